@@ -1,54 +1,70 @@
-# ./backends/providers/anthropic.py
 """Adapter for Anthropic Claude models."""
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, Tuple
 
-import requests
-
-from utilities import Print
 from . import register_provider
+from .base import BaseProvider
 
 
 @register_provider("anthropic")
-class AnthropicProvider:
+class AnthropicProvider(BaseProvider):
+    display_name = "Anthropic"
+    default_base_url = "https://api.anthropic.com/v1"
+    requires_api_key = True
+
     def __init__(self, connection_config: Dict[str, Any]):
-        self.base_url = connection_config.get("base_url", "https://api.anthropic.com/v1").rstrip("/")
-        self.api_key = connection_config.get("api_key")
-        self.model = connection_config.get("default_model")
-        self.max_tokens = connection_config.get("default_max_tokens", 1024)
-        self.temperature = connection_config.get("default_temperature", 0.2)
+        super().__init__(connection_config)
         self.version = connection_config.get("anthropic_version", "2023-06-01")
-        self.extra_options = connection_config.get("options", {})
-        self.request_timeout = connection_config.get("timeout", 60)
-
-        if not self.api_key:
-            raise ValueError("Anthropic providers require an API key")
-        if not self.model:
-            raise ValueError("Anthropic providers require a default_model")
+        # "5m" (API default) or "1h"; only sent when set
+        self.prompt_cache_ttl = connection_config.get("prompt_cache_ttl")
 
-    def generate(self, system_prompt: str, user_content: str) -> str:
-        url = f"{self.base_url}/messages"
+    def build_request(self, system_prompt: str,
+                      user_content: str) -> Tuple[str, Dict[str, str], Dict[str, Any]]:
         headers = {
             "x-api-key": self.api_key,
             "anthropic-version": self.version,
             "content-type": "application/json",
         }
         messages: List[Dict[str, Any]] = [{"role": "user", "content": user_content}]
+        system: Any = system_prompt
+        if self.prompt_caching:
+            # Every call of a stage shares the system prompt, so cache it as the prefix
+            cache_control = {"type": "ephemeral"}
+            if self.prompt_cache_ttl:
+                cache_control["ttl"] = self.prompt_cache_ttl
+            system = [{"type": "text", "text": system_prompt, "cache_control": cache_control}]
         payload: Dict[str, Any] = {
             "model": self.model,
-            "system": system_prompt,
+            "system": system,
             "messages": messages,
             "temperature": self.temperature,
             "max_tokens": self.max_tokens,
         }
-        payload.update(self.extra_options)
-
-        Print("ATTEMPT", f"Calling Anthropic at {self.base_url}")
-        response = requests.post(url, headers=headers, json=payload, timeout=self.request_timeout)
-        if not response.ok:
-            raise RuntimeError(f"Anthropic error {response.status_code}: {response.text}")
-        data = response.json()
-        try:
-            content = data["content"][0]["text"]
-        except (KeyError, IndexError) as exc:
-            raise RuntimeError("Malformed response from Anthropic") from exc
-        return content.strip()
+        payload.update(self.options)
+        return f"{self.base_url}/messages", headers, payload
+
+    def parse_response(self, data: Dict[str, Any]) -> str:
+        text: str = data["content"][0]["text"]
+        return text
+
+    def parse_stream_event(self, event: Dict[str, Any]) -> Optional[str]:
+        if event.get("type") == "error":
+            raise RuntimeError(f"Anthropic stream error: {event.get('error')}")
+        if event.get("type") == "content_block_delta":
+            text: Optional[str] = event["delta"].get("text")
+            return text
+        return None
+
+    def parse_usage(self, data: Dict[str, Any]) -> Dict[str, int]:
+        # Responses and message_delta events carry "usage"; message_start nests it in "message"
+        usage = data.get("usage") or data.get("message", {}).get("usage") or {}
+        counts = {}
+        if usage.get("input_tokens") is not None:
+            # input_tokens excludes tokens read from or written to the prompt cache
+            counts["prompt_tokens"] = (usage["input_tokens"]
+                                       + (usage.get("cache_read_input_tokens") or 0)
+                                       + (usage.get("cache_creation_input_tokens") or 0))
+            if usage.get("cache_read_input_tokens") is not None:
+                counts["cached_prompt_tokens"] = usage["cache_read_input_tokens"]
+        if usage.get("output_tokens") is not None:
+            counts["completion_tokens"] = usage["output_tokens"]
+        return counts
@@ -0,0 +1,271 @@
+"""Shared HTTP plumbing for provider adapters."""
+import json
+import re
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Dict, Iterator, NamedTuple, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from utilities import Print
+
+
+# Status codes that mean "slow down" rather than "this request is bad"
+THROTTLE_STATUS_CODES = (429, 529)
+# Per-limit reset hints: OpenAI sends durations ("6m0s"), Anthropic RFC 3339 timestamps
+RATE_LIMIT_RESET_HEADERS = (
+    "x-ratelimit-reset-requests",
+    "x-ratelimit-reset-tokens",
+    "anthropic-ratelimit-requests-reset",
+    "anthropic-ratelimit-tokens-reset",
+    "anthropic-ratelimit-input-tokens-reset",
+    "anthropic-ratelimit-output-tokens-reset",
+)
+DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_reset_value(value: str) -> Optional[float]:
+    """Seconds from now described by a Retry-After or rate-limit reset header value."""
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parts = DURATION_PART.findall(value)
+    if parts and "".join(number + unit for number, unit in parts) == value:
+        return sum(float(number) * DURATION_UNITS[unit] for number, unit in parts)
+    try:
+        moment = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        try:
+            moment = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return max(0.0, (moment - datetime.now(timezone.utc)).total_seconds())
+
+
+def parse_retry_after(headers: Any) -> Optional[float]:
+    """How long the server asked us to wait, from Retry-After or rate-limit reset headers."""
+    if headers.get("retry-after-ms"):
+        try:
+            return max(0.0, float(headers["retry-after-ms"]) / 1000.0)
+        except ValueError:
+            pass
+    if headers.get("retry-after"):
+        delay = parse_reset_value(headers["retry-after"])
+        if delay is not None:
+            return delay
+    resets = [parse_reset_value(headers[name]) for name in RATE_LIMIT_RESET_HEADERS
+              if headers.get(name)]
+    delays = [delay for delay in resets if delay is not None]
+    return max(delays) if delays else None
+
+
+class ProviderHTTPError(RuntimeError):
+    """Non-OK response from a provider, with any wait the server asked for."""
+
+    def __init__(self, message: str, status_code: int, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+    @property
+    def throttled(self) -> bool:
+        return self.status_code in THROTTLE_STATUS_CODES
+
+
+class Completion(NamedTuple):
+    """A generated text plus what the API reported about producing it."""
+    text: str
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    time_to_first_token: Optional[float] = None
+    cached: bool = False
+    # Member connection that served the call when routed through a group
+    endpoint: Optional[str] = None
+    # Prompt tokens served from the provider's prefix cache, when it reports them
+    cached_prompt_tokens: Optional[int] = None
+
+
+class BaseProvider:
+    """Pooled, keep-alive HTTP session plus common request/response handling.
+
+    Subclasses set the class attributes below and implement build_request,
+    parse_response and parse_stream_event; complete() does the rest. Streaming
+    responses are read as server-sent events unless iter_stream is overridden.
+    parse_usage reads OpenAI-style usage blocks and is overridden where the
+    API reports token counts differently.
+    """
+
+    display_name = "Provider"
+    default_base_url = ""
+    default_temperature = 0.2
+    default_timeout = 60
+    requires_api_key = False
+
+    def __init__(self, connection_config: Dict[str, Any]):
+        self.base_url = connection_config.get("base_url", self.default_base_url).rstrip("/")
+        self.api_key = connection_config.get("api_key")
+        self.model = connection_config.get("default_model")
+        self.max_tokens = connection_config.get("default_max_tokens", 1024)
+        self.temperature = connection_config.get("default_temperature", self.default_temperature)
+        self.options = connection_config.get("options", {})
+        self.prompt_caching = bool(connection_config.get("prompt_caching", True))
+        # Set by the crystallizer; providers that size cache settings by prompt length use it
+        self.count_tokens: Optional[Callable[[str], int]] = None
+        self._prompt_tokens: Dict[str, int] = {}
+        self.stream = bool(connection_config.get("stream", False))
+        self.connect_timeout = connection_config.get("connect_timeout", 10)
+        self.read_timeout = connection_config.get(
+            "read_timeout", connection_config.get("timeout", self.default_timeout)
+        )
+
+        if self.requires_api_key and not self.api_key:
+            raise ValueError(f"{self.display_name} providers require an API key")
+        if not self.model:
+            raise ValueError(f"{self.display_name} providers require a default_model")
+
+        # One pool per connection, sized to the number of requests kept in flight
+        pool_size = int(connection_config.get(
+            "pool_size", connection_config.get("max_concurrency", 4)
+        ))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def build_request(self, system_prompt: str,
+                      user_content: str) -> Tuple[str, Dict[str, str], Dict[str, Any]]:
+        """Return (url, headers, json payload) for a completion request."""
+        raise NotImplementedError
+
+    def parse_response(self, data: Dict[str, Any]) -> str:
+        """Extract the completion text from a decoded response body."""
+        raise NotImplementedError
+
+    def parse_stream_event(self, event: Dict[str, Any]) -> Optional[str]:
+        """Extract the text delta, if any, from one decoded stream event."""
+        raise NotImplementedError
+
+    def parse_usage(self, data: Dict[str, Any]) -> Dict[str, int]:
+        """prompt_tokens/completion_tokens/cached_prompt_tokens from a response body or stream event."""
+        usage = data.get("usage") or {}
+        counts = {key: usage[key] for key in ("prompt_tokens", "completion_tokens")
+                  if usage.get(key) is not None}
+        cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+        if cached is not None:
+            counts["cached_prompt_tokens"] = cached
+        return counts
+
+    def prompt_token_count(self, text: str) -> Optional[int]:
+        """Token count of a (system) prompt, measured once per distinct prompt."""
+        if self.count_tokens is None:
+            return None
+        if text not in self._prompt_tokens:
+            self._prompt_tokens[text] = self.count_tokens(text)
+        return self._prompt_tokens[text]
+
+    def stream_payload(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """Request payload with streaming switched on."""
+        return {**payload, "stream": True}
+
+    @staticmethod
+    def iter_text_lines(response: requests.Response) -> Iterator[str]:
+        """Decode a streamed body line by line (servers rarely declare a charset)."""
+        for raw_line in response.iter_lines():
+            if raw_line:
+                yield raw_line.decode("utf-8")
+
+    def iter_stream(self, response: requests.Response, usage: Dict[str, int]) -> Iterator[str]:
+        """Yield text deltas from a server-sent-events body, collecting usage as it appears."""
+        for line in self.iter_text_lines(response):
+            if not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            event = json.loads(data)
+            usage.update(self.parse_usage(event))
+            delta = self.parse_stream_event(event)
+            if delta:
+                yield delta
+
+    def post(self, url: str, headers: Dict[str, str], payload: Dict[str, Any],
+             stream: bool = False) -> requests.Response:
+        response = self.session.post(
+            url, headers=headers, json=payload, stream=stream,
+            timeout=(self.connect_timeout, self.read_timeout),
+        )
+        self.raise_for_status(response)
+        return response
+
+    def raise_for_status(self, response: requests.Response) -> None:
+        """Raise ProviderHTTPError for a non-OK response."""
+        if response.ok:
+            return
+        retry_after = None
+        if response.status_code in THROTTLE_STATUS_CODES or response.status_code == 503:
+            retry_after = parse_retry_after(response.headers)
+        raise ProviderHTTPError(
+            f"{self.display_name} error {response.status_code}: {response.text}",
+            response.status_code, retry_after,
+        )
+
+    def generate(self, system_prompt: str, user_content: str,
+                 on_token: Optional[Callable[[str], Any]] = None) -> str:
+        return self.complete(system_prompt, user_content, on_token).text
+
+    def complete(self, system_prompt: str, user_content: str,
+                 on_token: Optional[Callable[[str], Any]] = None) -> Completion:
+        url, headers, payload = self.build_request(system_prompt, user_content)
+        if self.stream:
+            return self.complete_stream(url, headers, payload, on_token)
+        Print("ATTEMPT", f"Calling {self.display_name} at {self.base_url}")
+        response = self.post(url, headers, payload)
+        try:
+            data = response.json()
+            content = self.parse_response(data)
+        except (KeyError, IndexError, TypeError, ValueError) as exc:
+            raise RuntimeError(f"Malformed response from {self.display_name}") from exc
+        usage = self.parse_usage(data)
+        return Completion(content.strip(), usage.get("prompt_tokens"),
+                          usage.get("completion_tokens"),
+                          cached_prompt_tokens=usage.get("cached_prompt_tokens"))
+
+    def complete_stream(self, url: str, headers: Dict[str, str], payload: Dict[str, Any],
+                        on_token: Optional[Callable[[str], Any]] = None) -> Completion:
+        """Stream a completion, passing each text delta to on_token as it arrives."""
+        Print("ATTEMPT", f"Streaming from {self.display_name} at {self.base_url}")
+        started = time.monotonic()
+        first_token_at = None
+        pieces = []
+        usage: Dict[str, int] = {}
+        with self.post(url, headers, self.stream_payload(payload), stream=True) as response:
+            try:
+                for delta in self.iter_stream(response, usage):
+                    if first_token_at is None:
+                        first_token_at = time.monotonic()
+                    pieces.append(delta)
+                    if on_token is not None:
+                        on_token(delta)
+            except (KeyError, IndexError, TypeError, ValueError) as exc:
+                raise RuntimeError(f"Malformed stream from {self.display_name}") from exc
+        if first_token_at is None:
+            raise RuntimeError(f"Empty stream from {self.display_name}")
+        finished = time.monotonic()
+        generated = usage.get("completion_tokens", len(pieces))
+        generation_time = max(finished - first_token_at, 1e-6)
+        Print("STATE", f"{self.display_name} stream: time to first token "
+                       f"{first_token_at - started:.2f}s, {generated} tokens in "
+                       f"{finished - started:.2f}s (~{generated / generation_time:.1f} tokens/s)")
+        return Completion("".join(pieces).strip(), usage.get("prompt_tokens"),
+                          usage.get("completion_tokens"), first_token_at - started,
+                          cached_prompt_tokens=usage.get("cached_prompt_tokens"))
+
+    def close(self) -> None:
+        self.session.close()
@@ -0,0 +1,188 @@
+"""Content-addressed SQLite cache of provider responses."""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+
+from utilities import Print
+from .base import Completion
+
+DEFAULT_CACHE_PATH = ".crystallizer_cache/responses.sqlite3"
+DEFAULT_MAX_SIZE_MB = 512
+ACCESS_FLUSH_ROWS = 256
+ACCESS_FLUSH_INTERVAL_SECONDS = 5.0
+
+
+class ResponseCache:
+    """zlib-compressed responses keyed by request hash, evicted least-recently-used by size.
+
+    Hits do not write: their access times are kept in memory and stored in
+    one transaction every ACCESS_FLUSH_ROWS hits or ACCESS_FLUSH_INTERVAL_SECONDS,
+    before an eviction and on close, so a warm run does not commit per segment.
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_size_mb: float = DEFAULT_MAX_SIZE_MB):
+        self.path = Path(path).expanduser()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # key -> last access time not yet written
+        self._accessed: Dict[str, float] = {}
+        self._last_flush = time.monotonic()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY,"
+            " value BLOB NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " last_access REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_access ON responses(last_access)"
+        )
+        self._conn.commit()
+        self._total_bytes = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+
+    @classmethod
+    def from_config(cls, cache_config: Dict[str, Any]) -> "ResponseCache":
+        return cls(
+            path=cache_config.get("path", DEFAULT_CACHE_PATH),
+            max_size_mb=cache_config.get("max_size_mb", DEFAULT_MAX_SIZE_MB),
+        )
+
+    @staticmethod
+    def make_key(**fields: Any) -> str:
+        """Stable sha256 over the JSON encoding of the request fields."""
+        encoded = json.dumps(fields, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._accessed[key] = time.time()
+            if (len(self._accessed) >= ACCESS_FLUSH_ROWS
+                    or time.monotonic() - self._last_flush >= ACCESS_FLUSH_INTERVAL_SECONDS):
+                self._flush_access()
+                self._conn.commit()
+        return zlib.decompress(row[0]).decode("utf-8")
+
+    def put(self, key: str, value: str) -> None:
+        blob = zlib.compress(value.encode("utf-8"))
+        with self._lock:
+            previous = self._conn.execute(
+                "SELECT size FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, last_access)"
+                " VALUES (?, ?, ?, ?)",
+                (key, blob, len(blob), time.time()),
+            )
+            self._accessed.pop(key, None)
+            self._total_bytes += len(blob) - (previous[0] if previous else 0)
+            self._evict()
+            self._conn.commit()
+
+    def _flush_access(self) -> None:
+        """Write pending access times; the caller commits."""
+        if self._accessed:
+            self._conn.executemany(
+                "UPDATE responses SET last_access = ? WHERE key = ?",
+                [(accessed, key) for key, accessed in self._accessed.items()],
+            )
+            self._accessed.clear()
+        self._last_flush = time.monotonic()
+
+    def _evict(self) -> None:
+        """Drop least-recently-used entries until the cache fits max_bytes."""
+        if self._total_bytes > self.max_bytes:
+            self._flush_access()
+        while self._total_bytes > self.max_bytes:
+            rows = self._conn.execute(
+                "SELECT key, size FROM responses ORDER BY last_access LIMIT 64"
+            ).fetchall()
+            if not rows:
+                self._total_bytes = 0
+                return
+            for key, size in rows:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._total_bytes -= size
+                if self._total_bytes <= self.max_bytes:
+                    return
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": entries,
+            "size_mb": round(self._total_bytes / (1024 ** 2), 2),
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush_access()
+            self._conn.commit()
+            self._conn.close()
+
+
+def provider_identity(provider: Any, api_type: str) -> Dict[str, Any]:
+    """Request fields besides the prompts that decide a provider's response."""
+    return {
+        "api_type": api_type,
+        "model": provider.model,
+        "temperature": provider.temperature,
+        "max_tokens": provider.max_tokens,
+        "options": provider.options,
+    }
+
+
+class CachedProvider:
+    """Wraps a provider so identical requests are served from a ResponseCache."""
+
+    def __init__(self, provider: Any, cache: ResponseCache, api_type: str):
+        self.provider = provider
+        self.cache = cache
+        self.api_type = api_type
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.provider, name)
+
+    def cache_key(self, system_prompt: str, user_content: str) -> str:
+        return ResponseCache.make_key(
+            **provider_identity(self.provider, self.api_type),
+            system=system_prompt,
+            user=user_content,
+        )
+
+    def generate(self, system_prompt: str, user_content: str,
+                 on_token: Optional[Callable[[str], Any]] = None) -> str:
+        return self.complete(system_prompt, user_content, on_token).text
+
+    def complete(self, system_prompt: str, user_content: str,
+                 on_token: Optional[Callable[[str], Any]] = None) -> Completion:
+        key = self.cache_key(system_prompt, user_content)
+        cached = self.cache.get(key)
+        if cached is not None:
+            Print("SUCCESS", f"Response cache hit ({key[:12]})")
+            if on_token is not None:
+                on_token(cached)
+            return Completion(cached, cached=True)
+        completion: Completion = self.provider.complete(system_prompt, user_content, on_token)
+        self.cache.put(key, completion.text)
+        return completion
@@ -0,0 +1,240 @@
+"""Load-balanced group of provider connections with circuit breakers and failover."""
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import requests
+
+from utilities import Print
+from .base import Completion, ProviderHTTPError
+
+ROUTING_STRATEGIES = ("least_outstanding", "latency")
+# Weight of the newest sample in each member's latency moving average
+LATENCY_SMOOTHING = 0.2
+
+
+def is_member_fault(error: BaseException) -> bool:
+    """True for errors that say the endpoint is unhealthy rather than the request bad.
+
+    Connection errors, timeouts, throttling and 5xx responses count against a
+    member and move the call to the next one; anything else (a 400 for an
+    oversized prompt, say) would fail the same way everywhere.
+    """
+    if isinstance(error, ProviderHTTPError):
+        return error.throttled or error.status_code >= 500
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+
+class CircuitBreaker:
+    """Opens after failure_threshold consecutive failures; after cooldown admits one trial call.
+
+    Not thread-safe on its own; ProviderGroup only touches it under its lock.
+    """
+
+    def __init__(self, failure_threshold: int = 3, cooldown: float = 30.0):
+        self.failure_threshold = max(1, failure_threshold)
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_in_flight = False
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def available(self, now: float) -> bool:
+        if self.opened_at is None:
+            return True
+        return not self.trial_in_flight and now - self.opened_at >= self.cooldown
+
+    def half_open_at(self) -> Optional[float]:
+        """When an open breaker will admit its trial call (None if closed or one is in flight)."""
+        if self.opened_at is None or self.trial_in_flight:
+            return None
+        return self.opened_at + self.cooldown
+
+    def on_start(self) -> None:
+        if self.opened_at is not None:
+            self.trial_in_flight = True
+
+    def on_success(self) -> bool:
+        """Reset; True if this closed an open breaker."""
+        was_open = self.opened_at is not None
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        return was_open
+
+    def on_failure(self, now: float) -> bool:
+        """Count a failure; True if this (re)opened the breaker."""
+        self.failures += 1
+        if self.opened_at is not None:
+            if not self.trial_in_flight:
+                # A call that was already in flight when the breaker opened
+                return False
+            # A failed trial call keeps the endpoint out for another cooldown
+            self.opened_at = now
+            self.trial_in_flight = False
+            return True
+        if self.failures >= self.failure_threshold:
+            self.opened_at = now
+            return True
+        return False
+
+
+class GroupMember:
+    """One connection in a group and its routing state."""
+
+    def __init__(self, name: str, provider: Any, weight: float = 1.0, max_concurrency: int = 4,
+                 breaker: Optional[CircuitBreaker] = None):
+        self.name = name
+        self.provider = provider
+        self.weight = max(weight, 1e-6)
+        self.max_concurrency = max(1, max_concurrency)
+        self.breaker = breaker or CircuitBreaker()
+        self.outstanding = 0
+        self.latency: Optional[float] = None
+        self.calls = 0
+        self.failures = 0
+
+
+class ProviderGroup:
+    """Routes each call to the best available member and fails over on errors.
+
+    A member is eligible while its breaker is closed (or due a trial call) and
+    it has fewer than max_concurrency calls in flight. "least_outstanding"
+    picks the lowest in-flight count per unit weight; "latency" the lowest
+    moving-average latency scaled by load and weight, so unmeasured members
+    are tried first. A call that fails with a member fault (see
+    is_member_fault) before any token was streamed is retried on the next
+    member until every member has been tried; other errors are raised at once.
+    """
+
+    def __init__(self, name: str, members: Sequence[GroupMember],
+                 routing: str = "least_outstanding"):
+        if not members:
+            raise ValueError(f"Connection group '{name}' has no members")
+        if routing not in ROUTING_STRATEGIES:
+            raise ValueError(f"Unknown routing strategy '{routing}' for group '{name}'")
+        self.name = name
+        self.members = list(members)
+        self.routing = routing
+        self.stream = any(member.provider.stream for member in self.members)
+        self._cond = threading.Condition()
+
+    @property
+    def max_concurrency(self) -> int:
+        return sum(member.max_concurrency for member in self.members)
+
+    def score(self, member: GroupMember) -> tuple:
+        if self.routing == "latency":
+            return ((member.latency or 0.0) * (member.outstanding + 1) / member.weight,
+                    member.outstanding)
+        return (member.outstanding / member.weight, member.latency or 0.0)
+
+    def acquire(self, exclude: List[str]) -> Optional[GroupMember]:
+        """Reserve a slot on the best eligible member, waiting while all of them are busy.
+
+        While every remaining member is ejected this waits for the earliest
+        cooldown to end. Returns None only when every member is excluded.
+        """
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                remaining = [m for m in self.members if m.name not in exclude]
+                if not remaining:
+                    return None
+                candidates = [m for m in remaining
+                              if m.breaker.available(now) and m.outstanding < m.max_concurrency]
+                if candidates:
+                    member = min(candidates, key=self.score)
+                    member.outstanding += 1
+                    member.breaker.on_start()
+                    return member
+                timeout = None
+                if all(m.breaker.is_open for m in remaining):
+                    half_open = [at for at in (m.breaker.half_open_at() for m in remaining)
+                                 if at is not None]
+                    if half_open:
+                        timeout = max(0.0, min(half_open) - now)
+                # Releases notify, so this only sleeps past a cooldown when nothing is in flight
+                self._cond.wait(timeout=timeout)
+
+    def release(self, member: GroupMember, elapsed: Optional[float], failed: bool) -> None:
+        """Return member's slot; elapsed is None for calls whose latency says nothing (cached)."""
+        with self._cond:
+            member.outstanding -= 1
+            member.calls += 1
+            if failed:
+                member.failures += 1
+                if member.breaker.on_failure(time.monotonic()):
+                    Print("WARNING", f"{self.name}: ejecting {member.name} for "
+                                     f"{member.breaker.cooldown:.0f}s after "
+                                     f"{member.breaker.failures} failure(s)")
+            else:
+                if elapsed is not None:
+                    member.latency = elapsed if member.latency is None else (
+                        LATENCY_SMOOTHING * elapsed + (1 - LATENCY_SMOOTHING) * member.latency
+                    )
+                if member.breaker.on_success():
+                    Print("SUCCESS", f"{self.name}: {member.name} is healthy again")
+            self._cond.notify_all()
+
+    def generate(self, system_prompt: str, user_content: str,
+                 on_token: Optional[Callable[[str], Any]] = None) -> str:
+        return self.complete(system_prompt, user_content, on_token).text
+
+    def complete(self, system_prompt: str, user_content: str,
+                 on_token: Optional[Callable[[str], Any]] = None) -> Completion:
+        tried: List[str] = []
+        last_error: Optional[Exception] = None
+        streamed = False
+
+        def forward(delta: str) -> None:
+            nonlocal streamed
+            streamed = True
+            if on_token is not None:
+                on_token(delta)
+
+        while True:
+            member = self.acquire(tried)
+            if member is None:
+                break
+            started = time.monotonic()
+            try:
+                completion: Completion = member.provider.complete(
+                    system_prompt, user_content, forward if on_token is not None else None)
+            except Exception as e:
+                if not is_member_fault(e):
+                    # The endpoint answered; it is the request that failed
+                    self.release(member, None, failed=False)
+                    raise
+                self.release(member, time.monotonic() - started, failed=True)
+                if streamed:
+                    # Partial output already reached the caller; let it retry from scratch
+                    raise
+                tried.append(member.name)
+                last_error = e
+                Print("WARNING", f"{self.name}: {member.name} failed ({e}); failing over")
+                continue
+            self.release(member, None if completion.cached else time.monotonic() - started,
+                         failed=False)
+            return completion._replace(endpoint=member.name)
+        raise RuntimeError(f"All members of connection group '{self.name}' failed: "
+                           f"{last_error}") from last_error
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._cond:
+            return {
+                member.name: {
+                    "calls": member.calls,
+                    "failures": member.failures,
+                    "latency": None if member.latency is None else round(member.latency, 3),
+                    "ejected": member.breaker.is_open,
+                }
+                for member in self.members
+            }
+
+    def close(self) -> None:
+        for member in self.members:
+            member.provider.close()
@@ -1,28 +1,26 @@
-# ./backends/providers/ollama.py
 """Adapter for local Ollama servers."""
-from typing import Any, Dict
+import json
+from typing import Any, Dict, Iterator, Optional, Tuple
 
 import requests
 
-from utilities import Print
 from . import register_provider
+from .base import BaseProvider
 
 
 @register_provider("ollama")
-class OllamaProvider:
+class OllamaProvider(BaseProvider):
+    display_name = "Ollama"
+    default_base_url = "http://localhost:11434"
+    default_timeout = 120
+
     def __init__(self, connection_config: Dict[str, Any]):
-        self.base_url = connection_config.get("base_url", "http://localhost:11434").rstrip("/")
-        self.model = connection_config.get("default_model")
-        self.max_tokens = connection_config.get("default_max_tokens", 1024)
-        self.temperature = connection_config.get("default_temperature", 0.2)
-        self.options = connection_config.get("options", {})
-        self.request_timeout = connection_config.get("timeout", 120)
-
-        if not self.model:
-            raise ValueError("Ollama providers require a default_model")
-
-    def generate(self, system_prompt: str, user_content: str) -> str:
-        url = f"{self.base_url}/api/chat"
+        super().__init__(connection_config)
+        # How long the model (and its KV cache of the shared prompt) stays loaded between calls
+        self.keep_alive = connection_config.get("keep_alive", "30m")
+
+    def build_request(self, system_prompt: str,
+                      user_content: str) -> Tuple[str, Dict[str, str], Dict[str, Any]]:
         payload: Dict[str, Any] = {
             "model": self.model,
             "stream": False,
@@ -36,13 +34,42 @@ class OllamaProvider:
                 **self.options,
             },
         }
-        Print("ATTEMPT", f"Calling Ollama at {self.base_url}")
-        response = requests.post(url, json=payload, timeout=self.request_timeout)
-        if not response.ok:
-            raise RuntimeError(f"Ollama error {response.status_code}: {response.text}")
-        data = response.json()
-        message = data.get("message", {})
-        content = message.get("content")
+        if self.prompt_caching:
+            payload["keep_alive"] = self.keep_alive
+            num_keep = self.prompt_token_count(system_prompt)
+            if num_keep and "num_keep" not in self.options:
+                # Keep the system prompt when the context shifts; counted with the
+                # crystallizer's tokenizer, so approximate for non-OpenAI vocabularies
+                payload["options"]["num_keep"] = num_keep
+        return f"{self.base_url}/api/chat", {}, payload
+
+    def parse_response(self, data: Dict[str, Any]) -> str:
+        content: Optional[str] = data.get("message", {}).get("content")
         if not content:
-            raise RuntimeError("Malformed response from Ollama")
-        return content.strip()
+            raise KeyError("content")
+        return content
+
+    def parse_stream_event(self, event: Dict[str, Any]) -> Optional[str]:
+        if "error" in event:
+            raise RuntimeError(f"Ollama stream error: {event['error']}")
+        content: Optional[str] = event.get("message", {}).get("content")
+        return content
+
+    def parse_usage(self, data: Dict[str, Any]) -> Dict[str, int]:
+        counts = {}
+        if data.get("prompt_eval_count") is not None:
+            counts["prompt_tokens"] = data["prompt_eval_count"]
+        if data.get("eval_count") is not None:
+            counts["completion_tokens"] = data["eval_count"]
+        return counts
+
+    def iter_stream(self, response: requests.Response, usage: Dict[str, int]) -> Iterator[str]:
+        """Ollama streams newline-delimited JSON objects rather than SSE."""
+        for line in self.iter_text_lines(response):
+            event = json.loads(line)
+            usage.update(self.parse_usage(event))
+            delta = self.parse_stream_event(event)
+            if delta:
+                yield delta
+            if event.get("done"):
+                break
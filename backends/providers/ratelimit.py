@@ -0,0 +1,156 @@
+"""Per-connection request/token budgets and throttling-aware concurrency."""
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+from utilities import Print
+from .base import Completion, ProviderHTTPError
+
+# Multiplicative cut applied to the concurrency limit when a call is throttled
+THROTTLE_DECREASE = 0.5
+
+
+class TokenBucket:
+    """Continuously refilled bucket of `per_minute` units, holding at most one minute's worth.
+
+    A request larger than the whole bucket is admitted once the bucket is full
+    and leaves it in debt, so oversized prompts are slowed down, not refused.
+    """
+
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60.0
+        self.capacity = float(per_minute)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until amount can be taken (0 if now)."""
+        self.refill(now)
+        needed = min(amount, self.capacity)
+        if self.level >= needed:
+            return 0.0
+        return (needed - self.level) / self.rate
+
+    def take(self, amount: float) -> None:
+        self.level -= amount
+
+
+class RateLimiter:
+    """Gates calls on RPM and TPM budgets, a server-requested pause and an adaptive concurrency limit.
+
+    The concurrency limit starts at max_concurrency, halves on each throttled
+    call (at most once per second) and creeps back up by one after a limit's
+    worth of consecutive successes.
+    """
+
+    def __init__(self, name: str, max_concurrency: int,
+                 requests_per_minute: Optional[float] = None,
+                 tokens_per_minute: Optional[float] = None,
+                 adaptive_concurrency: bool = True):
+        self.name = name
+        self.max_concurrency = max(1, max_concurrency)
+        self.limit = float(self.max_concurrency)
+        self.adaptive_concurrency = adaptive_concurrency
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.throttled = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    @classmethod
+    def from_config(cls, name: str, connection_config: Dict[str, Any]) -> "RateLimiter":
+        return cls(
+            name,
+            int(connection_config.get("max_concurrency", 4)),
+            requests_per_minute=connection_config.get("requests_per_minute"),
+            tokens_per_minute=connection_config.get("tokens_per_minute"),
+            adaptive_concurrency=connection_config.get("adaptive_concurrency", True),
+        )
+
+    @property
+    def needs_token_estimate(self) -> bool:
+        return self.tokens is not None
+
+    def acquire(self, estimated_tokens: int = 0) -> None:
+        """Block until a call of estimated_tokens fits every budget, then reserve it."""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                wait = max(0.0, self.paused_until - now)
+                if self.in_flight >= int(self.limit):
+                    wait = max(wait, 0.5)
+                if self.requests is not None:
+                    wait = max(wait, self.requests.wait_time(1, now))
+                if self.tokens is not None:
+                    wait = max(wait, self.tokens.wait_time(estimated_tokens, now))
+                if wait <= 0:
+                    break
+                self._cond.wait(timeout=wait)
+            self.in_flight += 1
+            if self.requests is not None:
+                self.requests.take(1)
+            if self.tokens is not None:
+                self.tokens.take(estimated_tokens)
+
+    def release(self, throttled: bool = False, retry_after: Optional[float] = None) -> None:
+        with self._cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                self.throttled += 1
+                if retry_after:
+                    self.paused_until = max(self.paused_until, now + retry_after)
+                if self.adaptive_concurrency and now - self._last_decrease >= 1.0:
+                    self._last_decrease = now
+                    previous = int(self.limit)
+                    self.limit = max(1.0, self.limit * THROTTLE_DECREASE)
+                    if int(self.limit) < previous:
+                        Print("WARNING", f"{self.name}: throttled; concurrency {previous} -> "
+                                         f"{int(self.limit)}")
+            elif self.adaptive_concurrency and self.limit < self.max_concurrency:
+                self.limit = min(float(self.max_concurrency), self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+
+class RateLimitedProvider:
+    """Wraps a provider so each call waits for its connection's RateLimiter."""
+
+    def __init__(self, provider: Any, limiter: RateLimiter,
+                 count_tokens: Optional[Callable[[str], int]] = None):
+        self.provider = provider
+        self.limiter = limiter
+        self.count_tokens = count_tokens
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.provider, name)
+
+    def estimate_tokens(self, system_prompt: str, user_content: str) -> int:
+        """Prompt tokens plus the completion allowance, which providers also charge against TPM."""
+        if not self.limiter.needs_token_estimate or self.count_tokens is None:
+            return 0
+        return (self.count_tokens(system_prompt) + self.count_tokens(user_content)
+                + int(self.provider.max_tokens or 0))
+
+    def generate(self, system_prompt: str, user_content: str,
+                 on_token: Optional[Callable[[str], Any]] = None) -> str:
+        return self.complete(system_prompt, user_content, on_token).text
+
+    def complete(self, system_prompt: str, user_content: str,
+                 on_token: Optional[Callable[[str], Any]] = None) -> Completion:
+        self.limiter.acquire(self.estimate_tokens(system_prompt, user_content))
+        try:
+            completion: Completion = self.provider.complete(system_prompt, user_content, on_token)
+        except ProviderHTTPError as e:
+            self.limiter.release(throttled=e.throttled, retry_after=e.retry_after)
+            raise
+        except Exception:
+            self.limiter.release()
+            raise
+        self.limiter.release()
+        return completion
@@ -0,0 +1,287 @@
+"""Offline map phase through the OpenAI-compatible /v1/files + /v1/batches API."""
+import json
+import time
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import requests
+
+from backends.providers.base import ProviderHTTPError
+from backends.providers.cache import CachedProvider
+from dispatch import Dispatcher
+from manifest import RunManifest, content_hash
+from telemetry import MetricsRecorder
+from utilities import Print
+
+BATCH_API_TYPES = ("openai", "vllm")
+BATCH_ENDPOINT = "/v1/chat/completions"
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+MAX_POLL_BACKOFF_SECONDS = 300.0
+
+
+class BatchFailedError(RuntimeError):
+    """A batch reached a terminal status without an output file."""
+
+
+def transient_poll_error(error: Exception) -> bool:
+    """True for poll failures worth waiting out: connection errors, timeouts, 429 and 5xx."""
+    if isinstance(error, ProviderHTTPError):
+        return error.throttled or error.status_code >= 500
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+
+class BatchRequest(NamedTuple):
+    custom_id: str
+    system_prompt: str
+    user_content: str
+    label: str
+    stage: str
+    future: Future
+
+
+class BatchCollector:
+    """Collects map calls as futures, then resolves them from batch jobs.
+
+    submit() has the dispatcher's signature so the crystallizer can queue
+    segments the same way in both modes. run() writes the queued requests as
+    JSONL, uploads it, creates a batch, polls it to a terminal status and
+    resolves each future from the output file. Requests the batch did not
+    answer (per-request errors, expiry) are retried through the interactive
+    dispatcher so no segment is lost. Cache hits are resolved immediately and
+    never enter the batch.
+    """
+
+    def __init__(self, provider: Any, connection_name: str, connection_config: Dict[str, Any],
+                 dispatcher: Dispatcher, metrics: Optional[MetricsRecorder] = None,
+                 manifest: Optional[RunManifest] = None):
+        self.provider = provider
+        self.connection_name = connection_name
+        self.dispatcher = dispatcher
+        self.metrics = metrics
+        self.manifest = manifest
+        self.poll_interval = float(connection_config.get("batch_poll_interval", 30.0))
+        self.completion_window = connection_config.get("batch_completion_window", "24h")
+        self.max_requests = max(1, int(connection_config.get("batch_max_requests", 50000)))
+        self.max_poll_failures = max(1, int(connection_config.get("batch_max_poll_failures", 10)))
+        self.requests: List[BatchRequest] = []
+
+    def submit(self, system_prompt: str, user_content: str, label: str,
+               stream_path: Optional[Path] = None, stage: str = "map") -> Future:
+        """Queue a call for the next batch; the future resolves to the response text."""
+        future: Future = Future()
+        if isinstance(self.provider, CachedProvider):
+            cached = self.provider.cache.get(self.provider.cache_key(system_prompt, user_content))
+            if cached is not None:
+                future.set_result(cached)
+                return future
+        custom_id = f"request-{len(self.requests):06d}"
+        self.requests.append(BatchRequest(custom_id, system_prompt, user_content, label, stage,
+                                          future))
+        return future
+
+    def run(self, output_dir: Path, task_label: str) -> None:
+        """Submit everything queued, in batches of at most max_requests, and wait for results."""
+        requests, self.requests = self.requests, []
+        if not requests:
+            return
+        chunks = [requests[i:i + self.max_requests]
+                  for i in range(0, len(requests), self.max_requests)]
+        for batch_idx, chunk in enumerate(chunks):
+            input_path = output_dir / f"{task_label}__batch-{batch_idx:03d}.jsonl"
+            self.run_batch(chunk, input_path)
+
+    def request_line(self, request: BatchRequest) -> Dict[str, Any]:
+        _, _, payload = self.provider.build_request(request.system_prompt, request.user_content)
+        return {"custom_id": request.custom_id, "method": "POST", "url": BATCH_ENDPOINT,
+                "body": payload}
+
+    def run_batch(self, requests: List[BatchRequest], input_path: Path) -> None:
+        contents = "".join(json.dumps(self.request_line(r)) + "\n" for r in requests)
+        with open(input_path, 'w') as f:
+            f.write(contents)
+        input_hash = content_hash(contents)
+        started = time.monotonic()
+        batch_id = self.manifest.batch_id(input_hash) if self.manifest is not None else None
+        if batch_id is not None and not self.batch_exists(batch_id):
+            Print("WARNING", f"Recorded batch {batch_id} is unknown to the server; resubmitting")
+            batch_id = None
+        if batch_id is not None:
+            Print("STATE", f"Resuming batch {batch_id} ({len(requests)} requests)")
+        else:
+            Print("STARTING", f"Uploading batch of {len(requests)} requests: {input_path.name}")
+            file_id = self.upload(input_path)
+            batch_id = self.create_batch(file_id)
+            if self.manifest is not None:
+                self.manifest.record_batch(input_hash, batch_id, str(input_path))
+            Print("STATE", f"Created batch {batch_id} (window {self.completion_window})")
+        try:
+            batch = self.wait(batch_id)
+        except BatchFailedError as e:
+            # Expired, failed or cancelled with no output: every request still needs an answer
+            if self.manifest is not None:
+                self.manifest.record_batch(input_hash, batch_id, str(input_path), "failed")
+            Print("WARNING", f"{e}; retrying all {len(requests)} request(s) interactively")
+            self.retry_interactively(requests)
+            return
+        results, errors = self.fetch_results(batch)
+        elapsed = time.monotonic() - started
+        fallback = []
+        for request in requests:
+            body = results.get(request.custom_id)
+            if body is None:
+                fallback.append((request, errors.get(request.custom_id, batch["status"])))
+                continue
+            try:
+                text = self.provider.parse_response(body).strip()
+            except (KeyError, IndexError, TypeError, ValueError) as e:
+                fallback.append((request, f"malformed response: {e}"))
+                continue
+            if isinstance(self.provider, CachedProvider):
+                self.provider.cache.put(
+                    self.provider.cache_key(request.system_prompt, request.user_content), text
+                )
+            usage = self.provider.parse_usage(body)
+            self.record(request, elapsed, usage, batch_id)
+            request.future.set_result(text)
+        if fallback:
+            Print("WARNING", f"Batch {batch_id}: {len(fallback)} request(s) unanswered "
+                             f"(e.g. {fallback[0][1]}); retrying them interactively")
+            self.retry_interactively([request for request, _ in fallback])
+        if self.manifest is not None:
+            self.manifest.record_batch(input_hash, batch_id, str(input_path), batch["status"])
+        Print("COMPLETED", f"Batch {batch_id}: {len(requests) - len(fallback)}/{len(requests)} "
+                           f"answered in {elapsed:.0f}s")
+        input_path.unlink(missing_ok=True)
+
+    def retry_interactively(self, requests: List[BatchRequest]) -> None:
+        """Send requests through the interactive dispatcher, resolving their futures from it."""
+        for request in requests:
+            self.chain(self.dispatcher.submit(request.system_prompt, request.user_content,
+                                              request.label, stage=request.stage),
+                       request.future)
+
+    @staticmethod
+    def chain(source: Future, target: Future) -> None:
+        """Resolve target with source's outcome once it finishes, or cancel it with source."""
+        def forward(done: Future) -> None:
+            if target.done():
+                return
+            if done.cancelled():
+                target.cancel()
+                return
+            error = done.exception()
+            if error is not None:
+                target.set_exception(error)
+            else:
+                target.set_result(done.result())
+        source.add_done_callback(forward)
+
+    def record(self, request: BatchRequest, elapsed: float, usage: Dict[str, int],
+               batch_id: str) -> None:
+        if self.metrics is None:
+            return
+        self.metrics.record_call(connection=self.connection_name, stage=request.stage,
+                                 label=request.label, status="ok", wall_time=round(elapsed, 4),
+                                 queue_wait=0.0, retries=0,
+                                 prompt_tokens=usage.get("prompt_tokens"),
+                                 completion_tokens=usage.get("completion_tokens"),
+                                 cached_prompt_tokens=usage.get("cached_prompt_tokens"),
+                                 cached=False, endpoint=f"batch:{batch_id}")
+
+    def api_headers(self) -> Dict[str, str]:
+        """The connection's auth headers, without the JSON content type."""
+        _, headers, _ = self.provider.build_request("", "")
+        return {name: value for name, value in headers.items() if name.lower() != "content-type"}
+
+    def api_call(self, method: str, path: str, **kwargs: Any) -> Any:
+        response = self.provider.session.request(
+            method, f"{self.provider.base_url}{path}", headers=self.api_headers(),
+            timeout=(self.provider.connect_timeout, self.provider.read_timeout), **kwargs,
+        )
+        self.provider.raise_for_status(response)
+        return response
+
+    def batch_exists(self, batch_id: str) -> bool:
+        try:
+            self.api_call("GET", f"/batches/{batch_id}")
+        except ProviderHTTPError as e:
+            if e.status_code == 404:
+                return False
+            raise
+        return True
+
+    def upload(self, input_path: Path) -> str:
+        with open(input_path, 'rb') as f:
+            response = self.api_call("POST", "/files", data={"purpose": "batch"},
+                                     files={"file": (input_path.name, f, "application/jsonl")})
+        return str(response.json()["id"])
+
+    def create_batch(self, file_id: str) -> str:
+        response = self.api_call("POST", "/batches", json={
+            "input_file_id": file_id,
+            "endpoint": BATCH_ENDPOINT,
+            "completion_window": self.completion_window,
+        })
+        return str(response.json()["id"])
+
+    def wait(self, batch_id: str) -> Dict[str, Any]:
+        """Poll until the batch reaches a terminal status; raise BatchFailedError if it produced
+        nothing usable.
+
+        Transient poll failures are retried with backoff; after max_poll_failures in a row the
+        error is raised, leaving the batch recorded in the manifest for --resume to collect.
+        """
+        last_progress = None
+        failures = 0
+        while True:
+            try:
+                batch: Dict[str, Any] = self.api_call("GET", f"/batches/{batch_id}").json()
+            except Exception as e:
+                if not transient_poll_error(e):
+                    raise
+                failures += 1
+                if failures >= self.max_poll_failures:
+                    raise
+                retry_after = e.retry_after if isinstance(e, ProviderHTTPError) else None
+                delay = retry_after if retry_after is not None else min(
+                    MAX_POLL_BACKOFF_SECONDS, self.poll_interval * 2.0 ** failures)
+                Print("WARNING", f"Polling batch {batch_id} failed ({e}); retrying in {delay:.0f}s")
+                time.sleep(delay)
+                continue
+            failures = 0
+            counts = batch.get("request_counts") or {}
+            progress = (batch["status"], counts.get("completed"), counts.get("failed"))
+            if progress != last_progress:
+                Print("PROGRESS", f"Batch {batch_id}: {batch['status']} "
+                                  f"({counts.get('completed', 0)}/{counts.get('total', '?')} done, "
+                                  f"{counts.get('failed', 0)} failed)")
+                last_progress = progress
+            if batch["status"] in TERMINAL_STATUSES:
+                break
+            time.sleep(self.poll_interval)
+        if batch["status"] != "completed" and not batch.get("output_file_id"):
+            raise BatchFailedError(f"Batch {batch_id} {batch['status']}: {batch.get('errors')}")
+        return batch
+
+    def fetch_results(self, batch: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, str]]:
+        """Response bodies by custom_id, and error descriptions for requests that failed."""
+        results: Dict[str, Any] = {}
+        errors: Dict[str, str] = {}
+        for key in ("output_file_id", "error_file_id"):
+            file_id = batch.get(key)
+            if not file_id:
+                continue
+            content = self.api_call("GET", f"/files/{file_id}/content").content.decode("utf-8")
+            for line in content.splitlines():
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                response = record.get("response") or {}
+                if response.get("status_code") == 200 and not record.get("error"):
+                    results[record["custom_id"]] = response["body"]
+                else:
+                    errors[record["custom_id"]] = str(record.get("error")
+                                                      or response.get("body")
+                                                      or response.get("status_code"))
+        return results, errors
@@ -0,0 +1,430 @@
+"""Local stand-in inference server for benchmarking without a model.
+
+Speaks the request/response shapes the adapters in backends/providers use:
+OpenAI and vLLM chat completions (``/v1/chat/completions``), Anthropic
+messages (``/v1/messages``) and Ollama chat (``/api/chat``), streaming and
+non-streaming, including usage blocks, plus the OpenAI batch flow
+(``/v1/files`` upload, ``/v1/batches`` create and poll, file content
+download). Repeated system prompts are reported as prefix-cache hits in
+the usage block, as the real APIs do (Anthropic only for system blocks
+marked with ``cache_control``). Latency before the first token,
+generation speed, reply length, the error rate and the rate of 429
+responses (with a Retry-After header) are configurable.
+
+Run standalone with ``python -m benchmarks.mock_server --port 8000``.
+"""
+import argparse
+import email.parser
+import email.policy
+import itertools
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+
+# Wire format each api_type speaks; vLLM serves the OpenAI chat completions API
+WIRE_FORMATS = {"openai": "openai", "vllm": "openai", "anthropic": "anthropic", "ollama": "ollama"}
+
+
+class MockSettings:
+    """Behaviour of the mock server; attributes may be changed while it runs."""
+
+    def __init__(self, latency: float = 0.0, tokens_per_sec: float = 0.0,
+                 reply_tokens: int = 64, error_rate: float = 0.0,
+                 error_status: int = 503, seed: Optional[int] = None,
+                 throttle_rate: float = 0.0, retry_after: float = 1.0,
+                 batch_delay: float = 0.0, batch_status: str = "completed",
+                 batch_poll_errors: int = 0):
+        self.latency = latency
+        # 0 means tokens are produced instantly
+        self.tokens_per_sec = tokens_per_sec
+        self.reply_tokens = reply_tokens
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        # Seconds a batch spends in_progress before its results are available
+        self.batch_delay = batch_delay
+        # Terminal status of batches; anything but "completed" ends them without output
+        self.batch_status = batch_status
+        # How many of the next batch status polls fail with error_status
+        self.batch_poll_errors = batch_poll_errors
+        self.random = random.Random(seed)
+
+
+class MockStats:
+    """Thread-safe request counters per wire format."""
+
+    def __init__(self) -> None:
+        self.requests: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+        self.throttled: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def count(self, api: str, failed: bool, throttled: bool = False) -> None:
+        with self._lock:
+            self.requests[api] = self.requests.get(api, 0) + 1
+            if failed:
+                self.errors[api] = self.errors.get(api, 0) + 1
+            if throttled:
+                self.throttled[api] = self.throttled.get(api, 0) + 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"requests": dict(self.requests), "errors": dict(self.errors),
+                    "throttled": dict(self.throttled)}
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough prompt token count (4 characters per token) for usage blocks."""
+    return max(1, len(text) // 4)
+
+
+def system_text(api: str, body: Dict[str, Any]) -> Tuple[str, bool]:
+    """The request's system prompt and whether the provider would cache it as a prefix."""
+    if api == "anthropic":
+        system = body.get("system", "")
+        if isinstance(system, list):
+            return ("".join(block.get("text", "") for block in system),
+                    any("cache_control" in block for block in system))
+        return system, False
+    for message in body.get("messages", []):
+        if message.get("role") == "system":
+            return str(message.get("content", "")), True
+    return "", False
+
+
+def reply_words(prompt: str, count: int) -> List[str]:
+    """Deterministic reply for a prompt: a digest line followed by filler words."""
+    words = [f"crystal[{len(prompt)}]"]
+    words.extend(f" w{i}" for i in range(max(0, count - 1)))
+    return words
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "MockInferenceServer"
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        parts = self.path.rstrip("/").split("/")
+        if len(parts) >= 2 and parts[-2] == "batches":
+            batch = self.server.batches.get(parts[-1])
+            settings = self.server.settings
+            if batch is not None and settings.batch_poll_errors > 0:
+                settings.batch_poll_errors -= 1
+                self.send_json(settings.error_status, {"error": "injected"})
+            elif batch is None:
+                self.send_json(404, {"error": "no such batch"})
+            else:
+                self.send_json(200, batch)
+            return
+        if len(parts) >= 3 and parts[-1] == "content" and parts[-3] == "files":
+            content = self.server.files.get(parts[-2])
+            if content is None:
+                self.send_json(404, {"error": "no such file"})
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/jsonl")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+            return
+        self.send_json(404, {"error": f"unknown endpoint {self.path}"})
+
+    def upload_file(self, body: bytes) -> None:
+        """Store the "file" part of a multipart upload."""
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            b"Content-Type: " + self.headers["Content-Type"].encode() + b"\r\n\r\n" + body
+        )
+        for part in message.iter_parts():
+            payload = part.get_payload(decode=True)
+            if part.get_param("name", header="content-disposition") == "file" \
+                    and isinstance(payload, bytes):
+                file_id = self.server.store_file(payload)
+                self.send_json(200, {"id": file_id, "object": "file", "purpose": "batch"})
+                return
+        self.send_json(400, {"error": "missing file part"})
+
+    def do_POST(self) -> None:
+        if self.path.endswith("/files"):
+            self.upload_file(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            return
+        if self.path.endswith("/batches"):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if body.get("input_file_id") not in self.server.files:
+                self.send_json(400, {"error": "unknown input_file_id"})
+                return
+            self.send_json(200, self.server.create_batch(body["input_file_id"]))
+            return
+        if self.path.endswith("/chat/completions"):
+            api = "openai"
+        elif self.path.endswith("/messages"):
+            api = "anthropic"
+        elif self.path.endswith("/api/chat"):
+            api = "ollama"
+        else:
+            self.send_json(404, {"error": f"unknown endpoint {self.path}"})
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        settings = self.server.settings
+        roll = settings.random.random()
+        throttled = roll < settings.throttle_rate
+        failed = not throttled and roll < settings.throttle_rate + settings.error_rate
+        self.server.stats.count(api, failed, throttled)
+        if throttled:
+            self.send_json(429, {"error": "rate limited"},
+                           {"Retry-After": f"{settings.retry_after:g}"})
+            return
+        if settings.latency:
+            time.sleep(settings.latency)
+        if failed:
+            self.send_json(settings.error_status, {"error": "injected failure"})
+            return
+
+        system, cacheable = system_text(api, body)
+        prompt = system + "".join(
+            str(message.get("content", "")) for message in body.get("messages", [])
+            if message.get("role") != "system"
+        )
+        words = reply_words(prompt, settings.reply_tokens)
+        cached = self.server.cached_prefix_tokens(system) if cacheable else 0
+        usage = (estimate_tokens(prompt), len(words), cached)
+        if body.get("stream"):
+            self.stream_reply(api, body, words, usage)
+            return
+        self.pace(len(words))
+        self.send_json(200, self.full_response(api, "".join(words), usage))
+
+    def pace(self, tokens: int) -> None:
+        tokens_per_sec = self.server.settings.tokens_per_sec
+        if tokens_per_sec > 0:
+            time.sleep(tokens / tokens_per_sec)
+
+    def send_json(self, status: int, data: Dict[str, Any],
+                  headers: Optional[Dict[str, str]] = None) -> None:
+        encoded = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    @staticmethod
+    def full_response(api: str, text: str, usage: tuple) -> Dict[str, Any]:
+        if api == "anthropic":
+            return {"type": "message", "content": [{"type": "text", "text": text}],
+                    "usage": MockHandler.usage_block(api, usage)}
+        if api == "ollama":
+            return {"message": {"role": "assistant", "content": text}, "done": True,
+                    **MockHandler.usage_block(api, usage)}
+        return {"choices": [{"message": {"role": "assistant", "content": text}}],
+                "usage": MockHandler.usage_block(api, usage)}
+
+    @staticmethod
+    def usage_block(api: str, usage: tuple) -> Dict[str, Any]:
+        prompt_tokens, completion_tokens, cached = usage
+        if api == "anthropic":
+            return {"input_tokens": prompt_tokens - cached, "cache_read_input_tokens": cached,
+                    "output_tokens": completion_tokens}
+        if api == "ollama":
+            # Ollama only evaluates the part of the prompt not already in its KV cache
+            return {"prompt_eval_count": prompt_tokens - cached, "eval_count": completion_tokens}
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": cached}}
+
+    @staticmethod
+    def stream_events(api: str, body: Dict[str, Any], words: List[str],
+                      usage: tuple) -> Iterator[Optional[bytes]]:
+        """Encoded stream chunks; None marks where a token's generation time is spent."""
+        def sse(data: Dict[str, Any], event: Optional[str] = None) -> bytes:
+            prefix = f"event: {event}\n" if event else ""
+            return f"{prefix}data: {json.dumps(data)}\n\n".encode("utf-8")
+
+        if api == "anthropic":
+            yield sse({"type": "message_start",
+                       "message": {"usage": {**MockHandler.usage_block(api, usage),
+                                             "output_tokens": 1}}},
+                      "message_start")
+        for word in words:
+            yield None
+            if api == "anthropic":
+                yield sse({"type": "content_block_delta",
+                           "delta": {"type": "text_delta", "text": word}}, "content_block_delta")
+            elif api == "ollama":
+                yield (json.dumps({"message": {"content": word}, "done": False}) + "\n").encode()
+            else:
+                yield sse({"choices": [{"delta": {"content": word}}]})
+        if api == "anthropic":
+            yield sse({"type": "message_delta", "usage": {"output_tokens": usage[1]}},
+                      "message_delta")
+            yield sse({"type": "message_stop"}, "message_stop")
+        elif api == "ollama":
+            yield (json.dumps({"message": {"content": ""}, "done": True,
+                               **MockHandler.usage_block(api, usage)}) + "\n").encode()
+        else:
+            if body.get("stream_options", {}).get("include_usage"):
+                yield sse({"choices": [], "usage": MockHandler.usage_block(api, usage)})
+            yield b"data: [DONE]\n\n"
+
+    def stream_reply(self, api: str, body: Dict[str, Any], words: List[str], usage: tuple) -> None:
+        self.send_response(200)
+        content_type = "application/x-ndjson" if api == "ollama" else "text/event-stream"
+        self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for chunk in self.stream_events(api, body, words, usage):
+            if chunk is None:
+                self.pace(1)
+                continue
+            self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+
+class MockInferenceServer(ThreadingHTTPServer):
+    """Threaded HTTP server answering every supported wire format on one port."""
+
+    daemon_threads = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0,
+                 settings: Optional[MockSettings] = None):
+        super().__init__((host, port), MockHandler)
+        self.settings = settings or MockSettings()
+        self.stats = MockStats()
+        self.files: Dict[str, bytes] = {}
+        self.batches: Dict[str, Dict[str, Any]] = {}
+        self.prefixes: Set[str] = set()
+        self._prefix_lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._thread: Optional[threading.Thread] = None
+
+    def cached_prefix_tokens(self, system: str) -> int:
+        """Tokens of system served from the prefix cache: all of them once it has been seen."""
+        if not system:
+            return 0
+        with self._prefix_lock:
+            if system in self.prefixes:
+                return estimate_tokens(system)
+            self.prefixes.add(system)
+        return 0
+
+    def store_file(self, content: bytes) -> str:
+        file_id = f"file-{next(self._ids):06d}"
+        self.files[file_id] = content
+        return file_id
+
+    def create_batch(self, input_file_id: str) -> Dict[str, Any]:
+        batch_id = f"batch-{next(self._ids):06d}"
+        batch = {"id": batch_id, "object": "batch", "status": "validating",
+                 "input_file_id": input_file_id, "output_file_id": None, "error_file_id": None,
+                 "request_counts": {"total": 0, "completed": 0, "failed": 0}}
+        self.batches[batch_id] = batch
+        threading.Thread(target=self.run_batch, args=(batch,), daemon=True).start()
+        return dict(batch)
+
+    def run_batch(self, batch: Dict[str, Any]) -> None:
+        """Answer every request line, honouring error_rate per request."""
+        lines = [json.loads(line) for line in self.files[batch["input_file_id"]].splitlines()
+                 if line.strip()]
+        batch["request_counts"]["total"] = len(lines)
+        batch["status"] = "in_progress"
+        time.sleep(self.settings.batch_delay)
+        if self.settings.batch_status != "completed":
+            batch["status"] = self.settings.batch_status
+            return
+        outputs, errors = [], []
+        for line in lines:
+            request = line["body"]
+            system, _ = system_text("openai", request)
+            prompt = system + "".join(str(m.get("content", "")) for m in request.get("messages", [])
+                                      if m.get("role") != "system")
+            failed = self.settings.random.random() < self.settings.error_rate
+            self.stats.count("batch", failed)
+            if failed:
+                errors.append({"custom_id": line["custom_id"],
+                               "response": {"status_code": 500, "body": {"error": "injected"}}})
+                batch["request_counts"]["failed"] += 1
+                continue
+            words = reply_words(prompt, self.settings.reply_tokens)
+            body = MockHandler.full_response("openai", "".join(words),
+                                             (estimate_tokens(prompt), len(words),
+                                              self.cached_prefix_tokens(system)))
+            outputs.append({"custom_id": line["custom_id"],
+                            "response": {"status_code": 200, "body": body}, "error": None})
+            batch["request_counts"]["completed"] += 1
+
+        def encode(records: List[Dict[str, Any]]) -> bytes:
+            return "".join(json.dumps(record) + "\n" for record in records).encode()
+
+        batch["output_file_id"] = self.store_file(encode(outputs)) if outputs else None
+        batch["error_file_id"] = self.store_file(encode(errors)) if errors else None
+        batch["status"] = "completed"
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        if isinstance(host, bytes):
+            host = host.decode()
+        return f"http://{host}:{port}"
+
+    def base_url(self, api_type: str) -> str:
+        """base_url a connection of this api_type should use to reach the server."""
+        return self.url if WIRE_FORMATS[api_type] == "ollama" else f"{self.url}/v1"
+
+    def start(self) -> "MockInferenceServer":
+        self._thread = threading.Thread(target=self.serve_forever, name="mock-inference",
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Mock OpenAI/vLLM/Anthropic/Ollama server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Seconds before the first token of every response")
+    parser.add_argument("--tokens-per-sec", type=float, default=0.0,
+                        help="Generation speed; 0 returns the whole reply at once")
+    parser.add_argument("--reply-tokens", type=int, default=64)
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Fraction of requests answered with --error-status")
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--throttle-rate", type=float, default=0.0,
+                        help="Fraction of requests answered with 429 and a Retry-After header")
+    parser.add_argument("--retry-after", type=float, default=1.0,
+                        help="Retry-After seconds sent with 429 responses")
+    parser.add_argument("--batch-delay", type=float, default=0.0,
+                        help="Seconds each batch job stays in_progress")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    settings = MockSettings(args.latency, args.tokens_per_sec, args.reply_tokens,
+                            args.error_rate, args.error_status, args.seed,
+                            args.throttle_rate, args.retry_after, args.batch_delay)
+    server = MockInferenceServer(args.host, args.port, settings)
+    print(f"Mock inference server listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+"""Run Crystallizer end to end against the mock inference server.
+
+Builds synthetic haystacks of increasing size and file count, runs
+Crystallizer.process_haystack over each through a chosen wire format and
+reports throughput, tokenization time, logging overhead and peak memory.
+The model side is instant unless --latency/--tokens-per-sec say otherwise,
+so wall time is mostly Crystallizer's own overhead.
+
+    python -m benchmarks.run_benchmarks --sizes 20000,200000 --files 1,8
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from benchmarks.mock_server import WIRE_FORMATS, MockInferenceServer, MockSettings
+from crystallizer import Crystallizer
+from utilities import configure_logging, flush_logs
+
+API_TYPES = tuple(WIRE_FORMATS)
+CONNECTION_NAME = "bench"
+TASK_LABEL = "bench"
+
+VOCABULARY = (
+    "the of and to in is was for on that with as by at from this be are it an or "
+    "which have not has but had their its were been one all can there more when "
+    "system model data time user process result value state file text window "
+    "segment crystal merge reduce token context memory request response server"
+).split()
+
+
+def synthetic_document(approx_words: int, seed: int) -> str:
+    """Markdown-ish text of roughly approx_words words with headings, paragraphs and chat turns."""
+    rng = random.Random(seed)
+    lines: List[str] = []
+    words = 0
+    section = 0
+    while words < approx_words:
+        if words % 2000 < 60:
+            section += 1
+            lines.append(f"## Section {section}\n")
+        speaker = rng.choice(("User", "Assistant", None, None))
+        sentence_count = rng.randint(2, 6)
+        paragraph = []
+        for _ in range(sentence_count):
+            sentence = rng.choices(VOCABULARY, k=rng.randint(8, 20))
+            paragraph.append(" ".join(sentence).capitalize() + ".")
+            words += len(sentence)
+        text = " ".join(paragraph)
+        lines.append(f"{speaker}: {text}\n" if speaker else f"{text}\n")
+    return "\n".join(lines)
+
+
+def build_haystack(root: Path, file_count: int, words_per_file: int) -> Path:
+    haystack = root / f"haystack_{file_count}x{words_per_file}"
+    haystack.mkdir(parents=True, exist_ok=True)
+    for idx in range(file_count):
+        (haystack / f"doc_{idx:04d}.md").write_text(
+            synthetic_document(words_per_file, seed=idx), encoding="utf-8"
+        )
+    return haystack
+
+
+def write_config(path: Path, api_type: str, base_url: str, args: argparse.Namespace) -> None:
+    config = {
+        "processing": {
+            "chunker": args.chunker,
+            "resource_sample_interval": 0.1,
+        },
+        "response_cache": {"enabled": False},
+        "inference_service_connections": {
+            CONNECTION_NAME: {
+                "api_type": api_type,
+                "base_url": base_url,
+                "api_key": "benchmark",
+                "default_model": "mock",
+                "default_ctx_len": args.ctx_len,
+                "default_max_tokens": args.reply_tokens,
+                "max_concurrency": args.max_concurrency,
+                "max_retries": args.max_retries,
+                "retry_backoff": 0.05,
+            }
+        },
+    }
+    with open(path, 'w') as f:
+        json.dump(config, f, indent=2)
+
+
+def read_summary(metrics_path: Path) -> Dict[str, Any]:
+    """The summary record written last to a run's metrics file."""
+    with open(metrics_path, 'r') as f:
+        lines = f.read().splitlines()
+    return json.loads(lines[-1]) if lines else {}
+
+
+def run_once(config_path: Path, haystack: Path, output_dir: Path, prompt_path: Path,
+             stream: bool, log_level: str) -> Dict[str, Any]:
+    """One process_haystack run with log output discarded; returns timings and the metrics summary."""
+    configure_logging(level=log_level)
+    crystallizer = Crystallizer(str(config_path), CONNECTION_NAME, use_cache=False, stream=stream)
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            started = time.perf_counter()
+            finals = crystallizer.process_haystack(str(haystack), str(prompt_path), TASK_LABEL,
+                                                   str(output_dir))
+            flush_logs()
+            wall_time = time.perf_counter() - started
+    finally:
+        crystallizer.close()
+    summary = read_summary(output_dir / f"{TASK_LABEL}__metrics.jsonl")
+    return {"wall_time": wall_time, "finals": len(finals), "summary": summary}
+
+
+def run_scenario(server: MockInferenceServer, workdir: Path, api_type: str, file_count: int,
+                 words_per_file: int, args: argparse.Namespace) -> Dict[str, Any]:
+    haystack = build_haystack(workdir, file_count, words_per_file)
+    config_path = workdir / f"config_{api_type}.json"
+    write_config(config_path, api_type, server.base_url(api_type), args)
+    prompt_path = workdir / "system_prompt.j2"
+    prompt_path.write_text("Summarize the text for {{ task_label }}.", encoding="utf-8")
+
+    counter = Crystallizer(str(config_path), CONNECTION_NAME, use_cache=False).token_counter
+    total_tokens = sum(counter.count_tokens(p.read_text(encoding="utf-8"))
+                       for p in haystack.glob("*.md"))
+
+    before = server.stats.snapshot()
+    output_dir = workdir / f"out_{api_type}_{haystack.name}"
+    run = run_once(config_path, haystack, output_dir, prompt_path, args.stream, args.log_level)
+    after = server.stats.snapshot()
+    wire = WIRE_FORMATS[api_type]
+    requests = after["requests"].get(wire, 0) - before["requests"].get(wire, 0)
+    errors = after["errors"].get(wire, 0) - before["errors"].get(wire, 0)
+    throttled = after["throttled"].get(wire, 0) - before["throttled"].get(wire, 0)
+
+    summary = run["summary"]
+    connections = summary.get("connections", {})
+    calls = sum(row["calls"] for row in connections.values())
+    result = {
+        "api_type": api_type,
+        "files": file_count,
+        "total_tokens": total_tokens,
+        "wall_time": round(run["wall_time"], 3),
+        "tokens_per_sec": round(total_tokens / run["wall_time"], 1) if run["wall_time"] else 0.0,
+        "tokenize_seconds": summary.get("stage_seconds", {}).get("tokenize", 0.0),
+        "map_seconds": summary.get("stage_seconds", {}).get("map", 0.0),
+        "reduce_seconds": summary.get("stage_seconds", {}).get("reduce", 0.0),
+        "calls": calls,
+        "failed_calls": sum(row["failed"] for row in connections.values()),
+        "http_requests": requests,
+        "error_rate": round(errors / requests, 3) if requests else 0.0,
+        "throttled_requests": throttled,
+        "p95_latency": max((row["p95_latency"] for row in connections.values()), default=0.0),
+        "prefix_hit_rate": prefix_hit_rate(connections),
+        "peak_rss_mb": summary.get("peak_rss_mb"),
+        "finals": run["finals"],
+        "log_overhead_seconds": None,
+    }
+    if args.measure_log_overhead:
+        quiet = run_once(config_path, haystack, workdir / f"quiet_{output_dir.name}", prompt_path,
+                         args.stream, "critical")
+        result["log_overhead_seconds"] = round(run["wall_time"] - quiet["wall_time"], 3)
+    return result
+
+
+def prefix_hit_rate(connections: Dict[str, Dict[str, Any]]) -> Optional[float]:
+    """Cached share of prompt tokens over the connections that report prefix-cache hits."""
+    rows = [row for row in connections.values() if row.get("prefix_hit_rate") is not None]
+    prompt = sum(row["prompt_tokens"] for row in rows)
+    return round(sum(row["cached_prompt_tokens"] for row in rows) / prompt, 3) if prompt else None
+
+
+def print_report(results: List[Dict[str, Any]]) -> None:
+    header = (f"{'api':<10} {'files':>5} {'tokens':>10} {'wall s':>8} {'tok/s':>10} "
+              f"{'tokenize s':>10} {'calls':>6} {'err rate':>8} {'p95 s':>7} "
+              f"{'pfx hit':>7} {'log s':>7} {'peak MB':>8}")
+    print(header)
+    for r in results:
+        log_overhead = "-" if r["log_overhead_seconds"] is None else f"{r['log_overhead_seconds']:.3f}"
+        peak = "-" if r["peak_rss_mb"] is None else f"{r['peak_rss_mb']:.1f}"
+        hit_rate = "-" if r["prefix_hit_rate"] is None else f"{r['prefix_hit_rate']:.0%}"
+        print(f"{r['api_type']:<10} {r['files']:>5} {r['total_tokens']:>10,} {r['wall_time']:>8.2f} "
+              f"{r['tokens_per_sec']:>10,.0f} {r['tokenize_seconds']:>10.3f} {r['calls']:>6} "
+              f"{r['error_rate']:>8.3f} {r['p95_latency']:>7.3f} {hit_rate:>7} {log_overhead:>7} "
+              f"{peak:>8}")
+
+
+def parse_int_list(value: str) -> List[int]:
+    return [int(item) for item in value.split(",") if item.strip()]
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark Crystallizer against a mock server")
+    parser.add_argument("--api-types", default="openai",
+                        help=f"Comma-separated wire formats to exercise ({', '.join(API_TYPES)})")
+    parser.add_argument("--sizes", type=parse_int_list, default=[5000, 50000, 200000],
+                        help="Comma-separated approximate words per file")
+    parser.add_argument("--files", type=parse_int_list, default=[1, 8],
+                        help="Comma-separated file counts")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Mock seconds before the first token")
+    parser.add_argument("--tokens-per-sec", type=float, default=0.0,
+                        help="Mock generation speed (0 = instant)")
+    parser.add_argument("--reply-tokens", type=int, default=64)
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Fraction of mock requests that fail with HTTP 503")
+    parser.add_argument("--throttle-rate", type=float, default=0.0,
+                        help="Fraction of mock requests answered with 429 and Retry-After")
+    parser.add_argument("--retry-after", type=float, default=0.2,
+                        help="Retry-After seconds the mock sends with 429 responses")
+    parser.add_argument("--max-concurrency", type=int, default=8)
+    parser.add_argument("--max-retries", type=int, default=3)
+    parser.add_argument("--ctx-len", type=int, default=16000)
+    parser.add_argument("--chunker", default="fixed")
+    parser.add_argument("--stream", action="store_true", help="Use streaming responses")
+    parser.add_argument("--log-level", default="debug",
+                        help="Crystallizer log level during runs (output is discarded)")
+    parser.add_argument("--measure-log-overhead", action="store_true",
+                        help="Rerun each scenario with logging off and report the difference")
+    parser.add_argument("--output", help="Also write results as JSON to this path")
+    parser.add_argument("--workdir", help="Keep haystacks and outputs here instead of a temp dir")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    api_types = [item.strip() for item in args.api_types.split(",") if item.strip()]
+    unknown = [api for api in api_types if api not in API_TYPES]
+    if unknown:
+        parser.error(f"Unknown api type(s): {', '.join(unknown)}")
+
+    settings = MockSettings(args.latency, args.tokens_per_sec, args.reply_tokens,
+                            args.error_rate, seed=args.seed,
+                            throttle_rate=args.throttle_rate, retry_after=args.retry_after)
+    server = MockInferenceServer(settings=settings).start()
+    results = []
+    try:
+        with tempfile.TemporaryDirectory(prefix="crystallizer-bench-") as tmp:
+            workdir = Path(args.workdir) if args.workdir else Path(tmp)
+            workdir.mkdir(parents=True, exist_ok=True)
+            for api_type in api_types:
+                for file_count in args.files:
+                    for words_per_file in args.sizes:
+                        print(f"Running {api_type}: {file_count} file(s) x ~{words_per_file:,} words",
+                              file=sys.stderr)
+                        results.append(run_scenario(server, workdir, api_type, file_count,
+                                                    words_per_file, args))
+    finally:
+        server.stop()
+
+    print_report(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
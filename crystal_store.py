@@ -0,0 +1,359 @@
+"""Pluggable storage for map, reduce and final crystals.
+
+Crystals are addressed by (base_name, task_label, level, ordinal): level 0
+holds map crystals, level N >= 1 the reduce nodes of tree level N, and the
+final crystal has no ordinal. Callers refer to a stored crystal by its path
+in the plain file layout (<output-dir>/<base>__<task>__NNN.txt and so on),
+whichever store holds it, so manifests and return values look the same.
+
+Export an SQLite store to the file layout with
+``python crystal_store.py export --output-dir ./crystals``.
+"""
+import argparse
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Type
+
+from utilities import Print
+
+FINAL_LEVEL = -1
+# Names per SELECT ... IN (...), under SQLite's default host parameter limit
+IN_QUERY_CHUNK = 500
+FLUSH_ROWS = 256
+FLUSH_INTERVAL_SECONDS = 1.0
+SQLITE_STORE_NAME = "crystals.sqlite3"
+
+
+def crystal_filename(base_name: str, task_label: str, ordinal: Optional[int] = None,
+                     level: int = 0) -> str:
+    """<base>__<task>__NNN.txt (map), <base>__<task>__L<level>-NNN.txt (reduce level > 0)
+    or <base>__<task>__final.txt (ordinal None)."""
+    if ordinal is None:
+        return f"{base_name}__{task_label}__final.txt"
+    if level:
+        return f"{base_name}__{task_label}__L{level}-{ordinal:03d}.txt"
+    return f"{base_name}__{task_label}__{ordinal:03d}.txt"
+
+
+class CrystalStore(ABC):
+    """Interface shared by the stores; the file layout is the reference implementation."""
+
+    def __init__(self, output_dir: Path):
+        self.output_dir = output_dir
+        self.source_hashes: Dict[str, Optional[str]] = {}
+
+    def reference(self, base_name: str, task_label: str, ordinal: Optional[int] = None,
+                  level: int = 0) -> str:
+        return str(self.output_dir / crystal_filename(base_name, task_label, ordinal, level))
+
+    def begin_file(self, base_name: str, source_hash: Optional[str]) -> None:
+        """Remember the source hash stored with this file's crystals (None until it is known)."""
+        self.source_hashes[base_name] = source_hash
+
+    @abstractmethod
+    def put(self, base_name: str, task_label: str, text: str, ordinal: Optional[int] = None,
+            level: int = 0, input_hash: Optional[str] = None,
+            input_tokens: Optional[int] = None) -> str:
+        """Store a crystal; returns its reference."""
+
+    @abstractmethod
+    def get(self, reference: str) -> Optional[str]:
+        """A stored crystal's text, or None if there is none."""
+
+    def get_many(self, references: Iterable[str]) -> List[Optional[str]]:
+        return [self.get(reference) for reference in references]
+
+    def exists(self, reference: str) -> bool:
+        return self.get(reference) is not None
+
+    @abstractmethod
+    def read_range(self, base_name: str, task_label: str, level: int = 0, start: int = 0,
+                   end: Optional[int] = None) -> List[Tuple[int, str]]:
+        """(ordinal, text) of one level's crystals with start <= ordinal < end, in ordinal order."""
+
+    @abstractmethod
+    def delete(self, references: Iterable[str]) -> None:
+        """Remove crystals; missing ones are ignored."""
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.flush()
+
+
+class FileCrystalStore(CrystalStore):
+    """One UTF-8 text file per crystal in the output directory."""
+
+    def put(self, base_name: str, task_label: str, text: str, ordinal: Optional[int] = None,
+            level: int = 0, input_hash: Optional[str] = None,
+            input_tokens: Optional[int] = None) -> str:
+        reference = self.reference(base_name, task_label, ordinal, level)
+        with open(reference, 'w') as f:
+            f.write(text)
+        return reference
+
+    def get(self, reference: str) -> Optional[str]:
+        try:
+            with open(reference, 'r') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def exists(self, reference: str) -> bool:
+        return os.path.exists(reference)
+
+    def read_range(self, base_name: str, task_label: str, level: int = 0, start: int = 0,
+                   end: Optional[int] = None) -> List[Tuple[int, str]]:
+        if level == FINAL_LEVEL:
+            text = self.get(self.reference(base_name, task_label))
+            return [] if text is None else [(0, text)]
+        pattern = re.compile(re.escape(f"{base_name}__{task_label}__")
+                             + (rf"L{level}-(\d+)\.txt$" if level else r"(\d+)\.txt$"))
+        ordinals = []
+        for name in os.listdir(self.output_dir):
+            match = pattern.match(name)
+            if match:
+                ordinal = int(match.group(1))
+                if ordinal >= start and (end is None or ordinal < end):
+                    ordinals.append(ordinal)
+        results = []
+        for ordinal in sorted(ordinals):
+            text = self.get(self.reference(base_name, task_label, ordinal, level))
+            if text is not None:
+                results.append((ordinal, text))
+        return results
+
+    def delete(self, references: Iterable[str]) -> None:
+        for reference in references:
+            try:
+                os.remove(reference)
+            except OSError:
+                pass
+
+
+class SQLiteCrystalStore(CrystalStore):
+    """zlib-compressed crystals in one SQLite database per output directory.
+
+    Rows are indexed on (base_name, task_label, level, ordinal) and carry the
+    input hash, input token count and source file hash. Writes are buffered
+    and committed in bulk every FLUSH_ROWS rows or FLUSH_INTERVAL_SECONDS.
+    Reads see buffered rows too.
+    """
+
+    def __init__(self, output_dir: Path, path: Optional[Path] = None):
+        super().__init__(output_dir)
+        self.path = path or output_dir / SQLITE_STORE_NAME
+        self._lock = threading.Lock()
+        self._pending: Dict[str, Tuple[Any, ...]] = {}
+        self._last_flush = time.monotonic()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30.0)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS crystals ("
+            " name TEXT PRIMARY KEY,"
+            " base_name TEXT NOT NULL,"
+            " task_label TEXT NOT NULL,"
+            " level INTEGER NOT NULL,"
+            " ordinal INTEGER NOT NULL,"
+            " text BLOB NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " input_hash TEXT,"
+            " input_tokens INTEGER,"
+            " source_hash TEXT,"
+            " created REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS crystals_position"
+            " ON crystals(base_name, task_label, level, ordinal)"
+        )
+        self._conn.commit()
+
+    def begin_file(self, base_name: str, source_hash: Optional[str]) -> None:
+        """Also fill in the hash on rows written while a streamed file was still being read."""
+        super().begin_file(base_name, source_hash)
+        if source_hash is None:
+            return
+        with self._lock:
+            self._flush()
+            self._conn.execute(
+                "UPDATE crystals SET source_hash = ? WHERE base_name = ? AND source_hash IS NULL",
+                (source_hash, base_name),
+            )
+            self._conn.commit()
+
+    def put(self, base_name: str, task_label: str, text: str, ordinal: Optional[int] = None,
+            level: int = 0, input_hash: Optional[str] = None,
+            input_tokens: Optional[int] = None) -> str:
+        reference = self.reference(base_name, task_label, ordinal, level)
+        name = Path(reference).name
+        row = (name, base_name, task_label, FINAL_LEVEL if ordinal is None else level,
+               0 if ordinal is None else ordinal, zlib.compress(text.encode("utf-8")),
+               len(text), input_hash, input_tokens, self.source_hashes.get(base_name),
+               time.time())
+        with self._lock:
+            self._pending[name] = row
+            if (len(self._pending) >= FLUSH_ROWS
+                    or time.monotonic() - self._last_flush >= FLUSH_INTERVAL_SECONDS):
+                self._flush()
+        return reference
+
+    def get(self, reference: str) -> Optional[str]:
+        name = Path(reference).name
+        with self._lock:
+            row = self._pending.get(name)
+            if row is not None:
+                blob = row[5]
+            else:
+                found = self._conn.execute(
+                    "SELECT text FROM crystals WHERE name = ?", (name,)
+                ).fetchone()
+                if found is None:
+                    return None
+                blob = found[0]
+        return zlib.decompress(blob).decode("utf-8")
+
+    def get_many(self, references: Iterable[str]) -> List[Optional[str]]:
+        """Buffered rows plus one SELECT ... IN (...) per IN_QUERY_CHUNK names."""
+        names = [Path(reference).name for reference in references]
+        blobs: Dict[str, bytes] = {}
+        with self._lock:
+            missing = []
+            for name in names:
+                row = self._pending.get(name)
+                if row is not None:
+                    blobs[name] = row[5]
+                else:
+                    missing.append(name)
+            for i in range(0, len(missing), IN_QUERY_CHUNK):
+                chunk = missing[i:i + IN_QUERY_CHUNK]
+                blobs.update(self._conn.execute(
+                    f"SELECT name, text FROM crystals WHERE name IN ({', '.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall())
+        return [zlib.decompress(blobs[name]).decode("utf-8") if name in blobs else None
+                for name in names]
+
+    def read_range(self, base_name: str, task_label: str, level: int = 0, start: int = 0,
+                   end: Optional[int] = None) -> List[Tuple[int, str]]:
+        """One indexed range scan over (base_name, task_label, level, ordinal)."""
+        with self._lock:
+            self._flush()
+            rows = self._conn.execute(
+                "SELECT ordinal, text FROM crystals"
+                " WHERE base_name = ? AND task_label = ? AND level = ? AND ordinal >= ?"
+                " AND ordinal < ? ORDER BY ordinal",
+                (base_name, task_label, level, start, end if end is not None else 2 ** 62),
+            ).fetchall()
+        return [(ordinal, zlib.decompress(blob).decode("utf-8")) for ordinal, blob in rows]
+
+    def delete(self, references: Iterable[str]) -> None:
+        names = [Path(reference).name for reference in references]
+        with self._lock:
+            for name in names:
+                self._pending.pop(name, None)
+            self._conn.executemany("DELETE FROM crystals WHERE name = ?",
+                                   [(name,) for name in names])
+            self._conn.commit()
+
+    def _flush(self) -> None:
+        if self._pending:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO crystals (name, base_name, task_label, level, ordinal,"
+                " text, size, input_hash, input_tokens, source_hash, created)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                list(self._pending.values()),
+            )
+            self._conn.commit()
+            self._pending.clear()
+        self._last_flush = time.monotonic()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush()
+            self._conn.close()
+
+    def entries(self, task_label: Optional[str] = None, final_only: bool = False
+                ) -> Iterable[Tuple[str, str, str, int, int, int]]:
+        """(name, base_name, task_label, level, ordinal, size) rows in base/task/level/ordinal order."""
+        query = "SELECT name, base_name, task_label, level, ordinal, size FROM crystals WHERE 1=1"
+        params: List[Any] = []
+        if task_label:
+            query += " AND task_label = ?"
+            params.append(task_label)
+        if final_only:
+            query += " AND level = ?"
+            params.append(FINAL_LEVEL)
+        query += " ORDER BY base_name, task_label, level, ordinal"
+        with self._lock:
+            self._flush()
+            return self._conn.execute(query, params).fetchall()
+
+    def export(self, dest_dir: Path, task_label: Optional[str] = None,
+               final_only: bool = False) -> int:
+        """Write crystals to dest_dir in the file layout; returns how many were written."""
+        dest_dir.mkdir(parents=True, exist_ok=True)
+        count = 0
+        for name, *_ in self.entries(task_label, final_only):
+            text = self.get(name)
+            if text is None:
+                continue
+            with open(dest_dir / name, 'w') as f:
+                f.write(text)
+            count += 1
+        return count
+
+
+CRYSTAL_STORES: Dict[str, Type[CrystalStore]] = {
+    "files": FileCrystalStore,
+    "sqlite": SQLiteCrystalStore,
+}
+
+
+def open_crystal_store(kind: str, output_dir: Path) -> CrystalStore:
+    if kind not in CRYSTAL_STORES:
+        raise ValueError(f"Unknown crystal_store '{kind}'; choose from {sorted(CRYSTAL_STORES)}")
+    return CRYSTAL_STORES[kind](output_dir)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Inspect or export an SQLite crystal store")
+    parser.add_argument("command", choices=("export", "ls"),
+                        help="export: write crystals as text files; ls: list stored crystals")
+    parser.add_argument("--output-dir", default="./crystals",
+                        help=f"Output directory holding {SQLITE_STORE_NAME}")
+    parser.add_argument("--dest", help="Directory to export to (default: the output directory)")
+    parser.add_argument("--task-label", help="Only this task's crystals")
+    parser.add_argument("--final-only", action="store_true", help="Only final crystals")
+    args = parser.parse_args()
+
+    output_dir = Path(args.output_dir)
+    if not (output_dir / SQLITE_STORE_NAME).exists():
+        Print("FAILURE", f"No crystal store at {output_dir / SQLITE_STORE_NAME}")
+        raise SystemExit(1)
+    store = SQLiteCrystalStore(output_dir)
+    try:
+        if args.command == "ls":
+            for name, base_name, task_label, level, ordinal, size in store.entries(
+                    args.task_label, args.final_only):
+                print(f"{name}\t{size}")
+        else:
+            dest = Path(args.dest) if args.dest else output_dir
+            count = store.export(dest, args.task_label, args.final_only)
+            Print("SUCCESS", f"Exported {count} crystal(s) to {dest}")
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
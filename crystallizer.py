@@ -5,22 +5,64 @@ Handles arbitrary text files/folders, provider-agnostic LLM backends.
 """
 
 import argparse
+import copy
 import json
 import os
 import sys
+from concurrent.futures import (ALL_COMPLETED, FIRST_COMPLETED, Executor, Future, as_completed,
+                                wait)
 from pathlib import Path
-from typing import Dict, Any, List, Protocol
+from typing import (Callable, Dict, Any, Iterable, Iterator, List, NamedTuple, Optional, Protocol,
+                    Sequence, Tuple)
 
 import tiktoken
 from jinja2 import Template
-import time
 
-from utilities import Print
+from utilities import LOG_FORMATS, LOG_LEVELS, Print, configure_logging
 from backends.providers import get_provider_class
+from backends.providers.cache import CachedProvider, ResponseCache, provider_identity
+from backends.providers.group import CircuitBreaker, GroupMember, ProviderGroup
+from backends.providers.ratelimit import RateLimitedProvider, RateLimiter
+from batch import BATCH_API_TYPES, BatchCollector
+from crystal_store import SQLITE_STORE_NAME, CrystalStore, crystal_filename, open_crystal_store
+from dedup import DuplicateIndex, follow
+from dispatch import Dispatcher, FairScheduler
+from incremental import CrystalIndex
+from ingest import DEFAULT_BLOCK_CHARS, StreamHash, file_fingerprint, read_text_blocks
+from manifest import RunManifest, content_hash
+from pipeline import (DEFAULT_EXTENSIONS, DirectoryPipeline, PlannedFile, PlanOptions, discover_files,
+                      file_keys)
+from planner import HaystackPlanner
+from reduce_tree import CRYSTAL_SEPARATOR, GroupCutter, ReduceTree
+from segmentation import CHUNKER_REGISTRY, Segment, get_chunker, stream_segments
+from telemetry import MetricsRecorder, ResourceSampler
+
+
+class PendingSegment(NamedTuple):
+    segment: Segment
+    input_hash: str
+    future: Future
+    reused: bool
+
+
+class FileJob(NamedTuple):
+    """A planned file; finished holds its final crystal if a previous run completed it.
+
+    segments is produced lazily while the file is read and tokenized.
+    """
+    file_path: Path
+    base_name: str
+    segments: Iterable[Segment]
+    finished: Optional[str] = None
+    # Hash of a streamed file's text, complete once segments is exhausted
+    source: Optional[StreamHash] = None
 
 
 class LLMProvider(Protocol):
-    def generate(self, system_prompt: str, user_content: str) -> str:
+    stream: bool
+
+    def generate(self, system_prompt: str, user_content: str,
+                 on_token: Optional[Callable[[str], Any]] = None) -> str:
         ...
 
 
@@ -31,183 +73,811 @@ class TokenCounter:
     def count_tokens(self, text: str) -> int:
         return len(self.encoding.encode(text))
 
-    def chunk_text(self, text: str, max_tokens: int, overlap: int = 100) -> List[str]:
-        """Split text into chunks that fit within token limits."""
-        tokens = self.encoding.encode(text)
-        chunks = []
-        start = 0
-        while start < len(tokens):
-            end = min(start + max_tokens, len(tokens))
-            chunk_tokens = tokens[start:end]
-            chunk_text = self.encoding.decode(chunk_tokens)
-            chunks.append(chunk_text)
-            if end >= len(tokens):
-                break
-            start = end - overlap
-        return chunks
+    def encode(self, text: str) -> List[int]:
+        return self.encoding.encode(text)
+
+    def decode(self, tokens: List[int]) -> str:
+        return self.encoding.decode(tokens)
 
 
 class Crystallizer:
-    def __init__(self, config_path: str, connection_name: str):
+    def __init__(self, config_path: str, connection_name: str, use_cache: bool = True,
+                 stream: bool = False, batch_mode: bool = False, incremental: Optional[bool] = None,
+                 reduce_connection: Optional[str] = None):
         with open(config_path, 'r') as f:
             self.config = json.load(f)
 
-        connections = self.config.get("inference_service_connections", {})
-        if not connections:
+        if not self.config.get("inference_service_connections"):
             raise ValueError("Config file missing 'inference_service_connections'")
-        if connection_name not in connections:
-            raise ValueError(f"Connection '{connection_name}' not found in config")
 
+        cache_config = self.config.get("response_cache", {})
+        self.response_cache = None
+        if use_cache and cache_config.get("enabled", True):
+            self.response_cache = ResponseCache.from_config(cache_config)
+
+        self.token_counter = TokenCounter()
+        # Response-cache identities of the connections built, by name; reuse hashes start with one
+        self.connection_identities: Dict[str, str] = {}
         self.connection_name = connection_name
-        self.connection_config = connections[connection_name]
-        self.api_type = self.connection_config.get("api_type")
-        if not self.api_type:
-            raise ValueError(f"Connection '{connection_name}' missing 'api_type'")
+        self.provider, self.connection_config = self.build_connection(connection_name, stream)
+        self.api_type = self.connection_config["api_type"]
+        self.batch_mode = batch_mode
+        if batch_mode and self.api_type not in BATCH_API_TYPES:
+            raise ValueError(f"--batch-mode needs an {' or '.join(BATCH_API_TYPES)} connection, "
+                             f"not '{connection_name}' ({self.api_type})")
+        self.metrics = MetricsRecorder()
+        self.dispatcher = Dispatcher(self.provider, connection_name, self.connection_config,
+                                     self.metrics)
+        self.map_identity = self.connection_identities[connection_name]
+        self.manifest: Optional[RunManifest] = None
+        self.crystal_index: Optional[CrystalIndex] = None
+        self.duplicates: Optional[DuplicateIndex] = None
+        self.crystal_store: Optional[CrystalStore] = None
 
-        provider_class = get_provider_class(self.api_type)
-        self.provider = provider_class(self.connection_config)
+        self.context_length: int = self.connection_config.get("default_ctx_len", 16000)
 
-        self.context_length = self.connection_config.get("default_ctx_len", 16000)
-        self.token_counter = TokenCounter()
+        processing = self.config.get("processing", {})
+        self.processing_config = processing
+        # The reduce phase may run on its own connection with its own limits
+        reduce_connection = (reduce_connection or processing.get("reduce_connection")
+                             or connection_name)
+        if reduce_connection == connection_name:
+            self.route_reduce(connection_name, self.provider, self.connection_config,
+                              self.dispatcher, self.map_identity)
+        else:
+            reduce_provider, reduce_config = self.build_connection(reduce_connection, stream)
+            self.route_reduce(reduce_connection, reduce_provider, reduce_config,
+                              Dispatcher(reduce_provider, reduce_connection, reduce_config,
+                                         self.metrics),
+                              self.connection_identities[reduce_connection])
+        self.incremental = (processing.get("incremental", True) if incremental is None
+                            else incremental)
+        self.dedup = bool(processing.get("dedup", True))
+        self.pipeline_reduce = bool(processing.get("pipeline_reduce", True))
+        self.crystal_store_kind = processing.get("crystal_store", "files")
+        # Exact duplicates only unless near-duplicate matching is opted into
+        self.dedup_threshold = float(processing.get("dedup_threshold", 1.0))
+        self.reduce_fan_in = max(2, int(processing.get("reduce_fan_in", 8)))
+        self.reduce_max_levels = max(1, int(processing.get("reduce_max_levels", 4)))
+        self.segment_count = max(1, int(processing.get("segment_count", 3)))
+        self.segment_overlap = max(0, int(processing.get("segment_overlap", 0)))
+        # None lets the chunker pick its own default (structure-aware cuts need no overlap)
+        self.window_overlap = processing.get("window_overlap")
+        self.chunker_name = processing.get("chunker", "fixed")
+        self.chunker_options = {
+            key: processing[key] for key in ("snap_ratio", "chat_turn_pattern") if key in processing
+        }
+        self.resource_sample_interval = float(processing.get("resource_sample_interval", 1.0))
+        self.ingest_block_chars = max(1, int(processing.get("ingest_block_chars",
+                                                            DEFAULT_BLOCK_CHARS)))
+        self.extensions = list(processing.get("extensions", DEFAULT_EXTENSIONS))
+        self.include_patterns = list(processing.get("include", []))
+        self.exclude_patterns = list(processing.get("exclude", []))
+        # Compiled system prompt templates by (path, mtime)
+        self.templates: Dict[Tuple[str, int], Template] = {}
+        # Long-lived planning pool shared by runs (server mode); None plans per run
+        self.planning_pool: Optional[Executor] = None
+        # Base names of the files found by discover_files; other files go by their stem
+        self.file_keys: Dict[Path, str] = {}
+
+    def route_reduce(self, connection_name: str, provider: Any, connection_config: Dict[str, Any],
+                     dispatcher: Dispatcher, identity: str) -> None:
+        """Send reduce-phase calls to this connection, sized by its context and max_tokens."""
+        self.reduce_connection_name = connection_name
+        self.reduce_identity = identity
+        self.reduce_provider = provider
+        self.reduce_connection_config = connection_config
+        self.reduce_dispatcher = dispatcher
+        self.reduce_context_length: int = connection_config.get("default_ctx_len", 16000)
+
+    def for_job(self, scheduler: FairScheduler, job_id: str,
+                reduce_source: Optional["Crystallizer"] = None,
+                reduce_scheduler: Optional[FairScheduler] = None) -> "Crystallizer":
+        """A crystallizer for one job that shares this one's tokenizer, provider, cache and
+        templates, with its own metrics and run state, dispatching through scheduler.
+
+        reduce_source lends its reduce connection, dispatched through reduce_scheduler.
+        """
+        job = copy.copy(self)
+        job.metrics = MetricsRecorder()
+        job.dispatcher = Dispatcher(self.provider, self.connection_name, self.connection_config,
+                                    job.metrics, scheduler=scheduler, job_id=job_id)
+        source = reduce_source or self
+        if source is self and self.reduce_dispatcher is self.dispatcher:
+            reduce_dispatcher = job.dispatcher
+        else:
+            reduce_dispatcher = Dispatcher(source.reduce_provider, source.reduce_connection_name,
+                                           source.reduce_connection_config, job.metrics,
+                                           scheduler=reduce_scheduler or scheduler, job_id=job_id)
+        job.route_reduce(source.reduce_connection_name, source.reduce_provider,
+                         source.reduce_connection_config, reduce_dispatcher,
+                         source.reduce_identity)
+        job.manifest = None
+        job.crystal_index = None
+        job.duplicates = None
+        job.crystal_store = None
+        job.extensions = list(self.extensions)
+        job.include_patterns = list(self.include_patterns)
+        job.exclude_patterns = list(self.exclude_patterns)
+        job.file_keys = {}
+        return job
+
+    def apply_overrides(self, reduce_fan_in: Optional[int] = None,
+                        reduce_max_levels: Optional[int] = None, chunker: Optional[str] = None,
+                        segment_count: Optional[int] = None, segment_overlap: Optional[int] = None,
+                        include: Sequence[str] = (), exclude: Sequence[str] = (),
+                        extensions: Optional[str] = None, dedup: Optional[bool] = None) -> None:
+        """Per-run settings given on the command line or with a server job."""
+        if reduce_fan_in:
+            self.reduce_fan_in = max(2, int(reduce_fan_in))
+        if reduce_max_levels:
+            self.reduce_max_levels = max(1, int(reduce_max_levels))
+        if chunker:
+            if chunker not in CHUNKER_REGISTRY:
+                raise ValueError(f"Unknown chunker '{chunker}'; choose from {sorted(CHUNKER_REGISTRY)}")
+            self.chunker_name = chunker
+        if segment_count:
+            self.segment_count = max(1, int(segment_count))
+        if segment_overlap is not None:
+            self.segment_overlap = max(0, int(segment_overlap))
+        self.include_patterns.extend(include)
+        self.exclude_patterns.extend(exclude)
+        if extensions:
+            self.extensions = [ext.strip() for ext in extensions.split(",") if ext.strip()]
+        if dedup is not None:
+            self.dedup = dedup
+
+    def build_connection(self, connection_name: str, stream: bool = False) -> Tuple[Any, Dict[str, Any]]:
+        """Provider and effective config for a connection or connection group name."""
+        groups = self.config.get("connection_groups", {})
+        if connection_name in groups:
+            return self.build_group(connection_name, groups[connection_name], stream)
+        return self.build_provider(connection_name, stream)
+
+    def build_provider(self, connection_name: str, stream: bool = False,
+                       **overrides: Any) -> Tuple[Any, Dict[str, Any]]:
+        """Provider for one configured connection behind its rate limiter and, if enabled,
+        the response cache (outermost, so cache hits never wait on rate limits)."""
+        connections = self.config.get("inference_service_connections", {})
+        if connection_name not in connections:
+            raise ValueError(f"Connection '{connection_name}' not found in config")
+        connection_config = {**connections[connection_name], **overrides}
+        if stream:
+            connection_config["stream"] = True
+        api_type = connection_config.get("api_type")
+        if not api_type:
+            raise ValueError(f"Connection '{connection_name}' missing 'api_type'")
+        provider = get_provider_class(api_type)(connection_config)
+        provider.count_tokens = self.token_counter.count_tokens
+        self.connection_identities[connection_name] = ResponseCache.make_key(
+            **provider_identity(provider, api_type))
+        provider = RateLimitedProvider(provider,
+                                       RateLimiter.from_config(connection_name, connection_config),
+                                       self.token_counter.count_tokens)
+        if self.response_cache is not None:
+            provider = CachedProvider(provider, self.response_cache, api_type)
+        return provider, connection_config
+
+    def build_group(self, group_name: str, group_config: Dict[str, Any],
+                    stream: bool = False) -> Tuple[ProviderGroup, Dict[str, Any]]:
+        """ProviderGroup over a connection_groups entry, plus the limits that apply to it."""
+        members = []
+        member_configs = []
+        for entry in group_config.get("members", []):
+            if isinstance(entry, str):
+                entry = {"connection": entry}
+            if "connection" not in entry:
+                raise ValueError(f"Connection group '{group_name}' has a member without 'connection'")
+            overrides = {}
+            if "max_concurrency" in entry:
+                overrides["max_concurrency"] = entry["max_concurrency"]
+            provider, member_config = self.build_provider(entry["connection"], stream, **overrides)
+            members.append(GroupMember(
+                entry["connection"], provider,
+                weight=float(entry.get("weight", 1.0)),
+                max_concurrency=int(member_config.get("max_concurrency", 4)),
+                breaker=CircuitBreaker(int(group_config.get("failure_threshold", 3)),
+                                       float(group_config.get("cooldown", 30.0))),
+            ))
+            member_configs.append(member_config)
+        group = ProviderGroup(group_name, members, group_config.get("routing", "least_outstanding"))
+        # Any member may answer a call, so a group's results depend on all of them
+        self.connection_identities[group_name] = ResponseCache.make_key(
+            members=sorted(self.connection_identities[member.name] for member in members))
+        # Any member may serve any call, so windows and merges must fit the tightest one
+        connection_config = {
+            "api_type": "+".join(sorted({c["api_type"] for c in member_configs})),
+            "default_ctx_len": min(c.get("default_ctx_len", 16000) for c in member_configs),
+            "default_max_tokens": max(c.get("default_max_tokens", 1024) for c in member_configs),
+            "max_concurrency": group.max_concurrency,
+            "max_retries": group_config.get("max_retries", 3),
+            "retry_backoff": group_config.get("retry_backoff", 2.0),
+            "max_throttle_retries": group_config.get("max_throttle_retries", 8),
+        }
+        Print("STATE", f"Connection group {group_name}: {len(members)} members, "
+                       f"{group.routing} routing, max_concurrency={group.max_concurrency}")
+        return group, connection_config
 
     def load_system_prompt(self, template_path: str, **kwargs) -> str:
         """Load and render Jinja2 system prompt template."""
-        with open(template_path, 'r') as f:
-            template = Template(f.read())
+        key = (str(template_path), os.stat(template_path).st_mtime_ns)
+        template = self.templates.get(key)
+        if template is None:
+            with open(template_path, 'r') as f:
+                template = Template(f.read())
+            self.templates[key] = template
         return template.render(**kwargs)
 
-    def create_filename(self, base_name: str, task_label: str, ordinal: int = None) -> str:
-        """Create deterministic filename: <base>__<task>__NNN.txt"""
-        if ordinal is not None:
-            return f"{base_name}__{task_label}__{ordinal:03d}.txt"
-        else:
-            return f"{base_name}__{task_label}__final.txt"
-
-    def parse_filename(self, filename: str) -> tuple:
-        """Parse filename back into components."""
-        name = Path(filename).stem
-        parts = name.split("__")
-        if len(parts) >= 3:
-            base_name = parts[0]
-            task_label = parts[1]
-            ordinal_or_final = parts[2]
-            return base_name, task_label, ordinal_or_final
-        return None, None, None
-
-    def process_single_window(self, content: str, system_prompt: str,
-                              base_name: str, task_label: str,
-                              window_idx: int, output_dir: Path) -> List[str]:
-        """Process a single window with 3-segment strategy."""
-        Print("STARTING", f"Window {window_idx}: 3-segment processing")
-        crystals = []
-        segment_size = len(content) // 3
-        segments = [
-            content[:segment_size],
-            content[segment_size:segment_size * 2],
-            content[segment_size * 2:]
-        ]
-        for seg_idx, segment in enumerate(segments):
-            if not segment.strip():
-                continue
-            Print("PROGRESS", f"Window {window_idx}, segment {seg_idx + 1}/3")
-            try:
-                Print("ATTEMPT", f"LLM generation for segment {seg_idx}")
-                result = self.provider.generate(system_prompt, segment)
-                ordinal = window_idx * 3 + seg_idx
-                crystal_filename = self.create_filename(base_name, task_label, ordinal)
-                crystal_path = output_dir / crystal_filename
-                with open(crystal_path, 'w') as f:
-                    f.write(result)
-                crystals.append(str(crystal_path))
-                Print("SUCCESS", f"Generated crystal: {crystal_filename}")
-                time.sleep(0.1)
-            except Exception as e:
-                Print("EXCEPTION", f"Failed to process segment {seg_idx} of window {window_idx}: {e}")
-        Print("COMPLETED", f"Window {window_idx}: Generated {len(crystals)} crystals")
-        return crystals
+    def create_filename(self, base_name: str, task_label: str, ordinal: Optional[int] = None,
+                        level: int = 0) -> str:
+        """Create deterministic filename: <base>__<task>__NNN.txt (map) or
+        <base>__<task>__L<level>-NNN.txt (reduce level > 0)."""
+        return crystal_filename(base_name, task_label, ordinal, level)
 
-    def merge_crystals(self, crystal_paths: List[str], system_prompt: str,
-                       base_name: str, task_label: str, output_dir: Path) -> str:
-        """Merge all crystals into final output."""
-        if not crystal_paths:
+    def window_tokens(self) -> int:
+        """Token budget of one window, leaving headroom for the prompt and output."""
+        return max(2000, self.context_length - 2000)
+
+    def make_chunker(self) -> Any:
+        return get_chunker(
+            self.chunker_name,
+            segment_count=self.segment_count,
+            segment_overlap=self.segment_overlap,
+            window_overlap=self.window_overlap,
+            **self.chunker_options,
+        )
+
+    def plan_options(self) -> PlanOptions:
+        """The segmentation settings, in a form planning worker processes can rebuild."""
+        chunker_options = dict(segment_count=self.segment_count,
+                               segment_overlap=self.segment_overlap,
+                               window_overlap=self.window_overlap, **self.chunker_options)
+        return PlanOptions(self.token_counter.encoding.name, self.chunker_name,
+                           tuple(sorted(chunker_options.items())), self.window_tokens())
+
+    def iter_token_blocks(self, file_path: Path,
+                          source: Optional[StreamHash] = None) -> Iterator[List[int]]:
+        blocks = read_text_blocks(file_path, self.ingest_block_chars)
+        if source is not None:
+            blocks = source.blocks(blocks)
+        for block in blocks:
+            with self.metrics.stage("tokenize"):
+                tokens = self.token_counter.encode(block)
+            yield tokens
+
+    def iter_segments(self, file_path: Path,
+                      source: Optional[StreamHash] = None) -> Iterator[Segment]:
+        """Plan a file window by window while it is read, in bounded memory.
+
+        Raises UnicodeDecodeError, when iterated, if the file is not UTF-8 text.
+        """
+        return stream_segments(self.iter_token_blocks(file_path, source), self.make_chunker(),
+                               self.token_counter.encoding, self.window_tokens())
+
+    def stream_path(self, crystal_path: Path) -> Path:
+        """Where a crystal's tokens are written while it is still streaming."""
+        return crystal_path.with_name(crystal_path.name + ".partial")
+
+    def submit_segments(self, segments: Iterable[Segment], system_prompt: str, base_name: str,
+                        task_label: str, output_dir: Path,
+                        submit: Optional[Callable[..., Future]] = None) -> List[PendingSegment]:
+        """Queue segments on the dispatcher (or another submit with its signature),
+        reusing manifest results on resume."""
+        return [self.submit_segment(segment, system_prompt, base_name, task_label, output_dir,
+                                    submit)
+                for segment in segments]
+
+    def submit_segment(self, segment: Segment, system_prompt: str, base_name: str,
+                       task_label: str, output_dir: Path,
+                       submit: Optional[Callable[..., Future]] = None) -> PendingSegment:
+        submit = submit or self.dispatcher.submit
+        input_hash = content_hash(self.map_identity, system_prompt, segment.text)
+        reused = self.reusable_output(base_name, f"map:{segment.ordinal:03d}", input_hash)
+        if reused is not None:
+            done: Future = Future()
+            done.set_result(reused)
+            if self.duplicates is not None:
+                self.duplicates.add(input_hash, None, done)
+            return PendingSegment(segment, input_hash, done, True)
+        label = (f"window {segment.window_idx} segment "
+                 f"{segment.seg_idx + 1}/{self.segment_count} "
+                 f"({segment.token_count:,} tokens)")
+        crystal_path = output_dir / self.create_filename(base_name, task_label, segment.ordinal)
+        future: Optional[Future] = None
+        signature = None
+        if self.duplicates is not None:
+            earlier, signature = self.duplicates.match(input_hash, segment.text)
+            if earlier is not None:
+                # If the earlier call fails, this segment gets its own interactive call
+                text = segment.text
+                future = follow(earlier, lambda: self.dispatcher.submit(
+                    system_prompt, text, label, self.stream_path(crystal_path)))
+        if future is None:
+            future = submit(system_prompt, segment.text, label, self.stream_path(crystal_path))
+        if self.duplicates is not None:
+            self.duplicates.add(input_hash, signature, future)
+        return PendingSegment(segment, input_hash, future, False)
+
+    def reusable_output(self, base_name: str, unit_id: str, input_hash: str) -> Optional[str]:
+        """Output text of a unit completed in a previous run, if resuming or incremental."""
+        reused = None
+        if self.manifest is not None:
+            reused = self.manifest.completed_output(base_name, unit_id, input_hash)
+        if reused is None and self.crystal_index is not None:
+            reused = self.crystal_index.lookup(base_name, input_hash)
+        if reused is not None and self.crystal_index is not None:
+            self.crystal_index.add(base_name, unit_id, input_hash, reused)
+        return reused
+
+    def record_unit(self, base_name: str, unit_id: str, status: str, input_hash: str,
+                    output_path: Optional[str] = None, output_text: Optional[str] = None,
+                    **info: Any) -> None:
+        if self.manifest is not None:
+            self.manifest.record(base_name, unit_id, status, input_hash,
+                                 output_path, output_text, **info)
+        if status == "done" and output_text is not None and self.crystal_index is not None:
+            self.crystal_index.add(base_name, unit_id, input_hash, output_text)
+
+    def collect_crystals(self, pending: List[PendingSegment], base_name: str,
+                         task_label: str, output_dir: Path) -> List[str]:
+        """Write crystals as their segments complete; returns paths in ordinal order."""
+        by_future = {item.future: item for item in pending}
+        crystals: Dict[int, str] = {}
+        failed = []
+        for future in as_completed(by_future):
+            item = by_future[future]
+            crystal_path = self.finish_segment(item, base_name, task_label, output_dir)
+            if crystal_path is None:
+                failed.append(item.segment.ordinal)
+            else:
+                crystals[item.segment.ordinal] = crystal_path
+        reused = sum(item.reused for item in pending)
+        return self.ordered_crystals(base_name, crystals, failed, reused)
+
+    def map_file(self, job: FileJob, system_prompt: str, task_label: str,
+                 output_dir: Path, tree: Optional[ReduceTree] = None) -> List[str]:
+        """Submit a file's segments as they are planned and write crystals as they complete.
+
+        At most twice max_concurrency segments are in flight, and each one's
+        text is dropped once submitted, so memory stays bounded however large
+        the file is. Completed crystals are handed to tree, if given, so its
+        merges start during the map phase. Returns crystal paths in ordinal order.
+        """
+        base_name = job.base_name
+        limit = max(2, 2 * self.dispatcher.max_concurrency)
+        in_flight: Dict[Future, PendingSegment] = {}
+        crystals: Dict[int, str] = {}
+        failed: List[int] = []
+        reused = 0
+        windows = tokens = 0
+
+        def drain(return_when: str) -> None:
+            done, _ = wait(in_flight, return_when=return_when)
+            for future in done:
+                item = in_flight.pop(future)
+                crystal_path = self.finish_segment(item, base_name, task_label, output_dir)
+                if crystal_path is None:
+                    failed.append(item.segment.ordinal)
+                else:
+                    crystals[item.segment.ordinal] = crystal_path
+                    if tree is not None:
+                        tree.add(item.segment.ordinal, future.result())
+
+        try:
+            for segment in job.segments:
+                if len(in_flight) >= limit:
+                    drain(FIRST_COMPLETED)
+                item = self.submit_segment(segment, system_prompt, base_name, task_label,
+                                           output_dir)
+                if tree is not None:
+                    tree.expect(segment.ordinal)
+                in_flight[item.future] = item._replace(segment=segment._replace(text=""))
+                reused += item.reused
+                windows = segment.window_idx + 1
+                tokens = max(tokens, segment.end)
+        finally:
+            if in_flight:
+                drain(ALL_COMPLETED)
+        Print("INFO", f"Token count: {tokens:,} ({windows} window(s))")
+        return self.ordered_crystals(base_name, crystals, failed, reused)
+
+    def finish_segment(self, item: PendingSegment, base_name: str, task_label: str,
+                       output_dir: Path) -> Optional[str]:
+        """Write and record one completed segment; returns its crystal path, or None if it failed."""
+        segment = item.segment
+        unit_id = f"map:{segment.ordinal:03d}"
+        unit_info: Dict[str, Any] = {"window": segment.window_idx, "segment": segment.seg_idx,
+                                     "tokens": segment.token_count}
+        store = self.store(output_dir)
+        crystal_path = store.reference(base_name, task_label, segment.ordinal)
+        try:
+            result = item.future.result()
+        except Exception as e:
+            Print("EXCEPTION", f"Segment {segment.ordinal} failed: {e}")
+            self.record_unit(base_name, unit_id, "failed", item.input_hash,
+                             error=str(e), **unit_info)
             return None
-        Print("STARTING", f"Merging {len(crystal_paths)} crystals")
-        crystal_contents = []
-        for idx, path in enumerate(sorted(crystal_paths)):
-            Print("PROGRESS", f"Reading crystal {idx + 1}/{len(crystal_paths)}")
-            with open(path, 'r') as f:
-                crystal_contents.append(f.read())
-        merge_prompt = f"""You are merging {len(crystal_contents)} crystallized segments in chronological order.
+        if item.reused:
+            if not store.exists(crystal_path):
+                # Reused from the crystal index; merge_crystals reads crystals from the store
+                self.write_crystal(output_dir, base_name, task_label, result, segment.ordinal,
+                                   input_hash=item.input_hash, input_tokens=segment.token_count)
+        else:
+            self.write_crystal(output_dir, base_name, task_label, result, segment.ordinal,
+                               input_hash=item.input_hash, input_tokens=segment.token_count)
+            self.record_unit(base_name, unit_id, "done", item.input_hash, crystal_path,
+                             result, **unit_info)
+            Print("SUCCESS", f"Generated crystal: {Path(crystal_path).name}")
+        return crystal_path
+
+    def ordered_crystals(self, base_name: str, crystals: Dict[int, str], failed: List[int],
+                         reused: int) -> List[str]:
+        if reused:
+            Print("STATE", f"Reused {reused} crystals from a previous run")
+        if failed:
+            raise RuntimeError(
+                f"{len(failed)} segment(s) of {base_name} failed: ordinals {sorted(failed)}"
+            )
+        return [crystals[ordinal] for ordinal in sorted(crystals)]
+
+    def store(self, output_dir: Path) -> CrystalStore:
+        """The run's crystal store, opened on first use."""
+        if self.crystal_store is None:
+            self.crystal_store = open_crystal_store(self.crystal_store_kind, output_dir)
+        return self.crystal_store
+
+    def write_crystal(self, output_dir: Path, base_name: str, task_label: str, text: str,
+                      ordinal: Optional[int] = None, level: int = 0, **meta: Any) -> str:
+        """Store a finished crystal and drop its streaming scratch file; returns its path."""
+        crystal_path = self.store(output_dir).put(base_name, task_label, text, ordinal, level,
+                                                  **meta)
+        self.remove_partials([crystal_path])
+        return crystal_path
+
+    def remove_partials(self, crystal_paths: List[str]) -> None:
+        """Delete the streaming scratch files of these crystals, if any are left."""
+        self.remove_files([str(self.stream_path(Path(path))) for path in crystal_paths])
+
+    def build_merge_prompt(self, segment_count: int) -> str:
+        """System prompt for merging segment_count crystals.
+
+        The count comes last so every merge call shares the longest possible
+        prompt prefix for provider-side prefix caching.
+        """
+        return f"""You are merging crystallized segments given in chronological order.
 Combine them into a single, coherent, deduplicated summary while preserving:
 - Chronological ordering
 - Evolution of ideas (mark v1, v2, etc. if concepts evolve)
 - All key decisions and architectural insights
 - Remove redundancy but keep completeness
 
-Output should be well-structured and comprehensive."""
-        combined_content = "\n\n--- CRYSTAL SEGMENT ---\n\n".join(crystal_contents)
+Output should be well-structured and comprehensive.
+There are {segment_count} segments."""
+
+    def reduce_token_budget(self) -> int:
+        """Tokens available for crystal content in a single merge call."""
+        max_output: int = self.reduce_connection_config.get("default_max_tokens", 1024)
+        prompt_tokens = self.token_counter.count_tokens(self.build_merge_prompt(self.reduce_fan_in))
+        return max(2000, self.reduce_context_length - max_output - prompt_tokens - 500)
+
+    def merge_input_tokens(self, token_counts: List[int]) -> int:
+        """Tokens of crystals with these counts joined for one merge call."""
+        separator_tokens = self.token_counter.count_tokens(CRYSTAL_SEPARATOR)
+        return sum(token_counts) + separator_tokens * max(0, len(token_counts) - 1)
+
+    def plan_reduce_groups(self, token_counts: List[int], budget: int) -> List[List[int]]:
+        """Group consecutive crystal indices so each group fits the budget and fan-in.
+
+        Every group holds at least two crystals (except a lone trailing one) so
+        each level is guaranteed to shrink, even if that overflows the budget.
+        """
+        cutter = GroupCutter(budget, self.reduce_fan_in,
+                             self.token_counter.count_tokens(CRYSTAL_SEPARATOR))
+        groups = [group for group in map(cutter.add, token_counts) if group is not None]
+        trailing = cutter.close()
+        if trailing:
+            groups.append(trailing)
+        return groups
+
+    def reduce_tree(self, base_name: str, task_label: str, output_dir: Path) -> ReduceTree:
+        """A file's tree reduce, to be fed its map crystals as they complete."""
+        return ReduceTree(self, base_name, task_label, output_dir)
+
+    def merge_crystals(self, crystal_paths: List[str], system_prompt: str,
+                       base_name: str, task_label: str, output_dir: Path,
+                       tree: Optional[ReduceTree] = None) -> Optional[str]:
+        """Merge crystals into final output through a multi-level tree reduce.
+
+        crystal_paths must be in chronological (ordinal) order. A tree that
+        was fed these crystals during the map phase is finished instead of
+        reading them back from the store, which is done with one ordered range
+        read of the file's map level. Returns None if the merge failed.
+        """
+        if not crystal_paths:
+            return None
+        Print("STARTING", f"Merging {len(crystal_paths)} crystals")
+        store = self.store(output_dir)
+        if tree is None:
+            # Keyed by file name: the level may also hold crystals this run did not produce
+            level = {crystal_filename(base_name, task_label, ordinal): text
+                     for ordinal, text in store.read_range(base_name, task_label)}
+            names = [Path(path).name for path in crystal_paths]
+            missing = [path for path, name in zip(crystal_paths, names) if name not in level]
+            if missing:
+                raise RuntimeError(f"{len(missing)} crystal(s) of {base_name} missing from the "
+                                   f"store, e.g. {missing[0]}")
+            tree = self.reduce_tree(base_name, task_label, output_dir)
+            for name in names:
+                tree.append(level[name])
         try:
-            Print("ATTEMPT", f"LLM merge of {len(crystal_contents)} segments")
-            final_result = self.provider.generate(merge_prompt, combined_content)
-            final_filename = self.create_filename(base_name, task_label)
-            final_path = output_dir / final_filename
-            with open(final_path, 'w') as f:
-                f.write(final_result)
-            Print("COMPLETED", f"Final crystal merge: {final_filename}")
-            return str(final_path)
+            final_path = tree.finish()
         except Exception as e:
+            tree.cancel()
             Print("EXCEPTION", f"Failed to merge crystals: {e}")
             return None
+        store.delete(tree.level_files)
+        self.remove_partials(tree.level_files)
+        return final_path
 
-    def process_file(self, file_path: Path, system_prompt: str,
-                     task_label: str, output_dir: Path) -> str:
-        """Process a single text file."""
+    def remove_files(self, paths: List[str]) -> None:
+        """Delete scratch files, ignoring ones already gone."""
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def base_name(self, file_path: Path) -> str:
+        """Name a file's crystals, manifest entry and index are stored under."""
+        return self.file_keys.get(file_path, file_path.stem)
+
+    def prepare_file(self, file_path: Path) -> FileJob:
+        """Register one file and set up its lazy segment plan.
+
+        Nothing is read yet: the source hash is computed from the same blocks
+        the plan reads, so the first window is mapped while the rest of the
+        file is still being read. A file that is not UTF-8 text raises
+        UnicodeDecodeError from its segments.
+        """
         Print("INFO", f"Processing: {file_path.name}")
+        base_name = self.base_name(file_path)
+        finished = self.start_file(file_path, None)
+        if finished:
+            return FileJob(file_path, base_name, [], finished)
+        source = StreamHash()
+        return FileJob(file_path, base_name, self.iter_segments(file_path, source), source=source)
+
+    def job_from_plan(self, planned: PlannedFile) -> Optional[FileJob]:
+        """FileJob for a file planned by a worker; None if it is not UTF-8 text."""
+        file_path = planned.file_path
+        if planned.source_hash is None:
+            Print("WARNING", f"Skipping binary file: {file_path}")
+            return None
+        base_name = self.base_name(file_path)
+        finished = self.start_file(file_path, planned.source_hash)
+        if finished:
+            return FileJob(file_path, base_name, [], finished)
+        windows = planned.segments[-1].window_idx + 1 if planned.segments else 0
+        Print("INFO", f"Planned {file_path.name}: {planned.token_count:,} tokens, "
+                      f"{windows} window(s)")
+        return FileJob(file_path, base_name, planned.segments)
+
+    def start_file(self, file_path: Path, source_hash: Optional[str]) -> Optional[str]:
+        """Register a file in the manifest and crystal index; returns its final crystal if a
+        previous run finished it.
+
+        source_hash is None for a file that is read as a stream; it is recorded
+        by finish_source once the file has been read through.
+        """
+        base_name = self.base_name(file_path)
+        if self.manifest is not None:
+            fingerprint = file_fingerprint(file_path)
+            finished = self.manifest.finished_output(base_name, source_hash, fingerprint)
+            if finished:
+                Print("SUCCESS", f"Already crystallized in a previous run: {finished}")
+                return finished
+            self.manifest.begin_file(base_name, str(file_path), source_hash, fingerprint)
+        if self.crystal_index is not None:
+            self.crystal_index.load(base_name, source_hash)
+        if self.crystal_store is not None:
+            self.crystal_store.begin_file(base_name, source_hash)
+        return None
+
+    def finish_source(self, job: FileJob) -> None:
+        """Record a streamed file's source hash once its segments have all been read."""
+        if job.source is None or job.source.value is None:
+            return
+        if self.manifest is not None:
+            self.manifest.set_source_hash(job.base_name, job.source.value)
+        if self.crystal_index is not None:
+            self.crystal_index.set_source_hash(job.base_name, job.source.value)
+        if self.crystal_store is not None:
+            self.crystal_store.begin_file(job.base_name, job.source.value)
+
+    def skip_binary(self, job: FileJob) -> None:
+        """A streamed file turned out not to be UTF-8 text."""
+        Print("WARNING", f"Skipping binary file: {job.file_path}")
+        if self.manifest is not None:
+            self.manifest.finish_file(job.base_name, "failed")
+
+    def process_file(self, file_path: Path, system_prompt: str,
+                     task_label: str, output_dir: Path) -> Optional[str]:
+        """Process a single text file; returns its final crystal path, or None if it was skipped."""
+        job = self.prepare_file(file_path)
+        if job is None or job.finished:
+            return job.finished if job else None
+        tree = None
+        if self.pipeline_reduce:
+            tree = self.reduce_tree(job.base_name, task_label, output_dir)
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
+            with self.metrics.stage("map"):
+                all_crystals = self.map_file(job, system_prompt, task_label, output_dir, tree)
         except UnicodeDecodeError:
-            Print("WARNING", f"Skipping binary file: {file_path}")
+            if tree is not None:
+                tree.cancel()
+            self.skip_binary(job)
             return None
-        base_name = file_path.stem
-        token_count = self.token_counter.count_tokens(content)
-        Print("INFO", f"Token count: {token_count:,}")
-        safe_window = max(2000, self.context_length - 2000)
-        all_crystals = []
-        if token_count <= safe_window:
-            Print("INFO", "Single window processing")
-            crystals = self.process_single_window(
-                content, system_prompt, base_name, task_label, 0, output_dir
-            )
-            all_crystals.extend(crystals)
-        else:
-            num_windows = token_count // safe_window + 1
-            Print("INFO", f"Multi-window processing ({num_windows} windows)")
-            Print("STARTING", f"Chunking {token_count:,} tokens into {num_windows} windows")
-            chunks = self.token_counter.chunk_text(content, safe_window)
-            for window_idx, chunk in enumerate(chunks):
-                Print("PROGRESS", f"Processing window {window_idx + 1}/{len(chunks)}")
-                crystals = self.process_single_window(
-                    chunk, system_prompt, base_name, task_label, window_idx, output_dir
-                )
-                all_crystals.extend(crystals)
+        except Exception:
+            if tree is not None:
+                tree.cancel()
+            if self.manifest is not None:
+                self.manifest.finish_file(job.base_name, "failed")
+            raise
+        with self.metrics.stage("reduce"):
+            return self.reduce_file(job, all_crystals, system_prompt, task_label, output_dir,
+                                    tree)
+
+    def complete_file(self, job: FileJob, pending: List[PendingSegment], system_prompt: str,
+                      task_label: str, output_dir: Path) -> Optional[str]:
+        """Collect a file's already-submitted map results, then reduce them."""
+        try:
+            with self.metrics.stage("map"):
+                all_crystals = self.collect_crystals(pending, job.base_name, task_label,
+                                                     output_dir)
+        except Exception:
+            if self.manifest is not None:
+                self.manifest.finish_file(job.base_name, "failed")
+            raise
+        with self.metrics.stage("reduce"):
+            return self.reduce_file(job, all_crystals, system_prompt, task_label, output_dir)
+
+    def reduce_file(self, job: FileJob, all_crystals: List[str], system_prompt: str,
+                    task_label: str, output_dir: Path,
+                    tree: Optional[ReduceTree] = None) -> Optional[str]:
+        """Reduce a file's map crystals to its final crystal and record the outcome.
+
+        Not timed here: the caller records the reduce stage, since the directory
+        pipeline runs several of these at once.
+        """
+        base_name = job.base_name
+        Print("COMPLETED", f"Map phase: generated {len(all_crystals)} crystals")
+        self.finish_source(job)
         final_crystal = self.merge_crystals(
-            all_crystals, system_prompt, base_name, task_label, output_dir
+            all_crystals, system_prompt, base_name, task_label, output_dir, tree
         )
-        Print("STATE", f"Cleaning up {len(all_crystals)} intermediate crystal files")
-        for crystal_path in all_crystals:
-            try:
-                os.remove(crystal_path)
-            except OSError:
-                pass
+        if final_crystal is None:
+            if self.manifest is not None:
+                self.manifest.finish_file(base_name, "failed")
+            if self.crystal_index is not None:
+                self.crystal_index.discard(base_name)
+            Print("WARNING", f"Keeping {len(all_crystals)} intermediate crystals of "
+                             f"{base_name} for --resume")
+            return None
+        if self.manifest is not None:
+            self.manifest.finish_file(base_name, "done")
+        if self.crystal_index is not None:
+            self.crystal_index.save(base_name)
+        Print("STATE", f"Cleaning up {len(all_crystals)} intermediate crystals")
+        self.store(output_dir).delete(all_crystals)
+        self.remove_partials(all_crystals)
         return final_crystal
 
+    def process_files_batched(self, files: List[Path], system_prompt: str, task_label: str,
+                              output_dir: Path) -> Tuple[List[str], List[Path]]:
+        """Plan every file, run all map calls as batch jobs, then reduce file by file."""
+        collector = BatchCollector(self.provider, self.connection_name, self.connection_config,
+                                   self.dispatcher, self.metrics, self.manifest)
+        final_crystals: List[str] = []
+        failed_files: List[Path] = []
+        jobs = []
+        for file_path in files:
+            job = self.prepare_file(file_path)
+            if job.finished:
+                final_crystals.append(job.finished)
+                continue
+            try:
+                # Batch mode holds every request anyway; reading the file first keeps a
+                # binary one out of the batch
+                segments = list(job.segments)
+            except UnicodeDecodeError:
+                self.skip_binary(job)
+                continue
+            pending = self.submit_segments(segments, system_prompt, job.base_name,
+                                           task_label, output_dir, submit=collector.submit)
+            jobs.append((job, pending))
+        with self.metrics.stage("map"):
+            collector.run(output_dir, task_label)
+        for job, pending in jobs:
+            try:
+                result = self.complete_file(job, pending, system_prompt, task_label, output_dir)
+            except Exception as e:
+                Print("FAILURE", f"Failed to process {job.file_path}: {e}")
+                failed_files.append(job.file_path)
+                continue
+            if result:
+                final_crystals.append(result)
+        return final_crystals, failed_files
+
     def process_haystack(self, haystack_path: str, system_prompt_template: str,
-                         task_label: str, output_dir: str) -> List[str]:
+                         task_label: str, output_dir: str, resume: bool = False) -> List[str]:
         """Main processing function."""
         haystack = Path(haystack_path)
         output_path = Path(output_dir)
         output_path.mkdir(parents=True, exist_ok=True)
+        self.crystal_store = open_crystal_store(self.crystal_store_kind, output_path)
+        self.manifest = RunManifest(output_path, task_label, resume=resume,
+                                    read_output=self.crystal_store.get)
+        if self.incremental:
+            self.crystal_index = CrystalIndex(output_path, task_label)
+        if self.dedup:
+            self.duplicates = DuplicateIndex(
+                self.dedup_threshold,
+                num_perm=int(self.processing_config.get("dedup_num_perm", 128)),
+                shingle_words=int(self.processing_config.get("dedup_shingle_words", 5)),
+            )
+        sampler = ResourceSampler(self.resource_sample_interval)
+        sampler.start()
+        try:
+            return self._process_haystack(haystack, system_prompt_template, task_label, output_path)
+        finally:
+            sampler.stop()
+            self.crystal_store.close()
+            if self.crystal_store_kind == "sqlite":
+                Print("INFO", f"Crystals stored in {output_path / SQLITE_STORE_NAME}; export "
+                              f"them with: python crystal_store.py export --output-dir {output_path}")
+            self.crystal_store = None
+            self.manifest.save(force=True)
+            self.write_metrics(output_path / f"{task_label}__metrics.jsonl", sampler)
+
+    def plan_haystack(self, haystack_path: str, system_prompt_template: str,
+                      task_label: str, output_dir: str) -> Dict[str, Any]:
+        """Dry run: tokenize and plan without provider calls; writes <task>__plan.json."""
+        output_path = Path(output_dir)
+        output_path.mkdir(parents=True, exist_ok=True)
+        system_prompt = self.load_system_prompt(
+            system_prompt_template,
+            task_label=task_label,
+            provider=self.api_type,
+            connection=self.connection_name,
+        )
+        plan = HaystackPlanner(self).run(Path(haystack_path), system_prompt, task_label,
+                                         output_path)
+        plan_path = output_path / f"{task_label}__plan.json"
+        with open(plan_path, 'w') as f:
+            json.dump(plan, f, indent=2)
+        HaystackPlanner.log_plan(plan)
+        Print("INFO", f"Plan written to {plan_path}")
+        return plan
+
+    def write_metrics(self, path: Path, sampler: ResourceSampler) -> None:
+        """Write the run's call records and summary as JSON lines and log the summary table."""
+        try:
+            summary = self.metrics.write_jsonl(path, sampler)
+        except OSError as e:
+            Print("WARNING", f"Could not write metrics to {path}: {e}")
+            return
+        MetricsRecorder.log_summary(summary)
+        Print("INFO", f"Run metrics written to {path}")
+
+    def discover_files(self, haystack: Path) -> List[Path]:
+        text_files = discover_files(haystack, self.extensions, self.include_patterns,
+                                    self.exclude_patterns)
+        self.file_keys = file_keys(text_files, haystack)
+        Print("INFO", f"Found {len(text_files)} text files")
+        return text_files
+
+    def _process_haystack(self, haystack: Path, system_prompt_template: str,
+                          task_label: str, output_path: Path) -> List[str]:
         system_prompt = self.load_system_prompt(
             system_prompt_template,
             task_label=task_label,
@@ -215,27 +885,64 @@ Output should be well-structured and comprehensive."""
             connection=self.connection_name,
         )
         final_crystals = []
-        if haystack.is_file():
+        if self.batch_mode and (haystack.is_file() or haystack.is_dir()):
+            files = [haystack] if haystack.is_file() else self.discover_files(haystack)
+            Print("STARTING", f"Batch-mode processing of {len(files)} file(s)")
+            final_crystals, failed_files = self.process_files_batched(
+                files, system_prompt, task_label, output_path
+            )
+            if failed_files:
+                Print("WARNING", f"{len(failed_files)} file(s) failed and produced no final crystal")
+        elif haystack.is_file():
             result = self.process_file(haystack, system_prompt, task_label, output_path)
             if result:
                 final_crystals.append(result)
         elif haystack.is_dir():
-            text_files = [f for f in haystack.rglob("*.txt") if f.is_file()]
-            text_files.extend([f for f in haystack.rglob("*.md") if f.is_file()])
-            Print("INFO", f"Found {len(text_files)} text files")
+            text_files = self.discover_files(haystack)
             Print("STARTING", f"Batch processing {len(text_files)} files")
-            for file_idx, file_path in enumerate(sorted(text_files)):
-                Print("PROGRESS", f"File {file_idx + 1}/{len(text_files)}: {file_path.name}")
-                result = self.process_file(file_path, system_prompt, task_label, output_path)
-                if result:
-                    final_crystals.append(result)
+            final_crystals, failed_files = DirectoryPipeline(self, self.processing_config).run(
+                text_files, system_prompt, task_label, output_path
+            )
             Print("COMPLETED", f"Batch processing finished")
+            if failed_files:
+                Print("WARNING", f"{len(failed_files)} file(s) failed and produced no final crystal")
         else:
-            Print("FAILURE", f"Haystack path not found: {haystack_path}")
-            raise ValueError(f"Haystack path not found: {haystack_path}")
+            Print("FAILURE", f"Haystack path not found: {haystack}")
+            raise ValueError(f"Haystack path not found: {haystack}")
         Print("SUCCESS", f"Generated {len(final_crystals)} final crystals in {output_path}")
+        if self.duplicates is not None and self.duplicates.skipped:
+            Print("STATE", f"Dedup: {self.duplicates.skipped} of {self.duplicates.seen} segment(s) "
+                           f"reused an earlier crystal ({self.duplicates.exact_hits} exact, "
+                           f"{self.duplicates.near_hits} near-duplicate)")
+        if self.response_cache:
+            stats = self.response_cache.stats()
+            Print("STATE", f"Response cache: {stats['hits']} hits, {stats['misses']} misses, "
+                           f"{stats['entries']} entries ({stats['size_mb']} MB)")
+        for name, provider in self.stage_providers().items():
+            if not isinstance(provider, ProviderGroup):
+                continue
+            for member_name, stats in provider.stats().items():
+                latency = "-" if stats["latency"] is None else f"{stats['latency']:.2f}s"
+                Print("STATE", f"{name}/{member_name}: {stats['calls']} calls, "
+                               f"{stats['failures']} failures, avg latency {latency}"
+                               f"{' (ejected)' if stats['ejected'] else ''}")
         return final_crystals
 
+    def stage_providers(self) -> Dict[str, Any]:
+        """Distinct providers of the map and reduce phases, by connection name."""
+        return {self.connection_name: self.provider,
+                self.reduce_connection_name: self.reduce_provider}
+
+    def close(self) -> None:
+        """Release worker threads, pooled connections and the response cache."""
+        self.dispatcher.shutdown()
+        if self.reduce_dispatcher is not self.dispatcher:
+            self.reduce_dispatcher.shutdown()
+        for provider in self.stage_providers().values():
+            provider.close()
+        if self.response_cache:
+            self.response_cache.close()
+
 
 def main():
     parser = argparse.ArgumentParser(description="Crystallizer: LLM-powered text synthesis")
@@ -243,28 +950,91 @@ def main():
                         help="Path to Jinja2 system prompt template")
     parser.add_argument("--haystack-path", required=True,
                         help="Path to text file or directory")
-    parser.add_argument("--connection", "--provider", dest="connection_name", required=True,
-                        help="Name of the inference_service_connections entry to use")
+    parser.add_argument("--connection", "--map-connection", "--provider", dest="connection_name",
+                        required=True,
+                        help="Name of the inference_service_connections or "
+                             "connection_groups entry to use (for the map phase, and for the "
+                             "reduce phase unless --reduce-connection is given)")
+    parser.add_argument("--reduce-connection",
+                        help="Connection or group for the reduce phase (overrides config)")
     parser.add_argument("--config-file-path", default="./config/config.json",
                         help="Path to config file")
     parser.add_argument("--output-dir", default="./crystals",
                         help="Output directory for crystals")
     parser.add_argument("--task-label", default="crystal",
                         help="Task identifier for filenames")
+    parser.add_argument("--reduce-fan-in", type=int,
+                        help="Max crystals merged per reduce call (overrides config)")
+    parser.add_argument("--reduce-max-levels", type=int,
+                        help="Max reduce tree depth including the final merge (overrides config)")
+    parser.add_argument("--chunker", choices=sorted(CHUNKER_REGISTRY),
+                        help="Window/segment cutting strategy: fixed token offsets or "
+                             "structure-aware boundaries (overrides config)")
+    parser.add_argument("--segment-count", type=int,
+                        help="Segments per window (overrides config)")
+    parser.add_argument("--segment-overlap", type=int,
+                        help="Tokens each segment repeats from the previous one (overrides config)")
+    parser.add_argument("--include", action="append", default=[], metavar="GLOB",
+                        help="Only process files matching this glob (repeatable; adds to config)")
+    parser.add_argument("--exclude", action="append", default=[], metavar="GLOB",
+                        help="Skip files and directories matching this glob (repeatable; "
+                             "adds to config)")
+    parser.add_argument("--extensions",
+                        help="Comma-separated file extensions to discover (overrides config)")
+    parser.add_argument("--stream", action="store_true",
+                        help="Stream completions, writing tokens to <crystal>.partial as they arrive")
+    parser.add_argument("--batch-mode", action="store_true",
+                        help="Run the map phase as offline /v1/batches jobs (openai/vllm connections)")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skip units completed by a previous run recorded in the output manifest")
+    parser.add_argument("--no-incremental", action="store_true",
+                        help="Ignore crystals of unchanged windows stored by previous runs")
+    parser.add_argument("--no-dedup", action="store_true",
+                        help="Send every segment to the model, even exact or near duplicates")
+    parser.add_argument("--plan", action="store_true",
+                        help="Dry run: print and save the segment/reduce plan with token and "
+                             "time estimates, without calling any provider")
+    parser.add_argument("--log-format", choices=LOG_FORMATS, default="text",
+                        help="Console log format: rich text or one JSON object per line")
+    parser.add_argument("--log-level", choices=list(LOG_LEVELS), default="debug",
+                        help="Minimum log level to emit; suppressed messages are never formatted")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Bypass the on-disk response cache")
     args = parser.parse_args()
+    configure_logging(args.log_format, args.log_level)
 
     try:
         Print("STARTING", "Initializing crystallizer")
-        crystallizer = Crystallizer(args.config_file_path, args.connection_name)
+        crystallizer = Crystallizer(args.config_file_path, args.connection_name,
+                                    use_cache=not args.no_cache, stream=args.stream,
+                                    batch_mode=args.batch_mode,
+                                    incremental=False if args.no_incremental else None,
+                                    reduce_connection=args.reduce_connection)
+        crystallizer.apply_overrides(
+            reduce_fan_in=args.reduce_fan_in, reduce_max_levels=args.reduce_max_levels,
+            chunker=args.chunker, segment_count=args.segment_count,
+            segment_overlap=args.segment_overlap, include=args.include, exclude=args.exclude,
+            extensions=args.extensions, dedup=False if args.no_dedup else None,
+        )
         Print("STATE", f"System prompt: {args.system_prompt}")
         Print("STATE", f"Connection: {crystallizer.connection_name} ({crystallizer.api_type})")
+        if crystallizer.reduce_connection_name != crystallizer.connection_name:
+            Print("STATE", f"Reduce connection: {crystallizer.reduce_connection_name} "
+                           f"({crystallizer.reduce_connection_config['api_type']})")
         Print("STATE", f"Task label: {args.task_label}")
+        if args.plan:
+            crystallizer.plan_haystack(args.haystack_path, args.system_prompt, args.task_label,
+                                       args.output_dir)
+            crystallizer.close()
+            return
         crystals = crystallizer.process_haystack(
             args.haystack_path,
             args.system_prompt,
             args.task_label,
-            args.output_dir
+            args.output_dir,
+            resume=args.resume,
         )
+        crystallizer.close()
         Print("SUCCESS", "Crystallization complete!")
         Print("INFO", f"Output directory: {args.output_dir}")
     except Exception as e:
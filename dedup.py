@@ -0,0 +1,154 @@
+"""Run-wide detection of exact and near-duplicate segments before the map phase."""
+import hashlib
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Value of a MinHash bin that received no shingle
+EMPTY_BIN = (1 << 64) - 1
+
+
+def shingle_hashes(text: str, shingle_words: int) -> List[int]:
+    """64-bit hashes of the distinct word k-shingles of text (case-folded)."""
+    words = text.lower().split()
+    if len(words) <= shingle_words:
+        shingles = {" ".join(words)} if words else set()
+    else:
+        shingles = {" ".join(words[i:i + shingle_words])
+                    for i in range(len(words) - shingle_words + 1)}
+    return [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big")
+            for s in shingles]
+
+
+def minhash(hashes: List[int], num_perm: int) -> Tuple[int, ...]:
+    """One-permutation MinHash: the smallest hash landing in each of num_perm bins.
+
+    Bins are picked by the low bits and compared on the rest, so the signature
+    costs one hash per shingle instead of num_perm.
+    """
+    signature = [EMPTY_BIN] * num_perm
+    for h in hashes:
+        idx = h % num_perm
+        value = h // num_perm
+        if value < signature[idx]:
+            signature[idx] = value
+    return tuple(signature)
+
+
+def similarity(a: Tuple[int, ...], b: Tuple[int, ...]) -> float:
+    """Estimated Jaccard similarity: the fraction of filled bins two signatures share."""
+    filled = sum(1 for x, y in zip(a, b) if x != EMPTY_BIN or y != EMPTY_BIN)
+    if not filled:
+        return 0.0
+    return sum(1 for x, y in zip(a, b) if x == y and x != EMPTY_BIN) / filled
+
+
+def band_rows(num_perm: int, threshold: float) -> int:
+    """Rows per LSH band whose S-curve midpoint (1/b)^(1/r) sits just below threshold."""
+    candidates = [r for r in range(1, num_perm + 1) if num_perm % r == 0]
+    target = threshold * 0.9
+    return min(candidates, key=lambda r: abs((r / num_perm) ** (1 / r) - target))
+
+
+def follow(source: Future, fallback: Callable[[], Future]) -> Future:
+    """A future that resolves like source, or like fallback() if source fails.
+
+    A cancelled source counts as failed; if the fallback is cancelled too, so is the target.
+    """
+    target: Future = Future()
+
+    def forward(done: Future, retry: bool) -> None:
+        if target.done():
+            # Cancelled by its consumer while the call was running
+            return
+        if not done.cancelled() and done.exception() is None:
+            target.set_result(done.result())
+        elif retry:
+            fallback().add_done_callback(lambda again: forward(again, False))
+        elif done.cancelled():
+            target.cancel()
+        else:
+            target.set_exception(done.exception())
+
+    source.add_done_callback(lambda done: forward(done, True))
+    return target
+
+
+class DuplicateIndex:
+    """MinHash/LSH index of every segment submitted in a run, across all files.
+
+    A segment whose map input is identical to an earlier one, or whose word
+    shingles are at least threshold similar to it, takes the earlier
+    segment's crystal instead of a model call. Candidates come from LSH
+    buckets and are confirmed on the full signature. Texts with fewer
+    shingles than min_shingles are only matched exactly, since their
+    signatures are too sparse to compare. threshold >= 1, the default,
+    matches exact duplicates only.
+    """
+
+    def __init__(self, threshold: float = 1.0, num_perm: int = 128, shingle_words: int = 5,
+                 min_shingles: int = 32):
+        self.threshold = threshold
+        self.num_perm = max(1, num_perm)
+        self.shingle_words = max(1, shingle_words)
+        self.min_shingles = min_shingles
+        self.rows = band_rows(self.num_perm, min(threshold, 1.0))
+        self.exact: Dict[str, Future] = {}
+        self.buckets: Dict[Tuple[int, Tuple[int, ...]], List[int]] = {}
+        self.entries: List[Tuple[Tuple[int, ...], Future]] = []
+        self.seen = 0
+        self.exact_hits = 0
+        self.near_hits = 0
+
+    @property
+    def near_enabled(self) -> bool:
+        return self.threshold < 1.0
+
+    def match(self, input_hash: str, text: str) -> Tuple[Optional[Future], Optional[Tuple[int, ...]]]:
+        """(future of an earlier duplicate or None, signature to pass to add)."""
+        self.seen += 1
+        earlier = self.exact.get(input_hash)
+        if earlier is not None:
+            self.exact_hits += 1
+            return earlier, None
+        if not self.near_enabled:
+            return None, None
+        hashes = shingle_hashes(text, self.shingle_words)
+        if len(hashes) < self.min_shingles:
+            return None, None
+        signature = minhash(hashes, self.num_perm)
+        checked = set()
+        for key in self.band_keys(signature):
+            for entry_idx in self.buckets.get(key, ()):
+                if entry_idx in checked:
+                    continue
+                checked.add(entry_idx)
+                earlier_signature, earlier = self.entries[entry_idx]
+                if similarity(signature, earlier_signature) >= self.threshold:
+                    self.near_hits += 1
+                    return earlier, None
+        return None, signature
+
+    def add(self, input_hash: str, signature: Optional[Tuple[int, ...]], future: Future) -> None:
+        """Make a segment's crystal available to later duplicates."""
+        self.exact.setdefault(input_hash, future)
+        if signature is None:
+            return
+        entry_idx = len(self.entries)
+        self.entries.append((signature, future))
+        for key in self.band_keys(signature):
+            self.buckets.setdefault(key, []).append(entry_idx)
+
+    def band_keys(self, signature: Tuple[int, ...]) -> List[Tuple[int, Tuple[int, ...]]]:
+        rows = self.rows
+        keys = []
+        for band in range(self.num_perm // rows):
+            values = signature[band * rows:(band + 1) * rows]
+            # A band of empty bins says nothing about similarity
+            if all(v == EMPTY_BIN for v in values):
+                continue
+            keys.append((band, values))
+        return keys
+
+    @property
+    def skipped(self) -> int:
+        return self.exact_hits + self.near_hits
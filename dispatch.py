@@ -0,0 +1,212 @@
+"""Bounded, retrying dispatch of LLM calls against a single inference connection."""
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Deque, Dict, Hashable, List, Optional, Tuple
+
+from backends.providers.base import Completion, ProviderHTTPError
+from telemetry import MetricsRecorder
+from utilities import Print
+
+MAX_BACKOFF_SECONDS = 60.0
+
+
+def throttle_info(error: Optional[BaseException]) -> Tuple[bool, Optional[float]]:
+    """(throttled, retry_after) from the first ProviderHTTPError in error's cause chain."""
+    while error is not None:
+        if isinstance(error, ProviderHTTPError):
+            return error.throttled, error.retry_after
+        error = error.__cause__
+    return False, None
+
+
+class FairScheduler:
+    """Worker threads shared by several dispatchers, serving their queues round-robin.
+
+    Each key (a job) gets its own FIFO queue; workers take one call from the
+    next key with pending work in turn, so a job with thousands of segments
+    queued cannot starve one that arrives later.
+    """
+
+    def __init__(self, max_workers: int, name: str):
+        self._queues: Dict[Hashable, Deque[Tuple[Future, Callable[..., Any], tuple]]] = {}
+        self._order: Deque[Hashable] = deque()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._threads: List[threading.Thread] = [
+            threading.Thread(target=self._work, name=f"crystallizer-{name}-{idx}", daemon=True)
+            for idx in range(max(1, max_workers))
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, key: Hashable, fn: Callable[..., Any], *args: Any) -> Future:
+        future: Future = Future()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("FairScheduler is shut down")
+            if key not in self._queues:
+                self._queues[key] = deque()
+                self._order.append(key)
+            self._queues[key].append((future, fn, args))
+            self._condition.notify()
+        return future
+
+    def pending(self) -> Dict[Hashable, int]:
+        """Queued (not yet running) calls per key."""
+        with self._condition:
+            return {key: len(queue) for key, queue in self._queues.items()}
+
+    def _next(self) -> Optional[Tuple[Future, Callable[..., Any], tuple]]:
+        with self._condition:
+            while not self._order and not self._closed:
+                self._condition.wait()
+            if not self._order:
+                return None
+            key = self._order.popleft()
+            queue = self._queues[key]
+            item = queue.popleft()
+            if queue:
+                self._order.append(key)
+            else:
+                del self._queues[key]
+            return item
+
+    def _work(self) -> None:
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            future, fn, args = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def shutdown(self) -> None:
+        """Finish queued calls, then stop the workers."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+
+class Dispatcher:
+    """Runs provider.generate calls on a thread pool capped at max_concurrency.
+
+    With a scheduler, calls go to that shared FairScheduler under job_id
+    instead, so several jobs split one connection's concurrency fairly.
+    """
+
+    def __init__(self, provider: Any, connection_name: str, connection_config: Dict[str, Any],
+                 metrics: Optional[MetricsRecorder] = None,
+                 scheduler: Optional[FairScheduler] = None, job_id: Hashable = None):
+        self.provider = provider
+        self.connection_name = connection_name
+        self.metrics = metrics
+        self.max_concurrency = max(1, int(connection_config.get("max_concurrency", 4)))
+        self.max_retries = max(0, int(connection_config.get("max_retries", 3)))
+        self.retry_backoff = float(connection_config.get("retry_backoff", 2.0))
+        # Throttled calls are retried on their own budget so 429 bursts do not lose segments
+        self.max_throttle_retries = max(0, int(connection_config.get("max_throttle_retries", 8)))
+        self.scheduler = scheduler
+        self.job_id = job_id if job_id is not None else id(self)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        if scheduler is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_concurrency,
+                thread_name_prefix=f"crystallizer-{connection_name}",
+            )
+
+    def submit(self, system_prompt: str, user_content: str, label: str,
+               stream_path: Optional[Path] = None, stage: str = "map") -> Future:
+        """Schedule a generate call; the future resolves to the response text."""
+        if self.scheduler is not None:
+            return self.scheduler.submit(self.job_id, self.generate, system_prompt, user_content,
+                                         label, stream_path, stage, time.monotonic())
+        if self._executor is None:
+            raise RuntimeError(f"Dispatcher for {self.connection_name} has no thread pool")
+        return self._executor.submit(self.generate, system_prompt, user_content, label,
+                                     stream_path, stage, time.monotonic())
+
+    def generate(self, system_prompt: str, user_content: str, label: str,
+                 stream_path: Optional[Path] = None, stage: str = "map",
+                 queued_at: Optional[float] = None) -> str:
+        """Call the provider, retrying with jittered exponential backoff on failure.
+
+        Throttled calls (429/529) wait as long as the server asked, if it said,
+        and are retried up to max_throttle_retries times before counting
+        against max_retries. When the provider streams and stream_path is given,
+        tokens are written to that file as they arrive; it is truncated at the
+        start of every attempt. One call record per generate (not per attempt)
+        goes to the metrics recorder.
+        """
+        started = time.monotonic()
+        queue_wait = started - queued_at if queued_at is not None else 0.0
+        failures = 0
+        throttles = 0
+        last_error: Exception = RuntimeError("no attempts made")
+        completion: Completion
+        while True:
+            attempt = failures + throttles + 1
+            try:
+                Print("ATTEMPT", f"LLM generation for {label} (attempt {attempt})")
+                if stream_path is None or not self.provider.stream:
+                    completion = self.provider.complete(system_prompt, user_content)
+                else:
+                    with open(stream_path, 'w', buffering=1) as sink:
+                        completion = self.provider.complete(system_prompt, user_content, sink.write)
+                self.record(label, stage, "ok", started, queue_wait, attempt - 1,
+                            prompt_tokens=completion.prompt_tokens,
+                            completion_tokens=completion.completion_tokens,
+                            time_to_first_token=completion.time_to_first_token,
+                            cached=completion.cached, endpoint=completion.endpoint,
+                            cached_prompt_tokens=completion.cached_prompt_tokens,
+                            throttled=throttles)
+                return completion.text
+            except Exception as e:
+                last_error = e
+                throttled, retry_after = throttle_info(e)
+                if throttled and throttles < self.max_throttle_retries:
+                    throttles += 1
+                    delay = retry_after if retry_after is not None else self.backoff_delay(throttles)
+                    Print("WARNING", f"{label} throttled; retrying in {delay:.1f}s")
+                elif failures < self.max_retries:
+                    failures += 1
+                    delay = max(retry_after or 0.0, self.backoff_delay(failures))
+                    Print("WARNING", f"{label} failed ({e}); retrying in {delay:.1f}s")
+                else:
+                    break
+                time.sleep(delay)
+        attempts = failures + throttles + 1
+        if stream_path is not None:
+            # The partial output of a call that gave up is never promoted to a crystal
+            stream_path.unlink(missing_ok=True)
+        self.record(label, stage, "failed", started, queue_wait, attempts - 1,
+                    error=str(last_error), throttled=throttles)
+        Print("FAILURE", f"Giving up on {label} after {attempts} attempts: {last_error}")
+        raise RuntimeError(f"{label} failed after {attempts} attempts: {last_error}") from last_error
+
+    def backoff_delay(self, retry: int) -> float:
+        """Exponential backoff with equal jitter, so concurrent retries spread out."""
+        delay = min(MAX_BACKOFF_SECONDS, self.retry_backoff * 2.0 ** (retry - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def record(self, label: str, stage: str, status: str, started: float,
+               queue_wait: float, retries: int, **fields: Any) -> None:
+        if self.metrics is None:
+            return
+        self.metrics.record_call(connection=self.connection_name, stage=stage, label=label,
+                                 status=status, wall_time=round(time.monotonic() - started, 4),
+                                 queue_wait=round(queue_wait, 4), retries=retries, **fields)
+
+    def shutdown(self) -> None:
+        """Stop this dispatcher's own thread pool; a shared scheduler keeps running."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
@@ -0,0 +1,92 @@
+"""Per-file crystal index that lets reruns reuse crystals of unchanged windows."""
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from utilities import Print
+
+INDEX_VERSION = 1
+
+
+class CrystalIndex:
+    """Crystal texts keyed by the hash of the inputs that produced them, one sidecar per file.
+
+    The sidecar <base>__<task>__windows.json sits next to the file's final
+    crystal. On a rerun every map segment, reduce node and final merge whose
+    input hash is in the previous sidecar is answered from it, so an unchanged
+    window costs nothing and an appended log only pays for its new tail and
+    the reduce branches above it. The sidecar is rewritten with just the units
+    the latest successful run used, so stale entries do not accumulate.
+    """
+
+    def __init__(self, output_dir: Path, task_label: str):
+        self.output_dir = output_dir
+        self.task_label = task_label
+        self.previous: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self.current: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self.reused: Dict[str, int] = {}
+        self.source_hashes: Dict[str, Optional[str]] = {}
+        self._lock = threading.Lock()
+
+    def path(self, base_name: str) -> Path:
+        return self.output_dir / f"{base_name}__{self.task_label}__windows.json"
+
+    def load(self, base_name: str, source_hash: Optional[str]) -> None:
+        """Start a file: read its previous sidecar, if any, and reset this run's entries."""
+        units: Dict[str, Dict[str, Any]] = {}
+        path = self.path(base_name)
+        if path.exists():
+            try:
+                with open(path, 'r') as f:
+                    data = json.load(f)
+                if data.get("version") == INDEX_VERSION:
+                    units = data.get("units", {})
+            except (OSError, ValueError) as e:
+                Print("WARNING", f"Ignoring unreadable crystal index {path}: {e}")
+        with self._lock:
+            self.previous[base_name] = units
+            self.current[base_name] = {}
+            self.reused[base_name] = 0
+            self.source_hashes[base_name] = source_hash
+
+    def set_source_hash(self, base_name: str, source_hash: str) -> None:
+        """Hash of a file that was only known once it had been read as a stream."""
+        with self._lock:
+            self.source_hashes[base_name] = source_hash
+
+    def lookup(self, base_name: str, input_hash: str) -> Optional[str]:
+        with self._lock:
+            unit = self.previous.get(base_name, {}).get(input_hash)
+            if unit is None:
+                return None
+            self.reused[base_name] = self.reused.get(base_name, 0) + 1
+            return str(unit["output"])
+
+    def add(self, base_name: str, unit_id: str, input_hash: str, text: str) -> None:
+        with self._lock:
+            self.current.setdefault(base_name, {})[input_hash] = {"unit": unit_id, "output": text}
+
+    def save(self, base_name: str) -> None:
+        """Atomically replace the file's sidecar with this run's units."""
+        with self._lock:
+            units = self.current.pop(base_name, {})
+            self.previous.pop(base_name, None)
+            reused = self.reused.pop(base_name, 0)
+            source_hash = self.source_hashes.pop(base_name, None)
+        path = self.path(base_name)
+        tmp_path = path.with_suffix(".json.tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump({"version": INDEX_VERSION, "source_hash": source_hash, "units": units}, f)
+        os.replace(tmp_path, path)
+        if reused:
+            Print("STATE", f"Incremental: reused {reused} of {len(units)} crystal(s) of {base_name}")
+
+    def discard(self, base_name: str) -> None:
+        """Forget this run's units; the previous sidecar stays as it was."""
+        with self._lock:
+            self.current.pop(base_name, None)
+            self.previous.pop(base_name, None)
+            self.reused.pop(base_name, None)
+            self.source_hashes.pop(base_name, None)
@@ -0,0 +1,70 @@
+"""Bounded-memory reading of large text files."""
+import hashlib
+import os
+from pathlib import Path
+from typing import Iterable, Iterator, Optional, Tuple
+
+DEFAULT_BLOCK_CHARS = 1 << 20
+
+
+def clean_cut(text: str) -> int:
+    """Offset just after the last newline that is followed by non-whitespace, or 0.
+
+    Cutting there never splits a token: tiktoken's pre-tokenizer keeps
+    newlines apart from the word that follows them.
+    """
+    idx = len(text) - 1
+    while True:
+        idx = text.rfind("\n", 0, idx)
+        if idx < 0:
+            return 0
+        if not text[idx + 1].isspace():
+            return idx + 1
+
+
+def read_text_blocks(path: Path, block_chars: int = DEFAULT_BLOCK_CHARS) -> Iterator[str]:
+    """Decoded text of path in blocks of roughly block_chars characters, each ending at a line start.
+
+    A single line longer than a block is carried over until its end, so memory
+    grows with the longest line rather than the file.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        carry = ""
+        while True:
+            chunk = f.read(block_chars)
+            if not chunk:
+                if carry:
+                    yield carry
+                return
+            text = carry + chunk
+            cut = clean_cut(text)
+            if cut == 0:
+                carry = text
+                continue
+            yield text[:cut]
+            carry = text[cut:]
+
+
+class StreamHash:
+    """manifest.content_hash of a file's text, computed from the blocks it is read in as they
+    stream past.
+
+    value is None until the last block has been consumed.
+    """
+
+    def __init__(self) -> None:
+        self._digest = hashlib.sha256()
+        self.value: Optional[str] = None
+
+    def blocks(self, blocks: Iterable[str]) -> Iterator[str]:
+        for block in blocks:
+            self._digest.update(block.encode("utf-8"))
+            yield block
+        self._digest.update(b"\0")
+        self.value = self._digest.hexdigest()
+
+
+def file_fingerprint(path: Path) -> Tuple[int, int]:
+    """(size, mtime in ns): a cheap check that a file is unchanged since it was processed."""
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
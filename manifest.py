@@ -0,0 +1,183 @@
+"""Run manifest: per-file record of map/reduce units so interrupted runs can resume."""
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Sequence, Set
+
+from utilities import Print
+
+MANIFEST_VERSION = 1
+SAVE_INTERVAL_SECONDS = 1.0
+
+
+def content_hash(*parts: str) -> str:
+    """sha256 over the given strings, separated so ("ab", "c") != ("a", "bc")."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def read_text_file(path: str) -> Optional[str]:
+    try:
+        with open(path, 'r') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+class RunManifest:
+    """JSON manifest in the output dir keyed by file base name, then unit id.
+
+    Unit ids are "map:NNN" for segments, "reduce:L<level>-NNN" for reduce
+    nodes and "final" for the final merge. Each unit records its status, output
+    file, output hash and the hash of the inputs that produced it. Submitted
+    batch jobs are kept under "batches", keyed by the hash of their input file.
+    """
+
+    def __init__(self, output_dir: Path, task_label: str, resume: bool = False,
+                 read_output: Optional[Callable[[str], Optional[str]]] = None):
+        self.path = output_dir / f"{task_label}__manifest.json"
+        self.resume = resume
+        # Reads a recorded unit output back; crystals may live outside plain files
+        self.read_output = read_output or read_text_file
+        self._lock = threading.Lock()
+        self._last_save = 0.0
+        # Unit ids recorded or reused per file in this run
+        self._touched: Dict[str, Set[str]] = {}
+        self.data: Dict[str, Any] = {"version": MANIFEST_VERSION, "task_label": task_label, "files": {}}
+        if resume and self.path.exists():
+            with open(self.path, 'r') as f:
+                loaded = json.load(f)
+            if loaded.get("version") == MANIFEST_VERSION:
+                self.data = loaded
+                Print("STATE", f"Resuming from manifest {self.path} "
+                               f"({len(self.data['files'])} files recorded)")
+            else:
+                Print("WARNING", f"Ignoring manifest with unsupported version: {self.path}")
+
+    def begin_file(self, base_name: str, source: str, source_hash: Optional[str] = None,
+                   fingerprint: Optional[Sequence[int]] = None) -> None:
+        """Register a file; recorded units are discarded if its content changed.
+
+        A file read as a stream has no source_hash until it has been read
+        through; its units are kept (each is checked against its own input
+        hash) until set_source_hash tells whether the content changed.
+        """
+        with self._lock:
+            entry = self.data["files"].get(base_name)
+            if entry is None or (source_hash is not None
+                                 and entry.get("source_hash") != source_hash):
+                if entry is not None:
+                    Print("INFO", f"{source} changed since last run; reprocessing from scratch")
+                entry = {"source": source, "source_hash": source_hash, "units": {}}
+                self.data["files"][base_name] = entry
+            entry["status"] = "running"
+            entry["fingerprint"] = list(fingerprint) if fingerprint is not None else None
+            self._touched[base_name] = set()
+        self.save()
+
+    def set_source_hash(self, base_name: str, source_hash: str) -> None:
+        """Record the hash of a streamed file once read through, dropping stale units if it changed."""
+        with self._lock:
+            entry = self.data["files"][base_name]
+            previous = entry.get("source_hash")
+            entry["source_hash"] = source_hash
+            if previous is None or previous == source_hash:
+                return
+            touched = self._touched.get(base_name, set())
+            stale = [unit_id for unit_id in entry["units"] if unit_id not in touched]
+            for unit_id in stale:
+                del entry["units"][unit_id]
+        Print("INFO", f"{entry['source']} changed since last run; dropped {len(stale)} "
+                      f"stale unit(s)")
+
+    def finished_output(self, base_name: str, source_hash: Optional[str] = None,
+                        fingerprint: Optional[Sequence[int]] = None) -> Optional[str]:
+        """Final crystal path if this exact source was fully processed before.
+
+        Without a source_hash, an unchanged size and mtime (fingerprint) stand in for it.
+        """
+        with self._lock:
+            entry = self.data["files"].get(base_name)
+            if not entry or entry.get("status") != "done":
+                return None
+            if source_hash is not None:
+                if entry.get("source_hash") != source_hash:
+                    return None
+            elif fingerprint is None or entry.get("fingerprint") != list(fingerprint):
+                return None
+            final_unit = entry["units"].get("final", {})
+        if self.completed_output(base_name, "final", final_unit.get("input_hash", "")) is None:
+            return None
+        return str(final_unit["output"])
+
+    def finish_file(self, base_name: str, status: str) -> None:
+        with self._lock:
+            self.data["files"][base_name]["status"] = status
+        self.save(force=True)
+
+    def completed_output(self, base_name: str, unit_id: str, input_hash: str) -> Optional[str]:
+        """Return a finished unit's output text if it can be reused, else None."""
+        if not self.resume:
+            return None
+        with self._lock:
+            unit = self.data["files"].get(base_name, {}).get("units", {}).get(unit_id)
+        if not unit or unit.get("status") != "done" or unit.get("input_hash") != input_hash:
+            return None
+        text = self.read_output(unit["output"])
+        if text is None:
+            return None
+        if content_hash(text) != unit.get("output_hash"):
+            return None
+        with self._lock:
+            self._touched.setdefault(base_name, set()).add(unit_id)
+        return text
+
+    def record(self, base_name: str, unit_id: str, status: str, input_hash: str,
+               output_path: Optional[str] = None, output_text: Optional[str] = None,
+               **info: Any) -> None:
+        """Record a unit's status; output hash is taken from output_text when given."""
+        unit: Dict[str, Any] = {"status": status, "input_hash": input_hash, **info}
+        if output_path is not None:
+            unit["output"] = output_path
+        if output_text is not None:
+            unit["output_hash"] = content_hash(output_text)
+        with self._lock:
+            self.data["files"][base_name]["units"][unit_id] = unit
+            self._touched.setdefault(base_name, set()).add(unit_id)
+        self.save(force=status != "done")
+
+    def batch_id(self, input_hash: str) -> Optional[str]:
+        """Id of a batch submitted for this exact input that may still be collected, if resuming."""
+        if not self.resume:
+            return None
+        with self._lock:
+            batch = self.data.get("batches", {}).get(input_hash)
+        if not batch or batch.get("status") == "failed":
+            return None
+        return str(batch["id"])
+
+    def record_batch(self, input_hash: str, batch_id: str, input_path: str,
+                     status: str = "submitted") -> None:
+        with self._lock:
+            self.data.setdefault("batches", {})[input_hash] = {
+                "id": batch_id, "input": input_path, "status": status,
+            }
+        self.save(force=True)
+
+    def save(self, force: bool = False) -> None:
+        """Atomically rewrite the manifest, at most once per SAVE_INTERVAL_SECONDS unless forced."""
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._last_save < SAVE_INTERVAL_SECONDS:
+                return
+            self._last_save = now
+            tmp_path = self.path.with_suffix(".json.tmp")
+            with open(tmp_path, 'w') as f:
+                json.dump(self.data, f, indent=2)
+            os.replace(tmp_path, self.path)
@@ -0,0 +1,363 @@
+"""Directory pipeline: one-pass discovery, pooled planning and a global largest-first map queue."""
+import fnmatch
+import multiprocessing
+import os
+import time
+from collections import Counter
+from contextlib import nullcontext
+from concurrent.futures import (FIRST_COMPLETED, Executor, Future, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
+from pathlib import Path
+from typing import Any, ContextManager, Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+import tiktoken
+
+from manifest import content_hash
+from segmentation import Segment, get_chunker
+from utilities import Print
+
+DEFAULT_EXTENSIONS = (".txt", ".md")
+
+
+def matches(relative_path: str, patterns: Sequence[str]) -> bool:
+    """True if an fnmatch pattern matches the relative path or its last component."""
+    name = relative_path.rsplit("/", 1)[-1]
+    return any(fnmatch.fnmatch(relative_path, pattern) or fnmatch.fnmatch(name, pattern)
+               for pattern in patterns)
+
+
+def discover_files(root: Path, extensions: Sequence[str] = DEFAULT_EXTENSIONS,
+                   include: Sequence[str] = (), exclude: Sequence[str] = ()) -> List[Path]:
+    """Files under root with one of extensions, found in a single walk and sorted by path.
+
+    Patterns are matched against the path relative to root ('/'-separated) and
+    against the file or directory name. Excluded directories are not entered;
+    with include patterns, a file must match at least one of them.
+    """
+    suffixes = tuple(ext.lower() if ext.startswith(".") else f".{ext.lower()}"
+                     for ext in extensions)
+    found = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        relative_dir = Path(dirpath).relative_to(root)
+        dirnames[:] = [d for d in dirnames if not matches((relative_dir / d).as_posix(), exclude)]
+        for name in filenames:
+            relative = (relative_dir / name).as_posix()
+            if suffixes and not name.lower().endswith(suffixes):
+                continue
+            if include and not matches(relative, include):
+                continue
+            if matches(relative, exclude):
+                continue
+            path = Path(dirpath) / name
+            if path.is_file():
+                found.append(path)
+    return sorted(found)
+
+
+def file_keys(files: Sequence[Path], root: Path) -> Dict[Path, str]:
+    """A distinct base name for each file: its path relative to root, without the extension.
+
+    '%' and '/' are escaped as %25 and %2F, so a file directly under root is
+    keyed by its stem and same-named files in different directories stay
+    apart. Files that differ only in their extension keep it.
+    """
+    stems = {path: path.relative_to(root).with_suffix("") for path in files}
+    counts = Counter(stems.values())
+    return {path: (path.relative_to(root) if counts[stem] > 1 else stem).as_posix()
+            .replace("%", "%25").replace("/", "%2F") for path, stem in stems.items()}
+
+
+class PlanOptions(NamedTuple):
+    """Everything a planning worker needs to cut a file the way the crystallizer would."""
+    encoding_name: str
+    chunker_name: str
+    chunker_options: Tuple[Tuple[str, Any], ...]
+    window_tokens: int
+
+
+class PlannedFile(NamedTuple):
+    file_path: Path
+    source_hash: Optional[str]  # None if the file is not UTF-8 text
+    segments: List[Segment]
+    token_count: int
+    seconds: float
+
+
+_planning_tools: Dict[PlanOptions, Tuple[Any, Any]] = {}
+
+
+def planning_settings(processing_config: Dict[str, Any]) -> Tuple[int, int]:
+    """(planning_workers, largest file in bytes that is planned in the pool)."""
+    workers = processing_config.get("planning_workers")
+    workers = max(1, int(workers if workers else min(os.cpu_count() or 1, 8)))
+    return workers, int(float(processing_config.get("pool_max_file_mb", 16)) * 1024 * 1024)
+
+
+def planning_executor(workers: int, file_count: int,
+                      shared: Optional[Executor] = None) -> ContextManager[Executor]:
+    """Process pool for plan_file, or a single thread when a pool would not pay off.
+
+    A shared long-lived pool is used as is and left running.
+    """
+    if shared is not None and file_count > 1:
+        return nullcontext(shared)
+    # Workers are spawned, not forked: the caller already runs dispatcher and log threads
+    if workers > 1 and file_count > 1:
+        return ProcessPoolExecutor(max_workers=min(workers, file_count),
+                                   mp_context=multiprocessing.get_context("spawn"))
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="crystallizer-plan")
+
+
+def plan_file(file_path: Path, options: PlanOptions, keep_text: bool = True) -> PlannedFile:
+    """Read, hash, tokenize and plan one file; runs in a worker process.
+
+    keep_text=False blanks segment texts when only their sizes are needed.
+    """
+    started = time.monotonic()
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            content = f.read()
+    except UnicodeDecodeError:
+        return PlannedFile(file_path, None, [], 0, time.monotonic() - started)
+    if options not in _planning_tools:
+        _planning_tools[options] = (tiktoken.get_encoding(options.encoding_name),
+                                    get_chunker(options.chunker_name,
+                                                **dict(options.chunker_options)))
+    encoding, chunker = _planning_tools[options]
+    tokens = encoding.encode(content)
+    segments = chunker.plan(tokens, encoding, options.window_tokens)
+    if not keep_text:
+        segments = [segment._replace(text="") for segment in segments]
+    return PlannedFile(file_path, content_hash(content), segments, len(tokens),
+                       time.monotonic() - started)
+
+
+class FileRun:
+    """Scheduling state of one file: its segment source and map results so far."""
+
+    def __init__(self, job: Any, size: int, order: int):
+        self.job = job
+        self.size = size
+        self.order = order
+        self.segments: Iterator[Segment] = iter(job.segments)
+        self.exhausted = False
+        self.outstanding = 0
+        self.crystals: Dict[int, str] = {}
+        self.failed: List[int] = []
+        self.reused = 0
+        self.error: Optional[Exception] = None
+        # Reduce tree fed as crystals complete, when reduce is pipelined with the map phase
+        self.tree: Optional[Any] = None
+
+    @property
+    def done(self) -> bool:
+        return self.exhausted and self.outstanding == 0
+
+
+class DirectoryPipeline:
+    """Runs the map phase of many files through one inference queue.
+
+    Files up to pool_max_file_mb are read, tokenized and planned in a process
+    pool while earlier files are already being mapped, at most
+    planning_workers of them ahead of the map queue so planned segment texts
+    do not pile up in memory; larger files use the crystallizer's streaming
+    path in this process. Segments are fed to the
+    dispatcher from the largest pending file first, keeping at most twice
+    max_concurrency calls queued, so long files start early and the queue
+    never drains between files. With pipeline_reduce, each file's reduce tree
+    submits merges of consecutive crystals while its map phase is still
+    running; the rest of the reduce runs on a worker thread as soon as the
+    file's last segment completes.
+    """
+
+    def __init__(self, crystallizer: Any, processing_config: Dict[str, Any]):
+        self.crystallizer = crystallizer
+        self.planning_workers, self.pool_max_bytes = planning_settings(processing_config)
+        self.limit = max(2, 2 * crystallizer.dispatcher.max_concurrency)
+        self.context: Tuple[str, str, Path] = ("", "", Path("."))
+        self.sizes: Dict[Path, int] = {}
+        self.order: Dict[Path, int] = {}
+        self.streamed: List[Path] = []
+        self.unplanned: List[Path] = []
+        self.planning: Dict[Future, Path] = {}
+        self.planner: Optional[Executor] = None
+        self.options: Optional[PlanOptions] = None
+        self.reducer: Optional[Executor] = None
+        self.active: List[FileRun] = []
+        self.in_flight: Dict[Future, Tuple[FileRun, Any]] = {}
+        self.reducing: Dict[Future, FileRun] = {}
+        self.finals: Dict[int, str] = {}
+        self.failed_files: List[Path] = []
+        # Start of the current span in which some file is reducing after its map phase
+        self.reduce_started = 0.0
+
+    def run(self, files: List[Path], system_prompt: str, task_label: str,
+            output_dir: Path) -> Tuple[List[str], List[Path]]:
+        """Process files; returns final crystals in file order and the files that failed."""
+        c = self.crystallizer
+        self.context = (system_prompt, task_label, output_dir)
+        self.sizes = {path: path.stat().st_size for path in files}
+        self.order = {path: idx for idx, path in enumerate(files)}
+        largest_first = sorted(files, key=lambda path: (-self.sizes[path], self.order[path]))
+        self.unplanned = [path for path in largest_first if self.sizes[path] <= self.pool_max_bytes]
+        self.streamed = [path for path in largest_first if self.sizes[path] > self.pool_max_bytes]
+        self.options = c.plan_options()
+        Print("STATE", f"Planning {len(self.unplanned)} file(s) with {self.planning_workers} "
+                       f"worker(s), streaming {len(self.streamed)} large file(s)")
+        reduce_workers = max(1, c.reduce_dispatcher.max_concurrency)
+        with planning_executor(self.planning_workers, len(self.unplanned),
+                               c.planning_pool) as planner, \
+                ThreadPoolExecutor(max_workers=reduce_workers,
+                                   thread_name_prefix="crystallizer-reduce") as reducer:
+            self.planner = planner
+            self.reducer = reducer
+            # The map stage ends with the last map call; reduces still running are timed
+            # apart, as the spans in which any file is reducing
+            map_started: Optional[float] = time.monotonic()
+            while True:
+                self.plan_ahead()
+                self.fill()
+                if (map_started is not None and not self.in_flight and not self.planning
+                        and not self.unplanned and not self.active and not self.streamed):
+                    c.metrics.add_stage_time("map", time.monotonic() - map_started)
+                    map_started = None
+                waitables = set(self.in_flight) | set(self.planning) | set(self.reducing)
+                if not waitables:
+                    break
+                done, _ = wait(waitables, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in self.planning:
+                        self.on_planned(self.planning.pop(future), future)
+                    elif future in self.in_flight:
+                        self.on_segment(future)
+                    else:
+                        self.on_reduced(future)
+        return [self.finals[idx] for idx in sorted(self.finals)], self.failed_files
+
+    def plan_ahead(self) -> None:
+        """Submit pooled files for planning while fewer than planning_workers are being
+        planned or hold planned segments that are not all submitted yet."""
+        if self.planner is None or self.options is None:
+            return
+        # Streamed files are read lazily, so only pooled ones hold their text
+        waiting = sum(not run.exhausted and run.size <= self.pool_max_bytes
+                      for run in self.active)
+        while self.unplanned and len(self.planning) + waiting < self.planning_workers:
+            file_path = self.unplanned.pop(0)
+            self.planning[self.planner.submit(plan_file, file_path, self.options)] = file_path
+
+    def add(self, job: Any, file_path: Path) -> None:
+        idx = self.order[file_path]
+        if job is None:
+            return
+        if job.finished:
+            self.finals[idx] = job.finished
+            return
+        run = FileRun(job, self.sizes[file_path], idx)
+        if self.crystallizer.pipeline_reduce:
+            system_prompt, task_label, output_dir = self.context
+            run.tree = self.crystallizer.reduce_tree(job.base_name, task_label, output_dir)
+        self.active.append(run)
+        self.active.sort(key=lambda r: (-r.size, r.order))
+
+    def fill(self) -> None:
+        """Submit segments, largest pending file first, until the queue is full."""
+        c = self.crystallizer
+        system_prompt, task_label, output_dir = self.context
+        while len(self.in_flight) < self.limit:
+            run = next((r for r in self.active if not r.exhausted), None)
+            if run is None:
+                if not self.streamed:
+                    return
+                file_path = self.streamed.pop(0)
+                self.add(c.prepare_file(file_path), file_path)
+                continue
+            try:
+                segment = next(run.segments, None)
+            except Exception as e:
+                run.error = e
+                segment = None
+            if segment is None:
+                run.exhausted = True
+                if run.done:
+                    self.finish(run)
+                continue
+            item = c.submit_segment(segment, system_prompt, run.job.base_name, task_label,
+                                    output_dir)
+            if run.tree is not None:
+                run.tree.expect(segment.ordinal)
+            run.outstanding += 1
+            run.reused += item.reused
+            self.in_flight[item.future] = (run, item._replace(segment=segment._replace(text="")))
+
+    def on_planned(self, file_path: Path, future: Future) -> None:
+        c = self.crystallizer
+        try:
+            planned = future.result()
+        except Exception as e:
+            Print("FAILURE", f"Failed to plan {file_path}: {e}")
+            self.failed_files.append(file_path)
+            return
+        c.metrics.add_stage_time("tokenize", planned.seconds)
+        self.add(c.job_from_plan(planned), file_path)
+
+    def on_segment(self, future: Future) -> None:
+        system_prompt, task_label, output_dir = self.context
+        run, item = self.in_flight.pop(future)
+        run.outstanding -= 1
+        crystal_path = self.crystallizer.finish_segment(item, run.job.base_name, task_label,
+                                                        output_dir)
+        if crystal_path is None:
+            run.failed.append(item.segment.ordinal)
+        else:
+            run.crystals[item.segment.ordinal] = crystal_path
+            if run.tree is not None:
+                run.tree.add(item.segment.ordinal, future.result())
+        if run.done:
+            self.finish(run)
+
+    def finish(self, run: FileRun) -> None:
+        """Hand a fully mapped file to a reduce worker, or record why it failed."""
+        c = self.crystallizer
+        system_prompt, task_label, output_dir = self.context
+        self.active.remove(run)
+        if isinstance(run.error, UnicodeDecodeError):
+            if run.tree is not None:
+                run.tree.cancel()
+            c.skip_binary(run.job)
+            return
+        try:
+            if run.error is not None:
+                raise run.error
+            crystals = c.ordered_crystals(run.job.base_name, run.crystals, run.failed, run.reused)
+        except Exception as e:
+            if run.tree is not None:
+                run.tree.cancel()
+            if c.manifest is not None:
+                c.manifest.finish_file(run.job.base_name, "failed")
+            Print("FAILURE", f"Failed to process {run.job.file_path}: {e}")
+            self.failed_files.append(run.job.file_path)
+            return
+        if self.reducer is None:
+            raise RuntimeError("DirectoryPipeline.finish called outside run")
+        if not self.reducing:
+            self.reduce_started = time.monotonic()
+        future = self.reducer.submit(c.reduce_file, run.job, crystals, system_prompt,
+                                     task_label, output_dir, run.tree)
+        self.reducing[future] = run
+
+    def on_reduced(self, future: Future) -> None:
+        run = self.reducing.pop(future)
+        if not self.reducing:
+            self.crystallizer.metrics.add_stage_time("reduce",
+                                                     time.monotonic() - self.reduce_started)
+        try:
+            result = future.result()
+        except Exception as e:
+            Print("FAILURE", f"Failed to process {run.job.file_path}: {e}")
+            self.failed_files.append(run.job.file_path)
+            return
+        if result:
+            self.finals[run.order] = result
+        Print("PROGRESS", f"Finished {run.job.file_path.name} "
+                          f"({len(self.finals)} final crystal(s) so far)")
@@ -0,0 +1,312 @@
+"""Dry-run planning: segment and reduce-tree shapes, token totals and time estimates."""
+import json
+import math
+from pathlib import Path
+from typing import Any, Dict, List
+
+from ingest import StreamHash
+from pipeline import PlannedFile, plan_file, planning_executor, planning_settings
+from utilities import Print
+
+# Throughput assumed for connections without recorded metrics
+DEFAULT_PREFILL_TOKENS_PER_SEC = 2000.0
+DEFAULT_DECODE_TOKENS_PER_SEC = 40.0
+
+
+def load_history(metrics_path: Path) -> Dict[str, Dict[str, Any]]:
+    """Per "connection/stage" rows of the summary in a previous run's metrics file, if any."""
+    if not metrics_path.exists():
+        return {}
+    try:
+        with open(metrics_path, 'r') as f:
+            lines = f.read().splitlines()
+        summary = json.loads(lines[-1]) if lines else {}
+    except (OSError, ValueError) as e:
+        Print("WARNING", f"Ignoring unreadable metrics {metrics_path}: {e}")
+        return {}
+    return summary.get("connections", {}) if summary.get("type") == "summary" else {}
+
+
+class HaystackPlanner:
+    """Works out what a run would do without calling any provider.
+
+    Files are tokenized and cut exactly as a real run would cut them. Map
+    crystals are assumed to be as long as the previous run's mean completion
+    for this connection, or default_max_tokens without history. The reduce
+    tree is then simulated with the crystallizer's own grouping. Totals are
+    an upper bound: the response cache, --resume and incremental reuse are
+    ignored.
+    """
+
+    def __init__(self, crystallizer: Any):
+        self.crystallizer = crystallizer
+        processing = crystallizer.processing_config
+        self.prefill_rate = float(processing.get("plan_prefill_tokens_per_sec",
+                                                 DEFAULT_PREFILL_TOKENS_PER_SEC))
+        self.decode_rate = float(processing.get("plan_decode_tokens_per_sec",
+                                                DEFAULT_DECODE_TOKENS_PER_SEC))
+
+    def run(self, haystack: Path, system_prompt: str, task_label: str,
+            output_dir: Path) -> Dict[str, Any]:
+        c = self.crystallizer
+        if haystack.is_file():
+            files = [haystack]
+        elif haystack.is_dir():
+            files = c.discover_files(haystack)
+        else:
+            raise ValueError(f"Haystack path not found: {haystack}")
+        history = load_history(output_dir / f"{task_label}__metrics.jsonl")
+        map_output = self.expected_output("map", history)
+        reduce_output = self.expected_output("reduce", history)
+        system_tokens = c.token_counter.count_tokens(system_prompt)
+
+        planned = self.plan_files(files)
+        file_plans = [self.plan_one(p, system_tokens, map_output, reduce_output)
+                      for p in planned if p.source_hash is not None]
+        skipped = [str(p.file_path) for p in planned if p.source_hash is None]
+        totals = {
+            "files": len(file_plans),
+            "tokens": sum(f["tokens"] for f in file_plans),
+            "map_calls": sum(f["map_calls"] for f in file_plans),
+            "reduce_calls": sum(f["reduce_calls"] for f in file_plans),
+            "input_tokens": sum(f["input_tokens"] for f in file_plans),
+            "output_tokens": sum(f["output_tokens"] for f in file_plans),
+            "max_reduce_depth": max((f["reduce_depth"] for f in file_plans), default=0),
+        }
+        estimates = self.estimate_connections(file_plans, totals, history)
+        plan = {
+            "haystack": str(haystack),
+            "task_label": task_label,
+            "connection": c.connection_name,
+            "context_length": c.context_length,
+            "reduce_connection": c.reduce_connection_name,
+            "reduce_context_length": c.reduce_context_length,
+            "window_tokens": c.window_tokens(),
+            "segment_count": c.segment_count,
+            "chunker": c.chunker_name,
+            "system_prompt_tokens": system_tokens,
+            "assumed_output_tokens": {"map": map_output, "reduce": reduce_output},
+            "totals": totals,
+            "connections": estimates,
+            # Map phase on the map connection, reduce phase on the reduce connection
+            "estimated_seconds": round(estimates[c.connection_name]["map_seconds"]
+                                       + estimates[c.reduce_connection_name]["reduce_seconds"], 1),
+            "files": file_plans,
+            "skipped": skipped,
+            "warnings": [w for f in file_plans for w in f["warnings"]],
+        }
+        return plan
+
+    def expected_output(self, stage: str, history: Dict[str, Dict[str, Any]]) -> int:
+        """Mean completion tokens per call of stage on its connection in the last run."""
+        c = self.crystallizer
+        if stage == "reduce":
+            name, config = c.reduce_connection_name, c.reduce_connection_config
+        else:
+            name, config = c.connection_name, c.connection_config
+        row = history.get(f"{name}/{stage}")
+        if row:
+            succeeded = row["calls"] - row["failed"]
+            if succeeded > 0 and row.get("completion_tokens"):
+                return max(1, int(round(row["completion_tokens"] / succeeded)))
+        return int(config.get("default_max_tokens", 1024))
+
+    def plan_files(self, files: List[Path]) -> List[PlannedFile]:
+        """Tokenize and cut every file as a run would, keeping only segment sizes."""
+        c = self.crystallizer
+        workers, pool_max_bytes = planning_settings(c.processing_config)
+        pooled = [path for path in files if path.stat().st_size <= pool_max_bytes]
+        streamed = [path for path in files if path.stat().st_size > pool_max_bytes]
+        options = c.plan_options()
+        results: Dict[Path, PlannedFile] = {}
+        with planning_executor(workers, len(pooled), c.planning_pool) as executor:
+            futures = {path: executor.submit(plan_file, path, options, False) for path in pooled}
+            for path in streamed:
+                results[path] = self.plan_streamed(path)
+            for path, future in futures.items():
+                results[path] = future.result()
+        return [results[path] for path in files]
+
+    def plan_streamed(self, file_path: Path) -> PlannedFile:
+        c = self.crystallizer
+        source = StreamHash()
+        try:
+            segments = [s._replace(text="") for s in c.iter_segments(file_path, source)]
+        except UnicodeDecodeError:
+            return PlannedFile(file_path, None, [], 0, 0.0)
+        tokens = max((s.end for s in segments), default=0)
+        return PlannedFile(file_path, source.value, segments, tokens, 0.0)
+
+    def plan_one(self, planned: PlannedFile, system_tokens: int, map_output: int,
+                 reduce_output: int) -> Dict[str, Any]:
+        c = self.crystallizer
+        max_output = int(c.connection_config.get("default_max_tokens", 1024))
+        windows: List[List[int]] = []
+        for segment in planned.segments:
+            while len(windows) <= segment.window_idx:
+                windows.append([])
+            windows[segment.window_idx].append(segment.token_count)
+        segment_tokens = [tokens for window in windows for tokens in window]
+        warnings = []
+        largest = max(segment_tokens, default=0)
+        if system_tokens + largest + max_output > c.context_length:
+            warnings.append(f"{planned.file_path.name}: map call of {system_tokens + largest:,} "
+                            f"prompt tokens + {max_output} output exceeds the "
+                            f"{c.context_length:,}-token context")
+        reduce = self.simulate_reduce([map_output] * len(segment_tokens), reduce_output,
+                                      planned.file_path.name, warnings)
+        return {
+            "file": str(planned.file_path),
+            "tokens": planned.token_count,
+            "windows": len(windows),
+            "segment_tokens": windows,
+            "map_calls": len(segment_tokens),
+            "reduce_calls": reduce["calls"],
+            "reduce_depth": len(reduce["levels"]) + (1 if reduce["final"] else 0),
+            "reduce": reduce,
+            "input_tokens": (len(segment_tokens) * system_tokens + sum(segment_tokens)
+                             + reduce["input_tokens"]),
+            "output_tokens": len(segment_tokens) * map_output + reduce["calls"] * reduce_output,
+            "warnings": warnings,
+        }
+
+    def simulate_reduce(self, crystal_tokens: List[int], reduce_output: int, name: str,
+                        warnings: List[str]) -> Dict[str, Any]:
+        """Replay merge_crystals' level-by-level grouping on estimated crystal sizes."""
+        c = self.crystallizer
+        budget = c.reduce_token_budget()
+        max_output = int(c.reduce_connection_config.get("default_max_tokens", 1024))
+        levels = []
+        calls = 0
+        input_tokens = 0
+        if not crystal_tokens:
+            return {"levels": [], "final": None, "calls": 0, "input_tokens": 0}
+        counts = list(crystal_tokens)
+        level = 1
+        while True:
+            groups = c.plan_reduce_groups(counts, budget)
+            if len(groups) > 1 and level >= c.reduce_max_levels:
+                warnings.append(f"{name}: reduce_max_levels={c.reduce_max_levels} forces "
+                                f"{len(counts)} crystals into one merge")
+                groups = [list(range(len(counts)))]
+            if len(groups) == 1:
+                break
+            sizes = [c.merge_input_tokens([counts[i] for i in group]) for group in groups]
+            merged = [len(group) > 1 for group in groups]
+            prompts = [c.token_counter.count_tokens(c.build_merge_prompt(len(group)))
+                       for group in groups]
+            levels.append({"level": level, "groups": [len(group) for group in groups],
+                           "input_tokens": sizes})
+            calls += sum(merged)
+            input_tokens += sum(size + prompt for size, prompt, m in zip(sizes, prompts, merged)
+                                if m)
+            counts = [reduce_output if m else counts[group[0]]
+                      for group, m in zip(groups, merged)]
+            level += 1
+        final_input = (c.merge_input_tokens(counts)
+                       + c.token_counter.count_tokens(c.build_merge_prompt(len(counts))))
+        if final_input + max_output > c.reduce_context_length:
+            warnings.append(f"{name}: final merge of {final_input:,} prompt tokens + "
+                            f"{max_output} output exceeds the {c.reduce_context_length:,}-token "
+                            f"context")
+        return {"levels": levels, "final": {"crystals": len(counts), "input_tokens": final_input},
+                "calls": calls + 1, "input_tokens": input_tokens + final_input}
+
+    def connection_limits(self) -> Dict[str, Dict[str, Any]]:
+        """Concurrency, rate limits and context of every configured connection and group."""
+        config = self.crystallizer.config
+        connections = config.get("inference_service_connections", {})
+        limits = {
+            name: {"max_concurrency": int(conn.get("max_concurrency", 4)),
+                   "requests_per_minute": conn.get("requests_per_minute"),
+                   "tokens_per_minute": conn.get("tokens_per_minute"),
+                   "context_length": conn.get("default_ctx_len", 16000)}
+            for name, conn in connections.items()
+        }
+        for name, group in config.get("connection_groups", {}).items():
+            members = [m if isinstance(m, dict) else {"connection": m}
+                       for m in group.get("members", [])]
+            members = [m for m in members if m.get("connection") in limits]
+            if not members:
+                continue
+            limits[name] = {
+                "max_concurrency": sum(int(m.get("max_concurrency",
+                                                 limits[m["connection"]]["max_concurrency"]))
+                                       for m in members),
+                "requests_per_minute": None,
+                "tokens_per_minute": None,
+                "context_length": min(limits[m["connection"]]["context_length"] for m in members),
+            }
+        return limits
+
+    def estimate_connections(self, file_plans: List[Dict[str, Any]], totals: Dict[str, Any],
+                             history: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        """Rough wall-clock time of each phase of this plan on each connection.
+
+        Per-call latency is the last run's p50 for that connection and stage
+        when recorded, else prompt/prefill plus output/decode throughput.
+        Calls run max_concurrency at a time; the reduce phase is at least as
+        long as its deepest tree. RPM/TPM budgets set a floor.
+        """
+        c = self.crystallizer
+        reduce_input = sum(f["reduce"]["input_tokens"] for f in file_plans)
+        reduce_output = totals["reduce_calls"] * self.expected_output("reduce", history)
+        stages = {
+            "map": (totals["map_calls"], totals["input_tokens"] - reduce_input,
+                    totals["output_tokens"] - reduce_output),
+            "reduce": (totals["reduce_calls"], reduce_input, reduce_output),
+        }
+        estimates = {}
+        for name, limits in self.connection_limits().items():
+            concurrency = max(1, limits["max_concurrency"])
+            estimate: Dict[str, Any] = {"max_concurrency": concurrency, "latency_basis": {}}
+            for stage, (calls, prompt, output) in stages.items():
+                row = history.get(f"{name}/{stage}")
+                if row and row.get("p50_latency"):
+                    latency = row["p50_latency"]
+                    estimate["latency_basis"][stage] = "metrics"
+                else:
+                    latency = ((prompt / calls if calls else 0) / self.prefill_rate
+                               + (output / calls if calls else 0) / self.decode_rate)
+                    estimate["latency_basis"][stage] = "default throughput"
+                rounds = math.ceil(calls / concurrency)
+                if stage == "reduce":
+                    rounds = max(rounds, totals["max_reduce_depth"])
+                seconds = rounds * latency
+                if limits["requests_per_minute"]:
+                    seconds = max(seconds, calls / limits["requests_per_minute"] * 60)
+                if limits["tokens_per_minute"]:
+                    seconds = max(seconds, (prompt + output) / limits["tokens_per_minute"] * 60)
+                estimate[f"{stage}_call_seconds"] = round(latency, 2)
+                estimate[f"{stage}_seconds"] = round(seconds, 1)
+            estimate["estimated_seconds"] = round(estimate["map_seconds"]
+                                                  + estimate["reduce_seconds"], 1)
+            estimate["fits_map_context"] = limits["context_length"] >= c.context_length
+            estimate["fits_reduce_context"] = limits["context_length"] >= c.reduce_context_length
+            estimates[name] = estimate
+        return estimates
+
+    @staticmethod
+    def log_plan(plan: Dict[str, Any]) -> None:
+        totals = plan["totals"]
+        Print("STATE", f"Plan for {plan['haystack']} on {plan['connection']}: "
+                       f"{totals['files']} file(s), {totals['tokens']:,} tokens, "
+                       f"window {plan['window_tokens']:,} tokens")
+        Print("STATE", f"{totals['map_calls']:,} map + {totals['reduce_calls']:,} reduce calls, "
+                       f"~{totals['input_tokens']:,} input / ~{totals['output_tokens']:,} output "
+                       f"tokens, reduce depth up to {totals['max_reduce_depth']}")
+        for f in plan["files"]:
+            levels = " -> ".join(str(len(level["groups"])) for level in f["reduce"]["levels"])
+            Print("INFO", f"{Path(f['file']).name}: {f['tokens']:,} tokens, {f['windows']} "
+                          f"window(s), {f['map_calls']} segments, reduce "
+                          f"{levels + ' -> ' if levels else ''}1")
+        for name, estimate in plan["connections"].items():
+            fits = "" if estimate["fits_map_context"] else " (context smaller than planned windows)"
+            basis = "/".join(sorted(set(estimate["latency_basis"].values())))
+            Print("STATE", f"{name}: ~{estimate['estimated_seconds']:,.0f}s at concurrency "
+                           f"{estimate['max_concurrency']} ({basis}){fits}")
+        if plan["reduce_connection"] != plan["connection"]:
+            Print("STATE", f"Map on {plan['connection']}, reduce on {plan['reduce_connection']}: "
+                           f"~{plan['estimated_seconds']:,.0f}s")
+        for warning in plan["warnings"]:
+            Print("WARNING", warning)
@@ -0,0 +1,292 @@
+"""Dataflow tree reduce: merge groups of crystals while the crystals below are still arriving."""
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from pathlib import Path
+from typing import Any, Dict, Hashable, List, Optional, Tuple, Union
+
+from manifest import content_hash
+from utilities import Print
+
+CRYSTAL_SEPARATOR = "\n\n--- CRYSTAL SEGMENT ---\n\n"
+
+
+class GroupCutter:
+    """Greedy grouping of consecutive crystals, fed one token count at a time.
+
+    A group is closed once the next crystal would overflow the budget or the
+    fan-in, provided it holds at least two crystals, so each level is
+    guaranteed to shrink even if that overflows the budget. Closed groups
+    never change, which is what lets them be merged before the rest arrive.
+    """
+
+    def __init__(self, budget: int, fan_in: int, separator_tokens: int):
+        self.budget = budget
+        self.fan_in = fan_in
+        self.separator_tokens = separator_tokens
+        self.count = 0
+        self.current: List[int] = []
+        self.current_tokens = 0
+
+    def add(self, tokens: int) -> Optional[List[int]]:
+        """Take the next crystal's token count; returns the group it closed, if any."""
+        idx = self.count
+        self.count += 1
+        added = tokens + (self.separator_tokens if self.current else 0)
+        fits = self.current_tokens + added <= self.budget and len(self.current) < self.fan_in
+        closed = None
+        if self.current and not fits and len(self.current) >= 2:
+            closed, self.current, self.current_tokens, added = self.current, [], 0, tokens
+        self.current.append(idx)
+        self.current_tokens += added
+        return closed
+
+    def close(self) -> Optional[List[int]]:
+        """The trailing group once no more crystals will come (it may hold just one)."""
+        closed, self.current, self.current_tokens = self.current or None, [], 0
+        return closed
+
+
+class TreeLevel:
+    """Inputs, in chronological order, and merge groups of one reduce level."""
+
+    def __init__(self, level: int, cutter: Optional[GroupCutter]):
+        self.level = level
+        # None on the last level reduce_max_levels allows: its inputs all go to the final merge
+        self.cutter = cutter
+        self.inputs: List[str] = []
+        self.token_counts: List[int] = []
+        # (unit id, input hash or None if nothing is to be recorded, future or finished text)
+        self.groups: List[Tuple[str, Optional[str], Union[Future, str]]] = []
+        self.forwarded = 0
+        self.ended = False
+
+    def waiting(self) -> List[Future]:
+        return [item for _, _, item in self.groups[self.forwarded:] if isinstance(item, Future)]
+
+
+class ReduceTree:
+    """Multi-level tree reduce of one file's crystals, run as a dataflow.
+
+    Crystals are announced in chronological order with expect() as their map
+    calls are submitted, and handed over with add() as they complete, in any
+    order. As soon as the next consecutive crystals form a closed group (see
+    GroupCutter), that group's merge call is submitted, and merged results
+    feed the level above the same way. The grouping is exactly that of
+    Crystallizer.plan_reduce_groups over the finished level, so reduce units,
+    their input hashes and the final crystal are the same as when every level
+    waits for the one below; only the map tail and the reduce phase overlap.
+    finish() is called once every expected crystal was added: it waits for
+    the remaining merges, then submits the final merge and waits for it.
+
+    The tree is driven by one thread at a time and never blocks in add().
+    """
+
+    def __init__(self, crystallizer: Any, base_name: str, task_label: str, output_dir: Path):
+        c = crystallizer
+        self.crystallizer = crystallizer
+        self.base_name = base_name
+        self.task_label = task_label
+        self.output_dir = output_dir
+        self.budget = c.reduce_token_budget()
+        self.separator_tokens = c.token_counter.count_tokens(CRYSTAL_SEPARATOR)
+        self.positions: Dict[Hashable, int] = {}
+        self.arrived: Dict[int, str] = {}
+        self.fed = 0
+        self.levels: List[TreeLevel] = [self.new_level(1)]
+        self.top: Optional[TreeLevel] = None
+        self.level_files: List[str] = []
+        self.error: Optional[Exception] = None
+
+    def new_level(self, level: int) -> TreeLevel:
+        c = self.crystallizer
+        cutter = None
+        if level < c.reduce_max_levels:
+            cutter = GroupCutter(self.budget, c.reduce_fan_in, self.separator_tokens)
+        return TreeLevel(level, cutter)
+
+    def expect(self, key: Hashable) -> None:
+        """Announce the next crystal in chronological order."""
+        self.positions[key] = len(self.positions)
+
+    def add(self, key: Hashable, text: str) -> None:
+        """Hand over an announced crystal and start whatever merges it completes."""
+        self.arrived[self.positions[key]] = text
+        self.pump()
+
+    def append(self, text: str) -> None:
+        key = len(self.positions)
+        self.expect(key)
+        self.add(key, text)
+
+    def pump(self) -> None:
+        """Feed arrived crystals and finished merges upwards, without blocking.
+
+        A failure is kept in self.error and raised by finish(), so the map
+        phase driving add() is not interrupted.
+        """
+        if self.error is not None:
+            return
+        try:
+            first = self.levels[0]
+            while self.fed in self.arrived:
+                self.feed(first, self.arrived.pop(self.fed))
+                self.fed += 1
+            progress = True
+            while progress:
+                progress = False
+                for idx in range(len(self.levels)):
+                    progress = self.forward(idx) or progress
+        except Exception as e:
+            self.error = e
+
+    def feed(self, level: TreeLevel, text: str) -> None:
+        count = self.crystallizer.token_counter.count_tokens(text)
+        level.inputs.append(text)
+        level.token_counts.append(count)
+        if level.cutter is not None:
+            group = level.cutter.add(count)
+            if group is not None:
+                self.merge(level, group)
+
+    def merge(self, level: TreeLevel, group: List[int]) -> None:
+        """Submit one group's merge call, unless it is a lone crystal or reusable."""
+        c = self.crystallizer
+        group_idx = len(level.groups)
+        unit_id = f"reduce:L{level.level}-{group_idx:03d}"
+        if len(group) == 1:
+            level.groups.append((unit_id, None, level.inputs[group[0]]))
+            return
+        contents = [level.inputs[i] for i in group]
+        merge_prompt = c.build_merge_prompt(len(contents))
+        combined_content = CRYSTAL_SEPARATOR.join(contents)
+        input_hash = content_hash(c.reduce_identity, merge_prompt, combined_content)
+        reused = c.reusable_output(self.base_name, unit_id, input_hash)
+        if reused is not None:
+            level.groups.append((unit_id, None, reused))
+            return
+        if not group_idx and not level.ended:
+            Print("STARTING", f"Reduce level {level.level}: merging groups as crystals arrive "
+                              f"(budget {self.budget:,} tokens)")
+        store = c.store(self.output_dir)
+        level_path = Path(store.reference(self.base_name, self.task_label, group_idx, level.level))
+        level.groups.append((unit_id, input_hash, c.reduce_dispatcher.submit(
+            merge_prompt, combined_content, f"reduce level {level.level} group {group_idx + 1}",
+            c.stream_path(level_path), stage="reduce",
+        )))
+
+    def forward(self, idx: int) -> bool:
+        """Store finished merges of levels[idx] in order and feed them to the level above."""
+        c = self.crystallizer
+        level = self.levels[idx]
+        progress = False
+        while level.forwarded < len(level.groups):
+            unit_id, input_hash, item = level.groups[level.forwarded]
+            if isinstance(item, str):
+                result = item
+            elif not item.done():
+                break
+            else:
+                try:
+                    result = item.result()
+                except Exception as e:
+                    c.record_unit(self.base_name, unit_id, "failed", input_hash,
+                                  level=level.level, error=str(e))
+                    raise
+            level_path = c.write_crystal(self.output_dir, self.base_name, self.task_label,
+                                         result, level.forwarded, level.level,
+                                         input_hash=input_hash)
+            self.level_files.append(level_path)
+            if input_hash is not None:
+                c.record_unit(self.base_name, unit_id, "done", input_hash, level_path, result,
+                              level=level.level)
+            if idx + 1 == len(self.levels):
+                self.levels.append(self.new_level(level.level + 1))
+            self.feed(self.levels[idx + 1], result)
+            level.forwarded += 1
+            progress = True
+        upper = self.levels[idx + 1] if idx + 1 < len(self.levels) else None
+        if (level.ended and upper is not None and not upper.ended
+                and level.forwarded == len(level.groups)):
+            self.end(upper)
+            progress = True
+        return progress
+
+    def end(self, level: TreeLevel) -> None:
+        """No more inputs will reach this level: merge its trailing group, or make it the top."""
+        level.ended = True
+        if level.cutter is None or not level.groups:
+            self.top = level
+            c = self.crystallizer
+            if level.cutter is None and len(c.plan_reduce_groups(level.token_counts,
+                                                                 self.budget)) > 1:
+                Print("WARNING", f"Reached reduce_max_levels={c.reduce_max_levels}; "
+                                 f"forcing {len(level.inputs)} crystals into one merge "
+                                 f"({sum(level.token_counts):,} tokens, budget {self.budget:,})")
+            return
+        trailing = level.cutter.close()
+        if trailing:
+            self.merge(level, trailing)
+        Print("STATE", f"Reduce level {level.level}: {len(level.inputs)} crystals "
+                       f"-> {len(level.groups)} groups (budget {self.budget:,} tokens)")
+
+    def finish(self) -> Optional[str]:
+        """Wait for the remaining merges and run the final one; returns the final crystal path.
+
+        Returns None if no crystal was expected; raises if a merge failed.
+        """
+        if not self.positions:
+            return None
+        self.pump()
+        if self.error is None and self.fed < len(self.positions):
+            self.error = RuntimeError(f"{len(self.positions) - self.fed} crystal(s) of "
+                                      f"{self.base_name} never arrived")
+        if self.error is None:
+            self.end(self.levels[0])
+        while True:
+            self.pump()
+            if self.error is not None:
+                raise self.error
+            top = self.top
+            if top is not None:
+                break
+            waiting = [future for level in self.levels for future in level.waiting()]
+            if not waiting:
+                raise RuntimeError(f"Reduce tree of {self.base_name} stalled")
+            wait(waiting, return_when=FIRST_COMPLETED)
+        Print("COMPLETED", f"Reduce levels done: {len(top.inputs)} crystals left "
+                           f"for the final merge")
+        return self.final_merge(top.inputs)
+
+    def final_merge(self, crystal_contents: List[str]) -> str:
+        c = self.crystallizer
+        merge_prompt = c.build_merge_prompt(len(crystal_contents))
+        combined_content = CRYSTAL_SEPARATOR.join(crystal_contents)
+        input_hash = content_hash(c.reduce_identity, merge_prompt, combined_content)
+        final_path: str = c.store(self.output_dir).reference(self.base_name, self.task_label)
+        final_filename = Path(final_path).name
+        final_result = c.reusable_output(self.base_name, "final", input_hash)
+        if final_result is not None:
+            Print("STATE", f"Final merge inputs unchanged; reusing {final_filename}")
+            c.write_crystal(self.output_dir, self.base_name, self.task_label, final_result,
+                            input_hash=input_hash)
+            return final_path
+        try:
+            Print("ATTEMPT", f"LLM merge of {len(crystal_contents)} segments")
+            # Through the queue like every other call, so the scheduler sees it
+            final_result = c.reduce_dispatcher.submit(
+                merge_prompt, combined_content, "final merge",
+                c.stream_path(Path(final_path)), stage="reduce",
+            ).result()
+        except Exception as e:
+            c.record_unit(self.base_name, "final", "failed", input_hash, error=str(e))
+            raise
+        c.write_crystal(self.output_dir, self.base_name, self.task_label, final_result,
+                        input_hash=input_hash)
+        c.record_unit(self.base_name, "final", "done", input_hash, final_path, final_result)
+        Print("COMPLETED", f"Final crystal merge: {final_filename}")
+        return final_path
+
+    def cancel(self) -> None:
+        """Drop merge calls that have not started yet."""
+        for level in self.levels:
+            for future in level.waiting():
+                future.cancel()
@@ -0,0 +1,320 @@
+"""Token-offset planning of windows and segments.
+
+A document is tokenized once; windows and the segments inside them are cut
+directly on token offsets, so every segment's size is known exactly without
+re-encoding its text. Chunkers are registered by name so the CLI can pick one
+per task: "fixed" cuts at exact offsets, "structure" snaps each cut to the
+strongest nearby heading, chat turn, paragraph or line boundary.
+"""
+import bisect
+import re
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Type, TypeVar
+
+Span = Tuple[int, int]
+ChunkerCls = TypeVar("ChunkerCls", bound=type)
+
+CHUNKER_REGISTRY: Dict[str, Type[Any]] = {}
+
+# Boundary strengths: a cut prefers the strongest boundary within reach
+LINE = 1
+PARAGRAPH = 2
+CHAT_TURN = 3
+HEADING = 3
+
+HEADING_PATTERN = re.compile(r"#{1,6}\s")
+DEFAULT_CHAT_TURN_PATTERN = (
+    r"\s*(?:\*\*|__)?(?:user|assistant|human|ai|system|you|me|chatgpt|claude|gpt-?[\w.]*)"
+    r"(?:\*\*|__)?\s*(?::|>)"
+    r"|\s*\[?\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}"
+)
+
+
+class Segment(NamedTuple):
+    ordinal: int
+    window_idx: int
+    seg_idx: int
+    start: int
+    end: int
+    text: str
+
+    @property
+    def token_count(self) -> int:
+        return self.end - self.start
+
+
+def window_spans(total_tokens: int, window_tokens: int, overlap: int = 0) -> List[Span]:
+    """Token spans of consecutive windows, each starting `overlap` tokens before the last ended."""
+    if total_tokens <= window_tokens:
+        return [(0, total_tokens)]
+    step = max(1, window_tokens - overlap)
+    spans = []
+    start = 0
+    while True:
+        end = min(start + window_tokens, total_tokens)
+        spans.append((start, end))
+        if end >= total_tokens:
+            return spans
+        start += step
+
+
+def segment_spans(start: int, end: int, segment_count: int, overlap: int = 0) -> List[Span]:
+    """Split [start, end) into segment_count near-equal spans; later spans reach back `overlap` tokens."""
+    length = end - start
+    bounds = [start + (length * i) // segment_count for i in range(segment_count + 1)]
+    return [
+        (max(start, bounds[i] - overlap) if i else bounds[i], bounds[i + 1])
+        for i in range(segment_count)
+    ]
+
+
+def plan_segments(tokens: List[int], decode: Callable[[List[int]], str],
+                  window_tokens: int, window_overlap: int = 100,
+                  segment_count: int = 3, segment_overlap: int = 0) -> List[Segment]:
+    """Cut a tokenized document into windows and segments, skipping blank segments.
+
+    Ordinals are window_idx * segment_count + seg_idx, so they stay stable
+    regardless of which segments are skipped.
+    """
+    segments = []
+    for window_idx, (window_start, window_end) in enumerate(
+            window_spans(len(tokens), window_tokens, window_overlap)):
+        spans = segment_spans(window_start, window_end, segment_count, segment_overlap)
+        for seg_idx, (start, end) in enumerate(spans):
+            text = decode(tokens[start:end])
+            if not text.strip():
+                continue
+            segments.append(Segment(window_idx * segment_count + seg_idx,
+                                    window_idx, seg_idx, start, end, text))
+    return segments
+
+
+def stream_segments(token_blocks: Iterable[List[int]], chunker: Any, encoding: Any,
+                    window_tokens: int) -> Iterator[Segment]:
+    """Plan windows as token blocks arrive, holding about one window plus one block of tokens.
+
+    Each window is planned by chunker.plan_window once more than window_tokens
+    tokens are buffered (or the input is exhausted), so segments of window 0 are
+    yielded while later blocks are still being read.
+    """
+    blocks = iter(token_blocks)
+    buffer: List[int] = []
+    offset = 0
+    window_idx = 0
+    exhausted = False
+    while True:
+        while not exhausted and len(buffer) <= window_tokens:
+            block = next(blocks, None)
+            if block is None:
+                exhausted = True
+            else:
+                buffer.extend(block)
+        if not buffer:
+            return
+        segments, next_start = chunker.plan_window(buffer, encoding, window_tokens)
+        for segment in segments:
+            yield segment._replace(ordinal=window_idx * chunker.segment_count + segment.seg_idx,
+                                   window_idx=window_idx, start=segment.start + offset,
+                                   end=segment.end + offset)
+        if next_start >= len(buffer):
+            return
+        del buffer[:next_start]
+        offset += next_start
+        window_idx += 1
+
+
+def register_chunker(name: str) -> Callable[[ChunkerCls], ChunkerCls]:
+    """Decorator to register a chunker class under a CLI-selectable name."""
+    def decorator(cls: ChunkerCls) -> ChunkerCls:
+        if name in CHUNKER_REGISTRY:
+            raise ValueError(f"Chunker '{name}' already registered")
+        CHUNKER_REGISTRY[name] = cls
+        return cls
+
+    return decorator
+
+
+def get_chunker(name: str, **settings: Any) -> Any:
+    """Instantiate the chunker registered under name."""
+    try:
+        chunker_class = CHUNKER_REGISTRY[name]
+    except KeyError as exc:
+        raise ValueError(f"Chunker '{name}' not registered") from exc
+    return chunker_class(**settings)
+
+
+class BoundaryIndex:
+    """Sorted token offsets where a cut falls on a structural boundary, with strengths."""
+
+    def __init__(self, offsets: List[int], strengths: List[int]):
+        self.offsets = offsets
+        self.strengths = strengths
+
+    @classmethod
+    def build(cls, tokens: List[int], encoding: Any,
+              chat_turn_pattern: str = DEFAULT_CHAT_TURN_PATTERN) -> "BoundaryIndex":
+        """Single pass over the document's lines, mapping each line start to a token offset."""
+        text, token_starts = encoding.decode_with_offsets(tokens)
+        chat_turn = re.compile(chat_turn_pattern, re.IGNORECASE)
+        offsets: List[int] = []
+        strengths: List[int] = []
+        token_idx = 0
+        previous_blank = False
+        line_start = 0
+        for line in text.splitlines(keepends=True):
+            stripped = line.strip()
+            if line_start > 0 and stripped:
+                # Token containing the line's first character; a token that merges
+                # the preceding newline with this line still counts as its start
+                while (token_idx + 1 < len(token_starts)
+                       and token_starts[token_idx + 1] <= line_start):
+                    token_idx += 1
+                cut = token_idx
+                if text[token_starts[cut]:line_start].strip():
+                    cut += 1
+                if cut >= len(token_starts):
+                    break
+                if HEADING_PATTERN.match(line):
+                    strength = HEADING
+                elif chat_turn.match(line):
+                    strength = CHAT_TURN
+                elif previous_blank:
+                    strength = PARAGRAPH
+                else:
+                    strength = LINE
+                if offsets and offsets[-1] == cut:
+                    strengths[-1] = max(strengths[-1], strength)
+                else:
+                    offsets.append(cut)
+                    strengths.append(strength)
+            previous_blank = not stripped
+            line_start += len(line)
+        return cls(offsets, strengths)
+
+    def snap(self, target: int, lower: int, upper: Optional[int] = None) -> int:
+        """Strongest boundary in (lower, upper], nearest target on ties; target if none.
+
+        upper defaults to target, i.e. cuts only move backwards.
+        """
+        upper = target if upper is None else upper
+        lo = bisect.bisect_right(self.offsets, lower)
+        hi = bisect.bisect_right(self.offsets, upper)
+        best = target
+        best_key = (0, 0)
+        for i in range(lo, hi):
+            key = (self.strengths[i], -abs(self.offsets[i] - target))
+            if key > best_key:
+                best, best_key = self.offsets[i], key
+        return best
+
+
+@register_chunker("fixed")
+class FixedChunker:
+    """Cuts windows and segments at exact token offsets."""
+
+    default_window_overlap = 100
+
+    def __init__(self, segment_count: int = 3, segment_overlap: int = 0,
+                 window_overlap: Optional[int] = None, **settings: Any):
+        self.segment_count = segment_count
+        self.segment_overlap = segment_overlap
+        self.window_overlap = (self.default_window_overlap
+                               if window_overlap is None else window_overlap)
+
+    def plan(self, tokens: List[int], encoding: Any, window_tokens: int) -> List[Segment]:
+        return plan_segments(tokens, encoding.decode, window_tokens,
+                             window_overlap=self.window_overlap,
+                             segment_count=self.segment_count,
+                             segment_overlap=self.segment_overlap)
+
+    def plan_window(self, tokens: List[int], encoding: Any,
+                    window_tokens: int) -> Tuple[List[Segment], int]:
+        """Segments of the first window of tokens, and the offset where the next window starts.
+
+        The next start is len(tokens) when this window reaches the end, i.e. when
+        len(tokens) <= window_tokens; a caller that has not seen the whole
+        document must pass more than window_tokens tokens.
+        """
+        end = min(window_tokens, len(tokens))
+        segments = plan_segments(tokens[:end], encoding.decode, max(1, end),
+                                 segment_count=self.segment_count,
+                                 segment_overlap=self.segment_overlap)
+        if end >= len(tokens):
+            return segments, len(tokens)
+        return segments, max(1, window_tokens - self.window_overlap)
+
+
+@register_chunker("structure")
+class StructuralChunker(FixedChunker):
+    """Snaps cuts to the strongest boundary within snap_ratio of the target offset.
+
+    Window cuts only move backwards so windows stay within budget; segment cuts
+    may move either way inside their window.
+
+    Boundaries make overlap unnecessary, so windows do not overlap by default.
+    """
+
+    default_window_overlap = 0
+
+    def __init__(self, snap_ratio: float = 0.25,
+                 chat_turn_pattern: str = DEFAULT_CHAT_TURN_PATTERN, **settings: Any):
+        super().__init__(**settings)
+        self.snap_ratio = snap_ratio
+        self.chat_turn_pattern = chat_turn_pattern
+
+    def cut(self, index: BoundaryIndex, start: int, target: int, end: Optional[int] = None) -> int:
+        """Snap target to a boundary after start; may move forward up to end (exclusive)."""
+        reach = int((target - start) * self.snap_ratio)
+        upper = None if end is None else min(end - 1, target + reach)
+        return index.snap(target, max(start, target - reach), upper)
+
+    def plan(self, tokens: List[int], encoding: Any, window_tokens: int) -> List[Segment]:
+        index = BoundaryIndex.build(tokens, encoding, self.chat_turn_pattern)
+        total = len(tokens)
+        windows: List[Span] = []
+        start = 0
+        while True:
+            if start + window_tokens >= total:
+                windows.append((start, total))
+                break
+            end = self.cut(index, start, start + window_tokens)
+            windows.append((start, end))
+            start = max(start + 1, end - self.window_overlap)
+
+        segments = []
+        for window_idx, (window_start, window_end) in enumerate(windows):
+            segments.extend(self.window_segments(index, tokens, encoding, window_idx,
+                                                 window_start, window_end))
+        return segments
+
+    def plan_window(self, tokens: List[int], encoding: Any,
+                    window_tokens: int) -> Tuple[List[Segment], int]:
+        total = len(tokens)
+        # Every cut for this window lies at or before window_tokens
+        tokens = tokens[:window_tokens + 1]
+        index = BoundaryIndex.build(tokens, encoding, self.chat_turn_pattern)
+        if window_tokens >= total:
+            return self.window_segments(index, tokens, encoding, 0, 0, total), total
+        end = self.cut(index, 0, window_tokens)
+        return (self.window_segments(index, tokens, encoding, 0, 0, end),
+                max(1, end - self.window_overlap))
+
+    def window_segments(self, index: BoundaryIndex, tokens: List[int], encoding: Any,
+                        window_idx: int, window_start: int, window_end: int) -> List[Segment]:
+        """Split one window at boundary-snapped cuts, skipping blank segments."""
+        spans = segment_spans(window_start, window_end, self.segment_count)
+        cuts = [window_start]
+        for _, span_end in spans[:-1]:
+            cuts.append(self.cut(index, cuts[-1], span_end, window_end))
+        cuts.append(window_end)
+        segments = []
+        for seg_idx in range(self.segment_count):
+            seg_start = cuts[seg_idx]
+            if seg_idx:
+                seg_start = max(window_start, seg_start - self.segment_overlap)
+            seg_end = cuts[seg_idx + 1]
+            text = encoding.decode(tokens[seg_start:seg_end])
+            if not text.strip():
+                continue
+            segments.append(Segment(window_idx * self.segment_count + seg_idx,
+                                    window_idx, seg_idx, seg_start, seg_end, text))
+        return segments
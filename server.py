@@ -0,0 +1,420 @@
+"""Long-running crystallizer service: a local HTTP job API over warm connections.
+
+Start with ``python server.py --port 8765`` (or ``--socket PATH`` for a Unix
+socket) and submit jobs with ``POST /jobs``::
+
+    {"haystack_path": "logs/", "system_prompt": "prompts/summary.j2",
+     "task_label": "summary", "connection": "ollama-local",
+     "reduce_connection": "vllm-local",
+     "output_dir": "./crystals", "resume": false, "options": {"chunker": "structure"}}
+
+``GET /jobs`` lists jobs, ``GET /jobs/<id>`` returns one job's status, final
+crystals and metrics summary (live while it runs), ``DELETE /jobs/<id>``
+cancels a queued job and ``GET /health`` reports the warm connections.
+"""
+import argparse
+import functools
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import socketserver
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from crystallizer import Crystallizer
+from dispatch import FairScheduler
+from pipeline import planning_settings
+from utilities import LOG_FORMATS, LOG_LEVELS, Print, configure_logging
+
+JOB_STATUSES = ("queued", "running", "done", "failed", "cancelled")
+# Keys of a job's "options" object, passed to Crystallizer.apply_overrides, and their JSON types
+JOB_OPTIONS: Dict[str, str] = {
+    "reduce_fan_in": "integer", "reduce_max_levels": "integer", "chunker": "string",
+    "segment_count": "integer", "segment_overlap": "integer", "include": "list of strings",
+    "exclude": "list of strings", "extensions": "string", "dedup": "boolean",
+}
+# Optional job fields besides "options", with their JSON types
+JOB_FIELDS: Dict[str, str] = {
+    "haystack_path": "string", "system_prompt": "string", "connection": "string",
+    "reduce_connection": "string", "task_label": "string", "output_dir": "string",
+    "resume": "boolean",
+}
+
+
+def json_type_matches(value: Any, expected: str) -> bool:
+    """Whether a decoded JSON value has the type named in JOB_OPTIONS or JOB_FIELDS."""
+    if expected == "integer":
+        return isinstance(value, int) and not isinstance(value, bool)
+    if expected == "boolean":
+        return isinstance(value, bool)
+    if expected == "string":
+        return isinstance(value, str)
+    return isinstance(value, list) and all(isinstance(item, str) for item in value)
+
+
+class WarmConnection(NamedTuple):
+    """A connection's long-lived crystallizer and the scheduler its jobs share."""
+    crystallizer: Crystallizer
+    scheduler: FairScheduler
+
+
+class Job:
+    """One submitted haystack run and everything the API reports about it."""
+
+    def __init__(self, job_id: str, spec: Dict[str, Any]):
+        self.id = job_id
+        self.spec = spec
+        self.status = "queued"
+        self.submitted = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.final_crystals: List[str] = []
+        self.error: Optional[str] = None
+        self.crystallizer: Optional[Crystallizer] = None
+        self.summary: Optional[Dict[str, Any]] = None
+
+    def describe(self, detail: bool = True) -> Dict[str, Any]:
+        now = time.time()
+        info: Dict[str, Any] = {
+            "id": self.id,
+            "status": self.status,
+            "connection": self.spec["connection"],
+            "reduce_connection": self.spec.get("reduce_connection"),
+            "haystack_path": self.spec["haystack_path"],
+            "task_label": self.spec["task_label"],
+            "submitted": self.submitted,
+            "queue_seconds": round((self.started or now) - self.submitted, 3),
+            "run_seconds": (round((self.finished or now) - self.started, 3)
+                            if self.started is not None else None),
+        }
+        if not detail:
+            return info
+        info["final_crystals"] = self.final_crystals
+        info["error"] = self.error
+        summary = self.summary
+        if summary is None and self.crystallizer is not None:
+            summary = self.crystallizer.metrics.summary()
+        info["metrics"] = summary
+        return info
+
+
+class CrystallizerService:
+    """Runs jobs on warm crystallizers, at most max_jobs at a time.
+
+    The config, tokenizer, provider sessions, response cache and compiled
+    templates are built once per connection, on first use or at startup.
+    Every job gets a cheap per-job copy with its own metrics and run state.
+    Jobs on the same connection share one FairScheduler sized to the
+    connection's max_concurrency, which serves their calls round-robin.
+    Concurrent jobs therefore split the endpoint instead of each opening its
+    full concurrency against it.
+    """
+
+    def __init__(self, config_path: str, max_jobs: int = 4, use_cache: bool = True,
+                 stream: bool = False):
+        self.config_path = config_path
+        self.use_cache = use_cache
+        self.stream = stream
+        self.connections: Dict[str, WarmConnection] = {}
+        self.jobs: Dict[str, Job] = {}
+        self.queue: "queue.Queue[Optional[Job]]" = queue.Queue()
+        self.planning_pool: Optional[Executor] = None
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        # Held while a connection is built, so jobs for other connections are not held up
+        self._building: Dict[str, threading.Lock] = {}
+        self._runners = [threading.Thread(target=self._run_jobs, name=f"crystallizer-job-{idx}",
+                                          daemon=True)
+                         for idx in range(max(1, max_jobs))]
+        for runner in self._runners:
+            runner.start()
+
+    def connection(self, name: str) -> WarmConnection:
+        """The warm crystallizer for a connection, built on first use.
+
+        Only callers wanting the same connection wait for its build; the
+        service lock is not held meanwhile.
+        """
+        with self._lock:
+            warm = self.connections.get(name)
+            if warm is not None:
+                return warm
+            building = self._building.setdefault(name, threading.Lock())
+        with building:
+            with self._lock:
+                warm = self.connections.get(name)
+            if warm is not None:
+                return warm
+            started = time.monotonic()
+            # One connection per warm crystallizer; jobs pair a map and a reduce connection
+            crystallizer = Crystallizer(self.config_path, name, use_cache=self.use_cache,
+                                        stream=self.stream, reduce_connection=name)
+            crystallizer.planning_pool = self.shared_planning_pool(crystallizer)
+            scheduler = FairScheduler(crystallizer.dispatcher.max_concurrency, name)
+            warm = WarmConnection(crystallizer, scheduler)
+            with self._lock:
+                self.connections[name] = warm
+            Print("STATE", f"Warmed connection {name} in {time.monotonic() - started:.2f}s "
+                           f"(max_concurrency={crystallizer.dispatcher.max_concurrency})")
+            return warm
+
+    def shared_planning_pool(self, crystallizer: Crystallizer) -> Optional[Executor]:
+        """One spawned planning pool for every connection, so jobs skip worker startup."""
+        with self._lock:
+            if self.planning_pool is None:
+                workers, _ = planning_settings(crystallizer.processing_config)
+                if workers > 1:
+                    self.planning_pool = ProcessPoolExecutor(
+                        max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            return self.planning_pool
+
+    def submit(self, spec: Dict[str, Any]) -> Job:
+        """Validate and queue a job; raises ValueError for a bad request."""
+        for key in ("haystack_path", "system_prompt", "connection"):
+            if not spec.get(key):
+                raise ValueError(f"Job is missing '{key}'")
+        for key, expected in JOB_FIELDS.items():
+            if spec.get(key) is not None and not json_type_matches(spec[key], expected):
+                raise ValueError(f"Job field '{key}' must be of type {expected}")
+        if not Path(spec["haystack_path"]).exists():
+            raise ValueError(f"Haystack path not found: {spec['haystack_path']}")
+        if not Path(spec["system_prompt"]).is_file():
+            raise ValueError(f"System prompt template not found: {spec['system_prompt']}")
+        options = spec.get("options") or {}
+        if not isinstance(options, dict):
+            raise ValueError("Job options must be a JSON object")
+        unknown = sorted(set(options) - set(JOB_OPTIONS))
+        if unknown:
+            raise ValueError(f"Unknown job option(s) {unknown}; allowed: {list(JOB_OPTIONS)}")
+        for key, value in options.items():
+            if value is not None and not json_type_matches(value, JOB_OPTIONS[key]):
+                raise ValueError(f"Job option '{key}' must be of type {JOB_OPTIONS[key]}")
+        spec = {"task_label": "crystal", "output_dir": "./crystals", "resume": False,
+                **spec, "options": options}
+        with self._lock:
+            job = Job(f"job-{next(self._ids):06d}", spec)
+            self.jobs[job.id] = job
+        self.queue.put(job)
+        Print("STATE", f"Queued {job.id}: {spec['haystack_path']} on {spec['connection']}")
+        return job
+
+    def cancel(self, job_id: str) -> bool:
+        """Cancel a job that has not started; False if it is already running or over."""
+        with self._lock:
+            job = self.jobs[job_id]
+            if job.status != "queued":
+                return False
+            job.status = "cancelled"
+            job.finished = time.time()
+            return True
+
+    def _run_jobs(self) -> None:
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            with self._lock:
+                if job.status != "queued":
+                    continue
+                job.status = "running"
+                job.started = time.time()
+            self.run_job(job)
+
+    def run_job(self, job: Job) -> None:
+        spec = job.spec
+        try:
+            warm = self.connection(spec["connection"])
+            reduce_name = (spec.get("reduce_connection")
+                           or warm.crystallizer.processing_config.get("reduce_connection")
+                           or spec["connection"])
+            reduce_warm = self.connection(reduce_name)
+            crystallizer = warm.crystallizer.for_job(warm.scheduler, job.id,
+                                                     reduce_warm.crystallizer,
+                                                     reduce_warm.scheduler)
+            crystallizer.apply_overrides(**spec["options"])
+            job.crystallizer = crystallizer
+            Print("STARTING", f"{job.id}: {spec['haystack_path']} ({spec['task_label']})")
+            job.final_crystals = crystallizer.process_haystack(
+                spec["haystack_path"], spec["system_prompt"], spec["task_label"],
+                spec["output_dir"], resume=bool(spec["resume"]),
+            )
+            status = "done"
+        except Exception as e:
+            Print("FAILURE", f"{job.id} failed: {e}")
+            job.error = str(e)
+            status = "failed"
+        if job.crystallizer is not None:
+            job.summary = job.crystallizer.metrics.summary()
+            job.crystallizer = None
+        finished = time.time()
+        with self._lock:
+            job.status = status
+            job.finished = finished
+        Print("COMPLETED", f"{job.id} {status} in {finished - (job.started or finished):.2f}s")
+
+    def health(self) -> Dict[str, Any]:
+        with self._lock:
+            counts = {status: 0 for status in JOB_STATUSES}
+            for job in self.jobs.values():
+                counts[job.status] += 1
+            connections = {
+                name: {"max_concurrency": warm.crystallizer.dispatcher.max_concurrency,
+                       "queued_calls": sum(warm.scheduler.pending().values())}
+                for name, warm in self.connections.items()
+            }
+        return {"status": "ok", "jobs": counts, "connections": connections}
+
+    def shutdown(self) -> None:
+        """Let running jobs finish, then release connections and the planning pool."""
+        with self._lock:
+            for job in self.jobs.values():
+                if job.status == "queued":
+                    job.status = "cancelled"
+        for _ in self._runners:
+            self.queue.put(None)
+        for runner in self._runners:
+            runner.join()
+        for warm in self.connections.values():
+            warm.scheduler.shutdown()
+            warm.crystallizer.close()
+        if self.planning_pool is not None:
+            self.planning_pool.shutdown()
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """JSON API over a CrystallizerService (bound per server by make_server)."""
+
+    protocol_version = "HTTP/1.1"
+
+    def __init__(self, *args: Any, service: CrystallizerService, **kwargs: Any) -> None:
+        # Set before the base class handles the request in its constructor
+        self.service = service
+        super().__init__(*args, **kwargs)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        Print("DEBUG", f"{self.command} {self.path}: " + format % args)
+
+    def send_json(self, status: int, body: Any) -> None:
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def route(self) -> Tuple[str, Optional[str]]:
+        parts = [part for part in self.path.split("?", 1)[0].split("/") if part]
+        if not parts:
+            return "", None
+        return parts[0], parts[1] if len(parts) > 1 else None
+
+    def do_GET(self) -> None:
+        service = self.service
+        resource, job_id = self.route()
+        if resource == "health":
+            self.send_json(200, service.health())
+        elif resource == "jobs" and job_id is None:
+            with service._lock:
+                jobs = list(service.jobs.values())
+            self.send_json(200, {"jobs": [job.describe(detail=False) for job in jobs]})
+        elif resource == "jobs" and job_id in service.jobs:
+            self.send_json(200, service.jobs[job_id].describe())
+        else:
+            self.send_json(404, {"error": f"Not found: {self.path}"})
+
+    def do_POST(self) -> None:
+        service = self.service
+        resource, job_id = self.route()
+        if resource != "jobs" or job_id is not None:
+            self.send_json(404, {"error": f"Not found: {self.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            spec = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(spec, dict):
+                raise ValueError("Job must be a JSON object")
+            job = service.submit(spec)
+        except ValueError as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        self.send_json(202, job.describe(detail=False))
+
+    def do_DELETE(self) -> None:
+        service = self.service
+        resource, job_id = self.route()
+        if resource != "jobs" or job_id not in service.jobs:
+            self.send_json(404, {"error": f"Not found: {self.path}"})
+        elif service.cancel(job_id):
+            self.send_json(200, service.jobs[job_id].describe(detail=False))
+        else:
+            self.send_json(409, {"error": f"{job_id} is {service.jobs[job_id].status}"})
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self) -> Tuple[Any, Tuple[str, int]]:
+        request, _ = super().get_request()
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        return request, ("local", 0)
+
+
+def make_server(service: CrystallizerService, host: str = "127.0.0.1", port: int = 8765,
+                socket_path: Optional[str] = None) -> socketserver.BaseServer:
+    handler = functools.partial(ServiceHandler, service=service)
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server: socketserver.BaseServer = UnixHTTPServer(socket_path, handler)
+    else:
+        server = ThreadingHTTPServer((host, port), handler)
+        server.daemon_threads = True
+    return server
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Crystallizer job server")
+    parser.add_argument("--config-file-path", default="./config/config.json",
+                        help="Path to config file")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on")
+    parser.add_argument("--socket", help="Listen on this Unix socket instead of TCP")
+    parser.add_argument("--max-jobs", type=int, default=4,
+                        help="Jobs run at the same time; others wait in the queue")
+    parser.add_argument("--warm", action="append", default=[], metavar="CONNECTION",
+                        help="Connection to build at startup (repeatable)")
+    parser.add_argument("--stream", action="store_true",
+                        help="Stream completions, writing tokens to <crystal>.partial as they arrive")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Bypass the on-disk response cache")
+    parser.add_argument("--log-format", choices=LOG_FORMATS, default="text",
+                        help="Console log format: rich text or one JSON object per line")
+    parser.add_argument("--log-level", choices=list(LOG_LEVELS), default="info",
+                        help="Minimum log level to emit")
+    args = parser.parse_args()
+    configure_logging(args.log_format, args.log_level)
+
+    service = CrystallizerService(args.config_file_path, max_jobs=args.max_jobs,
+                                  use_cache=not args.no_cache, stream=args.stream)
+    for name in args.warm:
+        service.connection(name)
+    server = make_server(service, args.host, args.port, args.socket)
+    where = args.socket or f"http://{args.host}:{args.port}"
+    Print("STARTING", f"Crystallizer server listening on {where} (max {args.max_jobs} jobs)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        Print("STATE", "Shutting down; waiting for running jobs")
+    finally:
+        server.server_close()
+        service.shutdown()
+
+
+if __name__ == "__main__":
+    main()
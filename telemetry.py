@@ -0,0 +1,166 @@
+"""Per-call performance records, stage timers and a background resource sampler."""
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+import psutil
+
+from utilities import Print
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of values (0 for an empty list)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = min(len(ordered), max(1, math.ceil(fraction * len(ordered))))
+    return ordered[rank - 1]
+
+
+class ResourceSampler:
+    """Samples process CPU% and RSS on a daemon thread without blocking callers."""
+
+    def __init__(self, interval: float = 1.0):
+        self.interval = interval
+        self.samples: List[Dict[str, float]] = []
+        self._process = psutil.Process(os.getpid())
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._process.cpu_percent(interval=None)  # prime; the first reading is always 0
+        self._thread = threading.Thread(target=self._run, name="crystallizer-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval + 1)
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.samples.append({
+                "time": time.time(),
+                "cpu_percent": self._process.cpu_percent(interval=None),
+                "rss_mb": self._process.memory_info().rss / (1024 ** 2),
+            })
+
+
+class MetricsRecorder:
+    """Thread-safe collector of provider call records and per-stage wall time."""
+
+    def __init__(self) -> None:
+        self.calls: List[Dict[str, Any]] = []
+        self.stage_seconds: Dict[str, float] = {}
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record_call(self, **fields: Any) -> None:
+        fields.setdefault("time", time.time())
+        with self._lock:
+            self.calls.append(fields)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Accumulate wall time spent inside the block under name."""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            with self._lock:
+                self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + elapsed
+
+    def add_stage_time(self, name: str, seconds: float) -> None:
+        """Add time measured elsewhere, e.g. in a worker process, to a stage."""
+        with self._lock:
+            self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + seconds
+
+    def summary(self, sampler: Optional[ResourceSampler] = None) -> Dict[str, Any]:
+        with self._lock:
+            calls = list(self.calls)
+            stage_seconds = dict(self.stage_seconds)
+        connections: Dict[str, Dict[str, Any]] = {}
+        for key in sorted({(c["connection"], c["stage"]) for c in calls}):
+            group = [c for c in calls if (c["connection"], c["stage"]) == key]
+            ok = [c for c in group if c["status"] == "ok"]
+            latencies = [c["wall_time"] for c in ok]
+            completion_tokens = sum(c.get("completion_tokens") or 0 for c in ok)
+            # Hit rate only over calls whose provider reported cached prompt tokens
+            reporting = [c for c in ok if c.get("cached_prompt_tokens") is not None
+                         and c.get("prompt_tokens")]
+            cached_prompt = sum(c["cached_prompt_tokens"] for c in reporting)
+            reported_prompt = sum(c["prompt_tokens"] for c in reporting)
+            # Throughput over the span the connection was busy with this stage; summing
+            # wall times instead would give the speed of one call, not of N concurrent ones
+            served = [c for c in ok if not c.get("cached")]
+            span = (max(c["time"] for c in served)
+                    - min(c["time"] - c["wall_time"] for c in served)) if served else 0.0
+            served_tokens = sum(c.get("completion_tokens") or 0 for c in served)
+            first_token = [c["time_to_first_token"] for c in ok
+                           if c.get("time_to_first_token") is not None]
+            connections[f"{key[0]}/{key[1]}"] = {
+                "calls": len(group),
+                "failed": len(group) - len(ok),
+                "cached": sum(1 for c in ok if c.get("cached")),
+                "retries": sum(c.get("retries", 0) for c in group),
+                "throttled": sum(c.get("throttled", 0) for c in group),
+                "p50_latency": round(percentile(latencies, 0.50), 3),
+                "p95_latency": round(percentile(latencies, 0.95), 3),
+                "p95_queue_wait": round(percentile([c["queue_wait"] for c in group], 0.95), 3),
+                "p50_ttft": round(percentile(first_token, 0.50), 3) if first_token else None,
+                "prompt_tokens": sum(c.get("prompt_tokens") or 0 for c in ok),
+                "completion_tokens": completion_tokens,
+                "cached_prompt_tokens": cached_prompt,
+                "prefix_hit_rate": (round(cached_prompt / reported_prompt, 3)
+                                    if reported_prompt else None),
+                "tokens_per_sec": round(served_tokens / span, 1) if span > 0 else 0.0,
+            }
+        summary: Dict[str, Any] = {
+            "wall_time": round(time.monotonic() - self.started, 3),
+            "stage_seconds": {name: round(value, 3) for name, value in stage_seconds.items()},
+            "connections": connections,
+        }
+        if sampler is not None and sampler.samples:
+            summary["peak_rss_mb"] = round(max(s["rss_mb"] for s in sampler.samples), 1)
+            summary["mean_cpu_percent"] = round(
+                sum(s["cpu_percent"] for s in sampler.samples) / len(sampler.samples), 1
+            )
+        return summary
+
+    def write_jsonl(self, path: Path, sampler: Optional[ResourceSampler] = None) -> Dict[str, Any]:
+        """Write call records, resource samples and the summary; returns the summary."""
+        summary = self.summary(sampler)
+        with self._lock:
+            calls = list(self.calls)
+        with open(path, 'w') as f:
+            for call in calls:
+                f.write(json.dumps({"type": "call", **call}) + "\n")
+            for sample in (sampler.samples if sampler is not None else []):
+                f.write(json.dumps({"type": "resource", **sample}) + "\n")
+            f.write(json.dumps({"type": "summary", **summary}) + "\n")
+        return summary
+
+    @staticmethod
+    def log_summary(summary: Dict[str, Any]) -> None:
+        stages = ", ".join(f"{name} {seconds:.1f}s" for name, seconds in summary["stage_seconds"].items())
+        Print("STATE", f"Run time {summary['wall_time']:.1f}s ({stages or 'no stages timed'})")
+        if "peak_rss_mb" in summary:
+            Print("STATE", f"Peak RSS {summary['peak_rss_mb']} MB, "
+                           f"mean CPU {summary['mean_cpu_percent']}%")
+        header = (f"{'connection/stage':<32} {'calls':>6} {'fail':>5} {'cache':>6} {'retry':>6} {'429':>5} "
+                  f"{'p50 s':>8} {'p95 s':>8} {'p95 wait':>9} {'tok in':>9} {'pfx hit':>8} "
+                  f"{'tok out':>9} {'tok/s':>8}")
+        Print("STATE", header)
+        for name, row in summary["connections"].items():
+            hit_rate = "-" if row["prefix_hit_rate"] is None else f"{row['prefix_hit_rate']:.0%}"
+            Print("STATE", f"{name:<32} {row['calls']:>6} {row['failed']:>5} {row['cached']:>6} "
+                           f"{row['retries']:>6} {row['throttled']:>5} {row['p50_latency']:>8.2f} {row['p95_latency']:>8.2f} "
+                           f"{row['p95_queue_wait']:>9.2f} {row['prompt_tokens']:>9} {hit_rate:>8} "
+                           f"{row['completion_tokens']:>9} {row['tokens_per_sec']:>8.1f}")
@@ -0,0 +1,123 @@
+"""Shared fixtures: the repo root on sys.path and an offline stand-in for tiktoken encodings."""
+import json
+import re
+import sys
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+
+class WordEncoding:
+    """Tokenizes into words with their leading whitespace, like a BPE without the download.
+
+    Implements the parts of tiktoken.Encoding the crystallizer uses, so
+    tests run without fetching cl100k_base.
+    """
+
+    name = "test-words"
+
+    def __init__(self):
+        self.ids: Dict[str, int] = {}
+        self.pieces: List[str] = []
+
+    def token_id(self, piece: str) -> int:
+        if piece not in self.ids:
+            self.ids[piece] = len(self.pieces)
+            self.pieces.append(piece)
+        return self.ids[piece]
+
+    def encode(self, text: str, **kwargs) -> List[int]:
+        return [self.token_id(piece) for piece in re.findall(r"\s*\S+|\s+", text)]
+
+    def encode_ordinary(self, text: str) -> List[int]:
+        return self.encode(text)
+
+    def decode(self, tokens: List[int]) -> str:
+        return "".join(self.pieces[t] for t in tokens)
+
+    def decode_with_offsets(self, tokens: List[int]) -> Tuple[str, List[int]]:
+        offsets = []
+        position = 0
+        for t in tokens:
+            offsets.append(position)
+            position += len(self.pieces[t])
+        return self.decode(tokens), offsets
+
+
+@pytest.fixture
+def encoding() -> WordEncoding:
+    return WordEncoding()
+
+
+@pytest.fixture
+def offline_tiktoken(monkeypatch, encoding):
+    """Every tiktoken.get_encoding call returns the word encoding."""
+    import tiktoken
+    monkeypatch.setattr(tiktoken, "get_encoding", lambda name: encoding)
+    return encoding
+
+
+@pytest.fixture
+def mock_server():
+    from benchmarks.mock_server import MockInferenceServer, MockSettings
+    server = MockInferenceServer(settings=MockSettings(reply_tokens=8, seed=0)).start()
+    yield server
+    server.stop()
+
+
+def connection_config(server, model: str = "mock", **overrides) -> dict:
+    """An OpenAI-format connection to the mock server."""
+    config = {
+        "api_type": "openai",
+        "base_url": server.base_url("openai"),
+        "api_key": "test",
+        "default_model": model,
+        "default_ctx_len": 1200,
+        "default_max_tokens": 64,
+        "max_concurrency": 4,
+        "max_retries": 1,
+        "retry_backoff": 0.01,
+        "batch_poll_interval": 0.01,
+    }
+    config.update(overrides)
+    return config
+
+
+@pytest.fixture
+def workspace(tmp_path, offline_tiktoken):
+    """Config writer, a two-file haystack, a prompt template and an output directory."""
+    from benchmarks.run_benchmarks import synthetic_document
+    from utilities import configure_logging
+    configure_logging("text", "error")
+    haystack = tmp_path / "haystack"
+    haystack.mkdir()
+    (haystack / "a.md").write_text(synthetic_document(1500, seed=1), encoding="utf-8")
+    (haystack / "b.md").write_text(synthetic_document(800, seed=2), encoding="utf-8")
+    prompt = tmp_path / "system_prompt.j2"
+    prompt.write_text("Summarize the text for {{ task_label }}.", encoding="utf-8")
+
+    class Workspace:
+        root = tmp_path
+        output_dir = tmp_path / "out"
+
+        def __init__(self):
+            self.haystack = haystack
+            self.prompt = prompt
+
+        def write_config(self, connections: dict, **processing) -> str:
+            config = {
+                "processing": {"planning_workers": 1, "resource_sample_interval": 1.0,
+                               **processing},
+                "response_cache": {"enabled": False},
+                "inference_service_connections": connections,
+            }
+            path = tmp_path / "config.json"
+            path.write_text(json.dumps(config), encoding="utf-8")
+            return str(path)
+
+    return Workspace()
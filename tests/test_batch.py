@@ -0,0 +1,61 @@
+"""--batch-mode against the mock server's /v1/files and /v1/batches endpoints."""
+import json
+
+import pytest
+
+from backends.providers.base import ProviderHTTPError
+from conftest import connection_config
+from crystallizer import Crystallizer
+
+
+def run_batched(workspace, server, **overrides):
+    config = workspace.write_config({"mock": connection_config(server, **overrides)},
+                                    incremental=False)
+    crystallizer = Crystallizer(config, "mock", use_cache=False, batch_mode=True)
+    try:
+        return crystallizer.process_haystack(str(workspace.haystack), str(workspace.prompt),
+                                             "task", str(workspace.output_dir))
+    finally:
+        crystallizer.close()
+
+
+def test_batch_answers_map_calls(workspace, mock_server):
+    finals = run_batched(workspace, mock_server)
+    assert len(finals) == 2
+    requests = mock_server.stats.snapshot()["requests"]
+    assert requests.get("batch", 0) > 0
+    # Only the reduce phase goes through the interactive endpoint
+    assert requests.get("openai", 0) == 2
+
+
+@pytest.mark.parametrize("status", ["expired", "failed", "cancelled"])
+def test_batch_without_output_falls_back_to_interactive_calls(workspace, mock_server, status):
+    mock_server.settings.batch_status = status
+    finals = run_batched(workspace, mock_server)
+    assert len(finals) == 2
+    requests = mock_server.stats.snapshot()["requests"]
+    assert requests.get("batch", 0) == 0
+    assert requests.get("openai", 0) > 2
+    manifest = json.loads((workspace.output_dir / "task__manifest.json").read_text())
+    assert [batch["status"] for batch in manifest["batches"].values()] == ["failed"]
+
+
+def test_transient_poll_errors_are_retried(workspace, mock_server):
+    mock_server.settings.error_status = 502
+    mock_server.settings.batch_poll_errors = 3
+    finals = run_batched(workspace, mock_server)
+    assert len(finals) == 2
+    assert mock_server.settings.batch_poll_errors == 0
+    requests = mock_server.stats.snapshot()["requests"]
+    # The batch still answered every map call
+    assert requests.get("batch", 0) > 0
+    assert requests.get("openai", 0) == 2
+
+
+def test_persistent_poll_errors_stop_the_run_for_resume(workspace, mock_server):
+    mock_server.settings.batch_poll_errors = 5
+    with pytest.raises(ProviderHTTPError):
+        run_batched(workspace, mock_server, batch_max_poll_failures=3)
+    manifest = json.loads((workspace.output_dir / "task__manifest.json").read_text())
+    assert [batch["status"] for batch in manifest["batches"].values()] == ["submitted"]
+    assert mock_server.stats.snapshot()["requests"].get("openai", 0) == 0
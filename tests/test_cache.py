@@ -0,0 +1,77 @@
+"""Response cache: hits, LRU eviction and batched access-time writes."""
+import sqlite3
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+from backends.providers.base import Completion
+from backends.providers.cache import CachedProvider, ResponseCache
+
+
+def last_access(path: Path, key: str) -> float:
+    with sqlite3.connect(str(path)) as conn:
+        row = conn.execute("SELECT last_access FROM responses WHERE key = ?", (key,)).fetchone()
+    return float(row[0])
+
+
+def test_get_returns_what_was_put(tmp_path: Path) -> None:
+    cache = ResponseCache(str(tmp_path / "cache.sqlite3"))
+    cache.put("k", "crystal")
+    assert cache.get("k") == "crystal"
+    assert cache.get("missing") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache.close()
+
+
+def test_hits_do_not_commit_until_flushed(tmp_path: Path) -> None:
+    path = tmp_path / "cache.sqlite3"
+    cache = ResponseCache(str(path))
+    cache.put("k", "crystal")
+    stored = last_access(path, "k")
+    changes = cache._conn.total_changes
+    for _ in range(10):
+        cache.get("k")
+    assert cache._conn.total_changes == changes
+    assert last_access(path, "k") == stored
+    cache.close()
+    assert last_access(path, "k") > stored
+
+
+def test_eviction_sees_pending_access_times(tmp_path: Path) -> None:
+    cache = ResponseCache(str(tmp_path / "cache.sqlite3"), max_size_mb=0)
+    cache.max_bytes = 10 ** 6
+    for key in ("a", "b", "c"):
+        cache.put(key, key * 1000)
+    # "a" is the oldest write but the most recent read, so "b" goes first
+    cache.get("a")
+    cache.max_bytes = cache._total_bytes - 1
+    cache.put("c", "c" * 1000)
+    assert cache.get("a") is not None
+    assert cache.get("b") is None
+    cache.close()
+
+
+class CountingProvider:
+    def __init__(self, model: str):
+        self.model = model
+        self.temperature = 0.2
+        self.max_tokens = 64
+        self.options: dict = {}
+        self.calls = 0
+
+    def complete(self, system_prompt: str, user_content: str,
+                 on_token: Optional[Callable[[str], Any]] = None) -> Completion:
+        self.calls += 1
+        return Completion(f"{self.model}: {user_content}")
+
+
+def test_cached_provider_keys_on_the_provider_identity(tmp_path: Path) -> None:
+    cache = ResponseCache(str(tmp_path / "cache.sqlite3"))
+    first = CountingProvider("m1")
+    cached = CachedProvider(first, cache, "openai")
+    assert cached.generate("system", "text") == "m1: text"
+    assert cached.complete("system", "text").cached
+    assert first.calls == 1
+    other = CountingProvider("m2")
+    assert CachedProvider(other, cache, "openai").generate("system", "text") == "m2: text"
+    assert other.calls == 1
+    cache.close()
@@ -0,0 +1,61 @@
+"""Crystal stores: the file layout and the SQLite store behave alike."""
+import pytest
+
+from crystal_store import CRYSTAL_STORES, CrystalStore, open_crystal_store
+
+
+def test_crystal_store_is_abstract(tmp_path):
+    with pytest.raises(TypeError):
+        CrystalStore(tmp_path)
+
+
+@pytest.mark.parametrize("kind", sorted(CRYSTAL_STORES))
+def test_put_get_delete(tmp_path, kind):
+    store = open_crystal_store(kind, tmp_path)
+    try:
+        store.begin_file("doc", None)
+        map_ref = store.put("doc", "task", "first", 0)
+        level_ref = store.put("doc", "task", "merged", 0, level=1)
+        final_ref = store.put("doc", "task", "final")
+        assert map_ref == str(tmp_path / "doc__task__000.txt")
+        assert level_ref == str(tmp_path / "doc__task__L1-000.txt")
+        assert final_ref == str(tmp_path / "doc__task__final.txt")
+        store.begin_file("doc", "source-hash")
+        assert store.get_many([map_ref, level_ref, final_ref]) == ["first", "merged", "final"]
+        store.delete([map_ref, level_ref])
+        assert not store.exists(map_ref) and not store.exists(level_ref)
+        assert store.get(final_ref) == "final"
+    finally:
+        store.close()
+
+
+@pytest.mark.parametrize("kind", sorted(CRYSTAL_STORES))
+def test_read_range_is_ordered_by_integer_ordinal(tmp_path, kind):
+    store = open_crystal_store(kind, tmp_path)
+    try:
+        for ordinal in (1000, 7, 999, 0, 12):
+            store.put("doc", "task", f"map {ordinal}", ordinal)
+        store.put("doc", "task", "merged", 3, level=1)
+        store.put("doc", "other", "other task", 5)
+        store.put("doc2", "task", "other file", 5)
+        assert store.read_range("doc", "task") == [
+            (0, "map 0"), (7, "map 7"), (12, "map 12"), (999, "map 999"), (1000, "map 1000")]
+        assert store.read_range("doc", "task", start=7, end=999) == [(7, "map 7"),
+                                                                     (12, "map 12")]
+        assert store.read_range("doc", "task", level=1) == [(3, "merged")]
+        assert store.read_range("doc", "task", level=2) == []
+    finally:
+        store.close()
+
+
+def test_sqlite_get_many_reads_buffered_and_committed_rows(tmp_path):
+    store = open_crystal_store("sqlite", tmp_path)
+    try:
+        committed = [store.put("doc", "task", f"text {i}", i) for i in range(600)]
+        store.flush()
+        buffered = store.put("doc", "task", "buffered", 600)
+        missing = str(tmp_path / "doc__task__999.txt")
+        texts = store.get_many(committed + [buffered, missing])
+        assert texts == [f"text {i}" for i in range(600)] + ["buffered", None]
+    finally:
+        store.close()
@@ -0,0 +1,37 @@
+"""Run-wide dedup: exact duplicates by default, near duplicates only when opted into."""
+from conftest import connection_config
+from crystallizer import Crystallizer
+
+
+def run(workspace, server, **processing):
+    config = workspace.write_config({"mock": connection_config(server)}, incremental=False,
+                                    **processing)
+    crystallizer = Crystallizer(config, "mock", use_cache=False)
+    try:
+        crystallizer.process_haystack(str(workspace.haystack), str(workspace.prompt), "task",
+                                      str(workspace.output_dir))
+        return crystallizer.duplicates
+    finally:
+        crystallizer.close()
+
+
+def add_copies(workspace):
+    text = (workspace.haystack / "a.md").read_text(encoding="utf-8")
+    (workspace.haystack / "copy.md").write_text(text, encoding="utf-8")
+    words = text.split(" ")
+    words[len(words) // 2] = "changed"
+    (workspace.haystack / "edited.md").write_text(" ".join(words), encoding="utf-8")
+
+
+def test_only_exact_duplicates_are_reused_by_default(workspace, mock_server):
+    add_copies(workspace)
+    duplicates = run(workspace, mock_server)
+    assert duplicates.exact_hits > 0
+    assert duplicates.near_hits == 0
+
+
+def test_near_duplicates_are_opt_in(workspace, mock_server):
+    add_copies(workspace)
+    duplicates = run(workspace, mock_server, dedup_threshold=0.9)
+    assert duplicates.exact_hits > 0
+    assert duplicates.near_hits > 0
@@ -0,0 +1,51 @@
+"""Future chaining used by duplicate detection and batch mode."""
+from concurrent.futures import Future
+
+from batch import BatchCollector
+from dedup import follow
+
+
+def finished(result=None, error=None) -> Future:
+    future: Future = Future()
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+    return future
+
+
+def cancelled() -> Future:
+    future: Future = Future()
+    future.cancel()
+    return future
+
+
+def test_follow_takes_the_source_result():
+    assert follow(finished("crystal"), lambda: finished("fallback")).result(0) == "crystal"
+
+
+def test_follow_falls_back_on_a_failed_source():
+    target = follow(finished(error=RuntimeError("boom")), lambda: finished("fallback"))
+    assert target.result(0) == "fallback"
+
+
+def test_follow_falls_back_on_a_cancelled_source():
+    assert follow(cancelled(), lambda: finished("fallback")).result(0) == "fallback"
+
+
+def test_follow_is_cancelled_when_the_fallback_is():
+    assert follow(cancelled(), cancelled).cancelled()
+
+
+def test_chain_forwards_cancellation():
+    target: Future = Future()
+    source: Future = Future()
+    BatchCollector.chain(source, target)
+    source.cancel()
+    assert target.cancelled()
+
+
+def test_chain_forwards_the_result():
+    target: Future = Future()
+    BatchCollector.chain(finished("crystal"), target)
+    assert target.result(0) == "crystal"
@@ -0,0 +1,99 @@
+"""ProviderGroup routing, ejection of failing members and their recovery."""
+import threading
+import time
+from typing import Any, Callable, List, Optional
+
+import pytest
+import requests
+
+from backends.providers.base import Completion, ProviderHTTPError
+from backends.providers.group import CircuitBreaker, GroupMember, ProviderGroup
+
+
+class FakeProvider:
+    """Answers with its own name, or raises the next queued error."""
+
+    stream = False
+
+    def __init__(self, name: str, delay: float = 0.0):
+        self.name = name
+        self.delay = delay
+        self.errors: List[BaseException] = []
+        self.calls = 0
+
+    def complete(self, system_prompt: str, user_content: str,
+                 on_token: Optional[Callable[[str], Any]] = None) -> Completion:
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.errors:
+            raise self.errors.pop(0)
+        return Completion(self.name)
+
+    def close(self) -> None:
+        pass
+
+
+def make_group(*providers: FakeProvider, routing: str = "least_outstanding",
+               cooldown: float = 30.0, **member: Any) -> ProviderGroup:
+    return ProviderGroup("pool", [
+        GroupMember(p.name, p, breaker=CircuitBreaker(failure_threshold=2, cooldown=cooldown),
+                    **member)
+        for p in providers
+    ], routing)
+
+
+def test_least_outstanding_spreads_concurrent_calls() -> None:
+    a, b = FakeProvider("a", delay=0.2), FakeProvider("b", delay=0.2)
+    group = make_group(a, b, max_concurrency=1)
+    threads = [threading.Thread(target=group.generate, args=("s", "u")) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert (a.calls, b.calls) == (2, 2)
+
+
+def test_latency_routing_prefers_the_faster_member() -> None:
+    fast, slow = FakeProvider("fast"), FakeProvider("slow", delay=0.05)
+    group = make_group(fast, slow, routing="latency")
+    answers = [group.complete("s", "u").endpoint for _ in range(6)]
+    # Both unmeasured members are tried once, then the faster one takes the rest
+    assert answers.count("slow") == 1
+    assert answers.count("fast") == 5
+
+
+def test_server_errors_fail_over_and_eject() -> None:
+    a, b = FakeProvider("a"), FakeProvider("b")
+    a.errors = [ProviderHTTPError("boom", 502), requests.ConnectionError("refused")]
+    group = make_group(a, b)
+    assert [group.generate("s", "u") for _ in range(3)] == ["b", "b", "b"]
+    assert a.calls == 2
+    assert group.stats()["a"] == {"calls": 2, "failures": 2, "latency": None, "ejected": True}
+
+
+def test_bad_requests_are_raised_without_penalty() -> None:
+    a, b = FakeProvider("a"), FakeProvider("b")
+    a.errors = [ProviderHTTPError("too long", 400)] * 3
+    group = make_group(a, b)
+    for _ in range(3):
+        with pytest.raises(ProviderHTTPError):
+            group.generate("s", "u")
+    assert b.calls == 0
+    assert group.stats()["a"]["failures"] == 0
+    assert group.generate("s", "u") == "a"
+
+
+def test_ejected_member_recovers_after_cooldown() -> None:
+    a = FakeProvider("a")
+    a.errors = [ProviderHTTPError("overloaded", 503)] * 2
+    group = make_group(a, cooldown=0.2)
+    with pytest.raises(RuntimeError, match="All members"):
+        group.generate("s", "u")
+    with pytest.raises(RuntimeError, match="All members"):
+        group.generate("s", "u")
+    assert group.stats()["a"]["ejected"]
+    # Every member is cooling down: the call waits for the trial slot instead of failing
+    started = time.monotonic()
+    assert group.generate("s", "u") == "a"
+    assert 0.1 < time.monotonic() - started < 1.0
+    assert not group.stats()["a"]["ejected"]
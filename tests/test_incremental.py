@@ -0,0 +1,56 @@
+"""Incremental re-runs: reuse of unchanged windows and merges through the windows.json sidecars."""
+from collections import Counter
+
+from conftest import connection_config
+from crystallizer import Crystallizer
+
+
+def run(workspace, server, model="mock", reduce_connection=None):
+    connections = {"mock": connection_config(server, model=model),
+                   "other": connection_config(server, model="other")}
+    config = workspace.write_config(connections, incremental=True)
+    crystallizer = Crystallizer(config, "mock", use_cache=False,
+                                reduce_connection=reduce_connection)
+    try:
+        finals = crystallizer.process_haystack(str(workspace.haystack), str(workspace.prompt),
+                                               "task", str(workspace.output_dir))
+        assert len(finals) == 2
+        calls = Counter(call["stage"] for call in crystallizer.metrics.calls)
+        return {"map": calls["map"], "reduce": calls["reduce"]}
+    finally:
+        crystallizer.close()
+
+
+def test_unchanged_rerun_reuses_everything(workspace, mock_server):
+    first = run(workspace, mock_server)
+    assert first["map"] > 0 and first["reduce"] > 0
+    assert run(workspace, mock_server) == {"map": 0, "reduce": 0}
+
+
+def test_model_change_reruns_every_call(workspace, mock_server):
+    first = run(workspace, mock_server)
+    assert run(workspace, mock_server, model="mock-2") == first
+
+
+def test_reduce_connection_change_reruns_only_merges(workspace, mock_server):
+    first = run(workspace, mock_server)
+    rerun = run(workspace, mock_server, reduce_connection="other")
+    assert rerun == {"map": 0, "reduce": first["reduce"]}
+    # And back again: the stored merges are now those of the other connection
+    assert run(workspace, mock_server) == {"map": 0, "reduce": first["reduce"]}
+
+
+def test_appended_tail_reruns_only_new_windows(workspace, mock_server):
+    from benchmarks.run_benchmarks import synthetic_document
+    path = workspace.haystack / "a.md"
+    # Several windows long, so the windows before the tail keep their inputs
+    path.write_text(synthetic_document(3000, seed=5), encoding="utf-8")
+    first = run(workspace, mock_server)
+    path.write_text(path.read_text(encoding="utf-8") + "\n" + synthetic_document(300, seed=6),
+                    encoding="utf-8")
+    rerun = run(workspace, mock_server)
+    # Only the last window's segments and the merges above them rerun
+    assert 0 < rerun["map"] <= 3 < first["map"]
+    assert rerun["reduce"] > 0
+    # The new sidecar covers the longer file, so an identical run reuses it all
+    assert run(workspace, mock_server) == {"map": 0, "reduce": 0}
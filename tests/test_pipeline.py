@@ -0,0 +1,105 @@
+"""Directory pipeline: scheduling, file identity and stage timing."""
+import json
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Iterator
+
+import pytest
+
+import crystallizer as crystallizer_module
+from conftest import connection_config
+from crystallizer import Crystallizer
+from pipeline import DirectoryPipeline, file_keys
+
+
+@pytest.fixture
+def slow_server() -> Iterator[Any]:
+    from benchmarks.mock_server import MockInferenceServer, MockSettings
+    server = MockInferenceServer(settings=MockSettings(latency=0.5, reply_tokens=8,
+                                                       seed=0)).start()
+    yield server
+    server.stop()
+
+
+def test_map_stage_ends_with_the_last_map_call(workspace: Any, mock_server: Any,
+                                               slow_server: Any) -> None:
+    config = workspace.write_config({"mock": connection_config(mock_server),
+                                     "slow": connection_config(slow_server)},
+                                    incremental=False, pipeline_reduce=False)
+    crystallizer = Crystallizer(config, "mock", use_cache=False, reduce_connection="slow")
+    try:
+        finals = crystallizer.process_haystack(str(workspace.haystack), str(workspace.prompt),
+                                               "task", str(workspace.output_dir))
+        stages = crystallizer.metrics.stage_seconds
+    finally:
+        crystallizer.close()
+    assert len(finals) == 2
+    # Map calls answer at once; each file's one merge waits 0.5 s, both files at the same time
+    assert stages["map"] < 0.25
+    assert 0.5 <= stages["reduce"] < 0.9
+
+
+def test_same_named_files_in_different_directories_stay_apart(workspace: Any,
+                                                              mock_server: Any) -> None:
+    from benchmarks.run_benchmarks import synthetic_document
+    for year, seed in (("2024", 3), ("2025", 4)):
+        (workspace.haystack / year).mkdir()
+        (workspace.haystack / year / "log.md").write_text(synthetic_document(600, seed=seed),
+                                                          encoding="utf-8")
+    config = workspace.write_config({"mock": connection_config(mock_server)}, incremental=True)
+    for resume in (False, True):
+        crystallizer = Crystallizer(config, "mock", use_cache=False)
+        try:
+            finals = crystallizer.process_haystack(str(workspace.haystack), str(workspace.prompt),
+                                                   "task", str(workspace.output_dir),
+                                                   resume=resume)
+            map_calls = sum(call["stage"] == "map" for call in crystallizer.metrics.calls)
+        finally:
+            crystallizer.close()
+        assert [Path(final).name for final in finals] == [
+            "2024%2Flog__task__final.txt", "2025%2Flog__task__final.txt",
+            "a__task__final.txt", "b__task__final.txt"]
+        assert (map_calls == 0) == resume
+    manifest = json.loads((workspace.output_dir / "task__manifest.json").read_text())
+    assert sorted(manifest["files"]) == ["2024%2Flog", "2025%2Flog", "a", "b"]
+    assert manifest["files"]["2025%2Flog"]["source"].endswith("2025/log.md")
+    assert len({entry["source_hash"] for entry in manifest["files"].values()}) == 4
+    assert all(entry["status"] == "done" for entry in manifest["files"].values())
+
+
+def test_file_keys() -> None:
+    root = Path("/haystack")
+    keys = file_keys([root / "a.md", root / "x" / "a.md", root / "x" / "n.md",
+                      root / "x" / "n.txt", root / "100%.md"], root)
+    assert list(keys.values()) == ["a", "x%2Fa", "x%2Fn.md", "x%2Fn.txt", "100%25"]
+
+
+def test_finals_follow_file_order_and_planning_stays_bounded(
+        workspace: Any, mock_server: Any, monkeypatch: pytest.MonkeyPatch) -> None:
+    from benchmarks.run_benchmarks import synthetic_document
+    # Sizes out of name order, so the largest-first queue finishes files out of order
+    for idx, words in enumerate((300, 2500, 150, 1800, 600, 900)):
+        (workspace.haystack / f"f{idx}.md").write_text(synthetic_document(words, seed=idx),
+                                                       encoding="utf-8")
+    most_planning = []
+
+    class WatchedPipeline(DirectoryPipeline):
+        def plan_ahead(self) -> None:
+            super().plan_ahead()
+            most_planning.append(len(self.planning))
+
+    monkeypatch.setattr(crystallizer_module, "DirectoryPipeline", WatchedPipeline)
+    config = workspace.write_config({"mock": connection_config(mock_server)}, incremental=False,
+                                    planning_workers=2)
+    crystallizer = Crystallizer(config, "mock", use_cache=False)
+    # A shared thread pool plans in parallel without spawning workers that lack the test encoding
+    crystallizer.planning_pool = ThreadPoolExecutor(max_workers=2)
+    try:
+        finals = crystallizer.process_haystack(str(workspace.haystack), str(workspace.prompt),
+                                               "task", str(workspace.output_dir))
+    finally:
+        crystallizer.planning_pool.shutdown()
+        crystallizer.close()
+    names = [Path(final).name.split("__")[0] for final in finals]
+    assert names == ["a", "b", "f0", "f1", "f2", "f3", "f4", "f5"]
+    assert max(most_planning) == 2
@@ -0,0 +1,24 @@
+"""--plan: what the planner reports about each file."""
+from conftest import connection_config
+from crystallizer import Crystallizer
+from manifest import content_hash
+from planner import HaystackPlanner
+
+
+def plan(workspace, server, **processing):
+    config = workspace.write_config({"mock": connection_config(server)}, **processing)
+    crystallizer = Crystallizer(config, "mock", use_cache=False)
+    try:
+        return HaystackPlanner(crystallizer).plan_files(
+            crystallizer.discover_files(workspace.haystack))
+    finally:
+        crystallizer.close()
+
+
+def test_streamed_and_pooled_files_report_their_source_hash(workspace, mock_server):
+    (workspace.haystack / "c.md").write_bytes(b"\xff\xfe\x00binary" * 100)
+    expected = [content_hash((workspace.haystack / name).read_text(encoding="utf-8"))
+                for name in ("a.md", "b.md")] + [None]
+    for pool_max_file_mb in (16, 0):
+        planned = plan(workspace, mock_server, pool_max_file_mb=pool_max_file_mb)
+        assert [p.source_hash for p in planned] == expected
@@ -0,0 +1,28 @@
+"""Provider adapters build the requests their APIs expect."""
+from typing import Any, Dict, Tuple
+
+from backends.providers import get_provider_class
+from backends.providers.base import BaseProvider
+
+
+def build(api_type: str, **config: Any) -> Tuple[str, Dict[str, str], Dict[str, Any]]:
+    provider: BaseProvider = get_provider_class(api_type)({"default_model": "m", **config})
+    try:
+        return provider.build_request("system", "user")
+    finally:
+        provider.close()
+
+
+def test_vllm_speaks_the_openai_format() -> None:
+    url, headers, payload = build("vllm", base_url="http://gpu:8000/v1", options={"top_p": 0.9})
+    openai_url, _, openai_payload = build("openai", base_url="http://gpu:8000/v1", api_key="k",
+                                          options={"top_p": 0.9}, default_temperature=0.7)
+    assert url == openai_url == "http://gpu:8000/v1/chat/completions"
+    assert payload == openai_payload
+    assert "Authorization" not in headers
+
+
+def test_vllm_sends_a_key_when_configured() -> None:
+    _, headers, payload = build("vllm", api_key="secret")
+    assert headers["Authorization"] == "Bearer secret"
+    assert payload["temperature"] == 0.7
@@ -0,0 +1,137 @@
+"""Token buckets, the AIMD concurrency limit and Retry-After pauses, on a fake clock."""
+from typing import Any, Callable, Optional
+
+import pytest
+
+from backends.providers import ratelimit
+from backends.providers.base import Completion, ProviderHTTPError, parse_retry_after
+from backends.providers.ratelimit import RateLimitedProvider, RateLimiter, TokenBucket
+from dispatch import throttle_info
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch: pytest.MonkeyPatch) -> FakeClock:
+    fake = FakeClock()
+    monkeypatch.setattr(ratelimit, "time", fake)
+    return fake
+
+
+class ThrottledProvider:
+    """Answers 429 with the given Retry-After once, then succeeds."""
+
+    max_tokens = 0
+
+    def __init__(self, retry_after: Optional[float]):
+        self.retry_after = retry_after
+        self.calls = 0
+
+    def complete(self, system_prompt: str, user_content: str,
+                 on_token: Optional[Callable[[str], Any]] = None) -> Completion:
+        self.calls += 1
+        if self.calls == 1:
+            raise ProviderHTTPError("slow down", 429, self.retry_after)
+        return Completion("ok")
+
+
+def test_token_bucket_refills_at_its_rate(clock: FakeClock) -> None:
+    bucket = TokenBucket(per_minute=60)
+    assert bucket.wait_time(60, clock.now) == 0.0
+    bucket.take(60)
+    assert bucket.wait_time(1, clock.now) == pytest.approx(1.0)
+    assert bucket.wait_time(30, clock.now + 10) == pytest.approx(20.0)
+    # Refill stops at one minute's worth
+    assert bucket.wait_time(1, clock.now + 600) == 0.0
+    assert bucket.level == 60
+
+
+def test_oversized_request_waits_for_a_full_bucket_and_leaves_debt(clock: FakeClock) -> None:
+    bucket = TokenBucket(per_minute=600)
+    bucket.take(300)
+    assert bucket.wait_time(5000, clock.now) == pytest.approx(30.0)
+    bucket.refill(clock.now + 30)
+    bucket.take(5000)
+    assert bucket.level == -4400
+    assert bucket.wait_time(1, clock.now + 30) == pytest.approx(440.1)
+
+
+def test_request_budget_gates_acquire(clock: FakeClock) -> None:
+    limiter = RateLimiter("conn", max_concurrency=4, requests_per_minute=2)
+    limiter.acquire()
+    limiter.acquire()
+    assert limiter.requests is not None
+    assert limiter.requests.wait_time(1, clock.now) == pytest.approx(30.0)
+    clock.now += 30
+    limiter.acquire()
+    assert limiter.in_flight == 3
+
+
+def test_throttling_halves_the_limit_and_successes_add_back(clock: FakeClock) -> None:
+    limiter = RateLimiter("conn", max_concurrency=8)
+    limiter.acquire()
+    limiter.release(throttled=True)
+    assert limiter.limit == 4
+    # A burst of 429s within a second counts as one decrease
+    for _ in range(3):
+        limiter.acquire()
+        limiter.release(throttled=True)
+    assert limiter.limit == 4
+    clock.now += 1.0
+    limiter.acquire()
+    limiter.release(throttled=True)
+    assert limiter.limit == 2
+    # Roughly one more slot per limit's worth of successes
+    for _ in range(2):
+        limiter.acquire()
+        limiter.release()
+    assert int(limiter.limit) == 2
+    limiter.acquire()
+    limiter.release()
+    assert int(limiter.limit) == 3
+    for _ in range(30):
+        limiter.acquire()
+        limiter.release()
+    assert limiter.limit == 8
+    assert limiter.throttled == 5
+
+
+def test_fixed_concurrency_ignores_throttling(clock: FakeClock) -> None:
+    limiter = RateLimiter("conn", max_concurrency=8, adaptive_concurrency=False)
+    limiter.acquire()
+    limiter.release(throttled=True)
+    assert limiter.limit == 8
+
+
+def test_retry_after_pauses_the_connection(clock: FakeClock) -> None:
+    limiter = RateLimiter("conn", max_concurrency=4)
+    provider = RateLimitedProvider(ThrottledProvider(retry_after=2.5), limiter)
+    with pytest.raises(ProviderHTTPError) as raised:
+        provider.complete("s", "u")
+    assert throttle_info(RuntimeError("unrelated")) == (False, None)
+    # The dispatcher finds the server's wait through its own error wrapping
+    wrapped = RuntimeError("call failed")
+    wrapped.__cause__ = raised.value
+    assert throttle_info(wrapped) == (True, 2.5)
+    assert limiter.paused_until == clock.now + 2.5
+    assert limiter.limit == 2
+    clock.now += 2.5
+    assert provider.complete("s", "u").text == "ok"
+    assert limiter.in_flight == 0
+
+
+@pytest.mark.parametrize("headers,expected", [
+    ({"retry-after": "7"}, 7.0),
+    ({"retry-after-ms": "1500"}, 1.5),
+    ({"x-ratelimit-reset-requests": "1m30s", "x-ratelimit-reset-tokens": "250ms"}, 90.0),
+    ({"retry-after": "soon"}, None),
+    ({}, None),
+])
+def test_parse_retry_after(headers: Any, expected: Optional[float]) -> None:
+    assert parse_retry_after(headers) == expected
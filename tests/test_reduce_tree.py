@@ -0,0 +1,120 @@
+"""The dataflow reduce tree against the level-by-level reduce it replaced."""
+import hashlib
+import random
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from conftest import connection_config
+from crystallizer import Crystallizer
+from reduce_tree import CRYSTAL_SEPARATOR, GroupCutter
+
+
+def reference_groups(token_counts, budget, fan_in, separator_tokens):
+    """Crystallizer.plan_reduce_groups as it was before GroupCutter: one pass over a finished level."""
+    groups, current, current_tokens = [], [], 0
+    for idx, count in enumerate(token_counts):
+        added = count + (separator_tokens if current else 0)
+        fits = current_tokens + added <= budget and len(current) < fan_in
+        if current and not fits and len(current) >= 2:
+            groups.append(current)
+            current, current_tokens, added = [], 0, count
+        current.append(idx)
+        current_tokens += added
+    if current:
+        groups.append(current)
+    return groups
+
+
+def merged(content):
+    """Deterministic stand-in for a merge call, a few hundred words long."""
+    digest = hashlib.sha256(content.encode("utf-8")).hexdigest()
+    return " ".join([digest] + ["merged"] * (100 + int(digest[:4], 16) % 300))
+
+
+class FakeReduceDispatcher:
+    """Answers merge calls with merged() on worker threads and records their inputs."""
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.calls = []
+
+    def submit(self, system_prompt, user_content, label, stream_path=None, stage="reduce"):
+        self.calls.append(user_content)
+        return self.executor.submit(merged, user_content)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+def level_by_level(crystallizer, texts):
+    """The reduce as done before the tree: each level waits for the whole level below."""
+    c = crystallizer
+    count = c.token_counter.count_tokens
+    budget = c.reduce_token_budget()
+    calls, level = [], 1
+    while True:
+        groups = reference_groups([count(text) for text in texts], budget, c.reduce_fan_in,
+                                  count(CRYSTAL_SEPARATOR))
+        if len(groups) > 1 and level >= c.reduce_max_levels:
+            groups = [list(range(len(texts)))]
+        if len(groups) == 1:
+            break
+        next_texts = []
+        for group in groups:
+            if len(group) == 1:
+                next_texts.append(texts[group[0]])
+                continue
+            content = CRYSTAL_SEPARATOR.join(texts[i] for i in group)
+            calls.append(content)
+            next_texts.append(merged(content))
+        texts, level = next_texts, level + 1
+    content = CRYSTAL_SEPARATOR.join(texts)
+    calls.append(content)
+    return merged(content), calls
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_group_cutter_matches_one_pass_grouping(seed):
+    rng = random.Random(seed)
+    counts = [rng.randint(1, 900) for _ in range(rng.randint(1, 60))]
+    budget, fan_in, separator = rng.randint(500, 3000), rng.randint(2, 9), rng.randint(0, 12)
+    cutter = GroupCutter(budget, fan_in, separator)
+    groups = [group for group in map(cutter.add, counts) if group is not None]
+    trailing = cutter.close()
+    if trailing:
+        groups.append(trailing)
+    assert groups == reference_groups(counts, budget, fan_in, separator)
+
+
+@pytest.fixture
+def crystallizer(workspace, mock_server):
+    config = workspace.write_config({"mock": connection_config(mock_server)}, incremental=False)
+    crystallizer = Crystallizer(config, "mock", use_cache=False)
+    crystallizer.reduce_dispatcher = FakeReduceDispatcher()
+    crystallizer.reduce_fan_in = 4
+    workspace.output_dir.mkdir()
+    yield crystallizer
+    crystallizer.close()
+
+
+@pytest.mark.parametrize("seed,max_levels", [(0, 4), (1, 4), (2, 2), (3, 1)])
+def test_tree_matches_level_by_level_reduce(workspace, crystallizer, seed, max_levels):
+    crystallizer.reduce_max_levels = max_levels
+    rng = random.Random(seed)
+    texts = [" ".join(f"w{i}-{n}" for n in range(rng.randint(20, 700))) for i in range(30)]
+    expected_final, expected_calls = level_by_level(crystallizer, texts)
+
+    tree = crystallizer.reduce_tree("doc", "task", workspace.output_dir)
+    for key in range(len(texts)):
+        tree.expect(key)
+    # Map crystals complete out of order
+    arrival = list(range(len(texts)))
+    rng.shuffle(arrival)
+    for key in arrival:
+        tree.add(key, texts[key])
+    final_path = tree.finish()
+
+    assert crystallizer.store(workspace.output_dir).get(final_path) == expected_final
+    assert Counter(crystallizer.reduce_dispatcher.calls) == Counter(expected_calls)
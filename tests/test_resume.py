@@ -0,0 +1,90 @@
+"""--resume: the run manifest and streamed source hashes."""
+import json
+
+from conftest import connection_config
+from crystallizer import Crystallizer
+from ingest import StreamHash, read_text_blocks
+from manifest import content_hash
+
+
+def run(workspace, server, resume=False, **processing):
+    # pool_max_file_mb=0 streams every file, so its source hash comes from the map phase
+    processing.setdefault("pool_max_file_mb", 0)
+    config = workspace.write_config({"mock": connection_config(server)}, incremental=False,
+                                    **processing)
+    crystallizer = Crystallizer(config, "mock", use_cache=False)
+    try:
+        finals = crystallizer.process_haystack(str(workspace.haystack), str(workspace.prompt),
+                                               "task", str(workspace.output_dir), resume=resume)
+        return finals, sum(call["stage"] == "map" for call in crystallizer.metrics.calls)
+    finally:
+        crystallizer.close()
+
+
+def source_hash(path):
+    return content_hash(path.read_text(encoding="utf-8"))
+
+
+def calls(server):
+    return server.stats.snapshot()["requests"].get("openai", 0)
+
+
+def manifest_files(workspace):
+    return json.loads((workspace.output_dir / "task__manifest.json").read_text())["files"]
+
+
+def test_stream_hash_matches_text_hash(workspace):
+    path = workspace.haystack / "a.md"
+    source = StreamHash()
+    blocks = list(source.blocks(read_text_blocks(path, 256)))
+    assert len(blocks) > 1
+    assert source.value == source_hash(path)
+
+
+def test_resume_skips_finished_files(workspace, mock_server):
+    first, _ = run(workspace, mock_server)
+    before = calls(mock_server)
+    assert before > 0
+    files = manifest_files(workspace)
+    for name in ("a", "b"):
+        assert files[name]["source_hash"] == source_hash(workspace.haystack / f"{name}.md")
+    assert sorted(run(workspace, mock_server, resume=True)[0]) == sorted(first)
+    assert calls(mock_server) == before
+
+
+def test_resume_reprocesses_a_changed_file(workspace, mock_server):
+    run(workspace, mock_server)
+    path = workspace.haystack / "b.md"
+    path.write_text(path.read_text(encoding="utf-8") + "\nA new closing line.\n",
+                    encoding="utf-8")
+    before = calls(mock_server)
+    assert len(run(workspace, mock_server, resume=True)[0]) == 2
+    assert calls(mock_server) > before
+    files = manifest_files(workspace)
+    assert files["b"]["source_hash"] == source_hash(path)
+    assert files["b"]["status"] == "done"
+
+
+def test_binary_file_is_skipped(workspace, mock_server):
+    (workspace.haystack / "c.md").write_bytes(b"\xff\xfe\x00binary" * 100)
+    assert len(run(workspace, mock_server)[0]) == 2
+    assert manifest_files(workspace)["c"]["status"] == "failed"
+
+
+def map_units(workspace):
+    return {(name, unit_id): unit["status"]
+            for name, entry in manifest_files(workspace).items()
+            for unit_id, unit in entry["units"].items() if unit_id.startswith("map:")}
+
+
+def test_resume_after_failures_only_redoes_failed_calls(workspace, mock_server):
+    mock_server.settings.error_rate = 0.7
+    run(workspace, mock_server, dedup=False)
+    done = sum(status == "done" for status in map_units(workspace).values())
+    mock_server.settings.error_rate = 0.0
+    finals, map_calls = run(workspace, mock_server, resume=True, dedup=False)
+    assert len(finals) == 2
+    units = map_units(workspace)
+    assert set(units.values()) == {"done"}
+    assert 0 < done < len(units)
+    assert map_calls == len(units) - done
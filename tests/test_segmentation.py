@@ -0,0 +1,62 @@
+"""The streaming planner must cut a document exactly like the whole-document planner."""
+import pytest
+
+from benchmarks.run_benchmarks import synthetic_document
+from segmentation import get_chunker, stream_segments
+
+WINDOW_TOKENS = 700
+
+
+def blocks_of(tokens, size):
+    for start in range(0, len(tokens), size):
+        yield tokens[start:start + size]
+
+
+def window_by_window(chunker, tokens, encoding, window_tokens):
+    """Concatenated plan_window() output, shifted back to document offsets."""
+    segments = []
+    offset = 0
+    window_idx = 0
+    while offset < len(tokens):
+        window, next_start = chunker.plan_window(tokens[offset:], encoding, window_tokens)
+        segments.extend(
+            segment._replace(ordinal=window_idx * chunker.segment_count + segment.seg_idx,
+                             window_idx=window_idx, start=segment.start + offset,
+                             end=segment.end + offset)
+            for segment in window
+        )
+        offset += next_start
+        window_idx += 1
+    return segments
+
+
+@pytest.mark.parametrize("chunker_name", ["fixed", "structure"])
+@pytest.mark.parametrize("window_overlap", [0, 100])
+@pytest.mark.parametrize("segment_overlap", [0, 25])
+def test_plan_window_matches_plan(encoding, chunker_name, window_overlap, segment_overlap):
+    chunker = get_chunker(chunker_name, segment_count=3, segment_overlap=segment_overlap,
+                          window_overlap=window_overlap)
+    tokens = encoding.encode(synthetic_document(4000, seed=7))
+    expected = chunker.plan(tokens, encoding, WINDOW_TOKENS)
+    assert len({segment.window_idx for segment in expected}) > 3
+    assert window_by_window(chunker, tokens, encoding, WINDOW_TOKENS) == expected
+
+
+@pytest.mark.parametrize("chunker_name", ["fixed", "structure"])
+@pytest.mark.parametrize("window_overlap", [0, 100])
+@pytest.mark.parametrize("block_size", [50, 701, 5000])
+def test_stream_segments_matches_plan(encoding, chunker_name, window_overlap, block_size):
+    chunker = get_chunker(chunker_name, window_overlap=window_overlap)
+    tokens = encoding.encode(synthetic_document(4000, seed=11))
+    streamed = list(stream_segments(blocks_of(tokens, block_size), chunker, encoding,
+                                    WINDOW_TOKENS))
+    assert streamed == chunker.plan(tokens, encoding, WINDOW_TOKENS)
+
+
+@pytest.mark.parametrize("chunker_name", ["fixed", "structure"])
+def test_short_document_is_one_window(encoding, chunker_name):
+    chunker = get_chunker(chunker_name)
+    tokens = encoding.encode(synthetic_document(100, seed=3))
+    segments, next_start = chunker.plan_window(tokens, encoding, WINDOW_TOKENS)
+    assert next_start == len(tokens)
+    assert segments == chunker.plan(tokens, encoding, WINDOW_TOKENS)
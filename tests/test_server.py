@@ -0,0 +1,108 @@
+"""The job server: its HTTP API, job validation and warm connection builds."""
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+import server as server_module
+from conftest import connection_config
+from crystallizer import Crystallizer
+from server import CrystallizerService, make_server
+
+
+@pytest.fixture
+def service(workspace, mock_server):
+    config = workspace.write_config({"mock": connection_config(mock_server),
+                                     "slow": connection_config(mock_server)},
+                                    incremental=False)
+    service = CrystallizerService(config, max_jobs=1, use_cache=False)
+    yield service
+    service.shutdown()
+
+
+@pytest.fixture
+def api(service):
+    http = make_server(service, port=0)
+    thread = threading.Thread(target=http.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    host, port = http.server_address[:2]
+
+    def call(method, path, body=None):
+        data = None if body is None else json.dumps(body).encode("utf-8")
+        request = urllib.request.Request(f"http://{host}:{port}{path}", data=data, method=method)
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            return e.code, json.loads(e.read())
+
+    yield call
+    http.shutdown()
+    http.server_close()
+
+
+def job_spec(workspace, **fields):
+    return {"haystack_path": str(workspace.haystack), "system_prompt": str(workspace.prompt),
+            "connection": "mock", "task_label": "task",
+            "output_dir": str(workspace.output_dir), **fields}
+
+
+def test_job_runs_to_completion(workspace, api):
+    status, job = api("POST", "/jobs", job_spec(workspace, options={"include": ["a.md"]}))
+    assert status == 202
+    deadline = time.monotonic() + 20
+    while job["status"] in ("queued", "running") and time.monotonic() < deadline:
+        time.sleep(0.05)
+        _, job = api("GET", f"/jobs/{job['id']}")
+    assert job["status"] == "done", job["error"]
+    assert [path.rsplit("/", 1)[-1] for path in job["final_crystals"]] == ["a__task__final.txt"]
+    _, health = api("GET", "/health")
+    assert health["jobs"]["done"] == 1
+    assert list(health["connections"]) == ["mock"]
+
+
+@pytest.mark.parametrize("fields,message", [
+    ({"options": {"include": "*.md"}}, "'include' must be of type list of strings"),
+    ({"options": {"reduce_fan_in": "8"}}, "'reduce_fan_in' must be of type integer"),
+    ({"options": {"segment_count": True}}, "'segment_count' must be of type integer"),
+    ({"options": {"dedup": 1}}, "'dedup' must be of type boolean"),
+    ({"options": {"colour": "blue"}}, "Unknown job option(s) ['colour']"),
+    ({"options": ["include"]}, "options must be a JSON object"),
+    ({"resume": "yes"}, "'resume' must be of type boolean"),
+    ({"task_label": 7}, "'task_label' must be of type string"),
+])
+def test_bad_jobs_are_rejected(workspace, api, fields, message):
+    status, body = api("POST", "/jobs", job_spec(workspace, **fields))
+    assert status == 400
+    assert message in body["error"]
+    _, jobs = api("GET", "/jobs")
+    assert jobs["jobs"] == []
+
+
+def test_slow_connection_build_does_not_block_others(service, monkeypatch):
+    builds = []
+
+    class SlowToBuild(Crystallizer):
+        def __init__(self, config_path, connection_name, **kwargs):
+            builds.append(connection_name)
+            if connection_name == "slow":
+                time.sleep(0.5)
+            super().__init__(config_path, connection_name, **kwargs)
+
+    monkeypatch.setattr(server_module, "Crystallizer", SlowToBuild)
+    warmed = []
+    threads = [threading.Thread(target=lambda: warmed.append(service.connection("slow")))
+               for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)
+    started = time.monotonic()
+    service.connection("mock")
+    assert time.monotonic() - started < 0.3
+    for thread in threads:
+        thread.join()
+    assert warmed[0] is warmed[1]
+    assert sorted(builds) == ["mock", "slow"]
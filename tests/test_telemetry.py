@@ -0,0 +1,30 @@
+"""Summary figures computed from call records."""
+from typing import Any
+
+from telemetry import MetricsRecorder
+
+
+def record(metrics: MetricsRecorder, end: float, wall_time: float, completion_tokens: int,
+           **fields: Any) -> None:
+    metrics.record_call(connection="c", stage="map", label="x", status="ok",
+                        wall_time=wall_time, queue_wait=0.0, retries=0,
+                        completion_tokens=completion_tokens, time=end, **fields)
+
+
+def test_tokens_per_sec_is_connection_throughput() -> None:
+    metrics = MetricsRecorder()
+    # Four fully concurrent 2 s calls of 100 tokens: 400 tokens in 2 s
+    for _ in range(4):
+        record(metrics, end=1002.0, wall_time=2.0, completion_tokens=100)
+    row = metrics.summary()["connections"]["c/map"]
+    assert row["tokens_per_sec"] == 200.0
+
+
+def test_tokens_per_sec_spans_sequential_calls_and_skips_cache_hits() -> None:
+    metrics = MetricsRecorder()
+    record(metrics, end=1001.0, wall_time=1.0, completion_tokens=50)
+    record(metrics, end=1004.0, wall_time=1.0, completion_tokens=50)
+    record(metrics, end=1004.5, wall_time=0.0, completion_tokens=500, cached=True)
+    row = metrics.summary()["connections"]["c/map"]
+    assert row["tokens_per_sec"] == 25.0
+    assert row["cached"] == 1
@@ -1,97 +1,215 @@
-import inspect
-import time
-from datetime import datetime, timezone
-import os
-
-import psutil
-from rich import print as _print
-
-def Print(logType: str, message: str) -> None:
-    """
-    Prints a log message with timestamp, function name, symbols wrapping the logType, and the message.
-    """
-    try:
-        # Mapping of logType to symbols
-        logTypeSymbols = {
-            'SUCCESS': ('^^^', '^^^'),
-            'FAILURE': ('###', '###'),
-            'STATE': ('~~~', '~~~'),
-            'INFO': ('---', '---'),
-            'IMPORTANT': ('===', '==='),
-            'CRITICAL': ('***', '***'),  # Changed symbols for CRITICAL
-            'EXCEPTION': ('!!!', '!!!'),
-            'WARNING': ('(((', ')))'),
-            'DEBUG': ('[[[', ']]]'),
-            'ATTEMPT': ('???', '???'),
-            'STARTING': ('>>>', '>>>'),
-            'PROGRESS': ('vvv', 'vvv'),
-            'COMPLETED': ('<<<', '<<<'),
-        }
-
-        # Mapping of logType to styles
-        logTypeStyles = {
-            'SUCCESS': 'green',
-            'FAILURE': 'red bold',
-            'STATE': 'cyan',
-            'INFO': 'blue',
-            'IMPORTANT': 'magenta',
-            'CRITICAL': 'red bold',
-            'EXCEPTION': 'red bold',
-            'WARNING': 'yellow',
-            'DEBUG': 'white',
-            'ATTEMPT': 'cyan',
-            'STARTING': 'green',
-            'PROGRESS': 'blue',
-            'COMPLETED': 'green',
-        }
-
-        # Get current timestamp with microseconds
-        current_time = time.time()
-        timestamp = datetime.fromtimestamp(current_time, tz=timezone.utc).isoformat(timespec='microseconds') + 'Z'
-
-        # Get symbols for the logType
-        logTypeUpper = logType.upper()
-        symbols = logTypeSymbols.get(logTypeUpper, ('', ''))
-        before_symbol, after_symbol = symbols
-
-        # Construct the formatted logType with symbols
-        formattedLogType = f"{before_symbol} {logTypeUpper} {after_symbol}"
-
-        # Apply style if available
-        style = logTypeStyles.get(logTypeUpper, '')
-        if style:
-            formattedLogType = f"[{style}]{formattedLogType}[/{style}]"
-
-        # Get the caller function name
-        caller_frame = inspect.stack()[1]
-        function_name = caller_frame.function
-
-        # If the caller is Print, get the next frame
-        if function_name == 'Print':
-            caller_frame = inspect.stack()[2]
-            function_name = caller_frame.function
-
-        # Pad the function name for alignment (optional)
-        functionNamePadding = 40
-        paddedFunctionName = function_name.ljust(functionNamePadding)
-
-        # Construct the output line
-        output_line = f"{timestamp} {formattedLogType} {paddedFunctionName} {message}"
-
-        # Print the output using rich
-        _print(output_line)
-
-    except Exception as e:
-        error_message = f"Something went wrong when attempting to print.\nError: {e}"
-        print(error_message)
-
-
-def CPU_and_Mem_usage() -> str:
-    """
-    Returns a string with the CPU usage and memory usage of the current process.
-    """
-    current_process = psutil.Process(os.getpid())
-    cpu_usage = psutil.cpu_percent(interval=1)
-    memory_info = current_process.memory_info()
-    memory_usage_mb = memory_info.rss / (1024 ** 2)
-    return f"CPU Usage: {cpu_usage}%, Process Memory Usage: {memory_usage_mb:.2f} MB"
+import atexit
+import json
+import queue
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+import os
+
+import psutil
+from rich import print as _print
+
+# Mapping of logType to symbols
+LOG_TYPE_SYMBOLS = {
+    'SUCCESS': ('^^^', '^^^'),
+    'FAILURE': ('###', '###'),
+    'STATE': ('~~~', '~~~'),
+    'INFO': ('---', '---'),
+    'IMPORTANT': ('===', '==='),
+    'CRITICAL': ('***', '***'),  # Changed symbols for CRITICAL
+    'EXCEPTION': ('!!!', '!!!'),
+    'WARNING': ('(((', ')))'),
+    'DEBUG': ('[[[', ']]]'),
+    'ATTEMPT': ('???', '???'),
+    'STARTING': ('>>>', '>>>'),
+    'PROGRESS': ('vvv', 'vvv'),
+    'COMPLETED': ('<<<', '<<<'),
+}
+
+# Mapping of logType to styles
+LOG_TYPE_STYLES = {
+    'SUCCESS': 'green',
+    'FAILURE': 'red bold',
+    'STATE': 'cyan',
+    'INFO': 'blue',
+    'IMPORTANT': 'magenta',
+    'CRITICAL': 'red bold',
+    'EXCEPTION': 'red bold',
+    'WARNING': 'yellow',
+    'DEBUG': 'white',
+    'ATTEMPT': 'cyan',
+    'STARTING': 'green',
+    'PROGRESS': 'blue',
+    'COMPLETED': 'green',
+}
+
+# Numeric severity of each logType; messages below the configured level are dropped
+LOG_TYPE_LEVELS = {
+    'DEBUG': 10,
+    'ATTEMPT': 15,
+    'PROGRESS': 15,
+    'INFO': 20,
+    'STATE': 20,
+    'STARTING': 20,
+    'COMPLETED': 20,
+    'SUCCESS': 20,
+    'IMPORTANT': 25,
+    'WARNING': 30,
+    'FAILURE': 40,
+    'EXCEPTION': 40,
+    'CRITICAL': 50,
+}
+
+LOG_LEVELS = {
+    'debug': 10,
+    'verbose': 15,
+    'info': 20,
+    'warning': 30,
+    'error': 40,
+    'critical': 50,
+}
+
+LOG_FORMATS = ('text', 'json')
+
+FUNCTION_NAME_PADDING = 40
+
+
+def _formatted_log_type(logTypeUpper: str) -> str:
+    """Symbols wrapping the logType, with rich style markup if available."""
+    before_symbol, after_symbol = LOG_TYPE_SYMBOLS.get(logTypeUpper, ('', ''))
+    formattedLogType = f"{before_symbol} {logTypeUpper} {after_symbol}"
+    style = LOG_TYPE_STYLES.get(logTypeUpper, '')
+    if style:
+        formattedLogType = f"[{style}]{formattedLogType}[/{style}]"
+    return formattedLogType
+
+
+# Precomputed once instead of on every call
+FORMATTED_LOG_TYPES = {logType: _formatted_log_type(logType) for logType in LOG_TYPE_SYMBOLS}
+
+
+class _LogWriter:
+    """Background thread that formats and renders queued log records in order."""
+
+    def __init__(self) -> None:
+        self.log_format = 'text'
+        self.min_level = LOG_LEVELS['debug']
+        self._queue: "queue.SimpleQueue" = queue.SimpleQueue()
+        self._thread: "threading.Thread | None" = None
+        self._start_lock = threading.Lock()
+
+    def submit(self, record: tuple) -> None:
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._run, name="crystallizer-log-writer", daemon=True
+                    )
+                    self._thread.start()
+                    atexit.register(self.flush)
+        self._queue.put(record)
+
+    def flush(self) -> None:
+        """Block until every queued record has been written."""
+        if self._thread is None:
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(timeout=5)
+
+    def _run(self) -> None:
+        while True:
+            record = self._queue.get()
+            if isinstance(record, threading.Event):
+                sys.stdout.flush()
+                record.set()
+                continue
+            try:
+                self._write(*record)
+            except Exception as e:
+                try:
+                    print(f"Something went wrong when attempting to print.\nError: {e}")
+                except Exception:
+                    pass  # stdout itself is gone; keep draining so flush() never hangs
+
+    def _write(self, created: float, logTypeUpper: str, function_name: str,
+               thread_name: str, message: str) -> None:
+        # Timestamp with microseconds
+        timestamp = datetime.fromtimestamp(created, tz=timezone.utc).isoformat(timespec='microseconds') + 'Z'
+        if self.log_format == 'json':
+            sys.stdout.write(json.dumps({
+                "timestamp": timestamp,
+                "type": logTypeUpper,
+                "level": LOG_TYPE_LEVELS.get(logTypeUpper, LOG_LEVELS['info']),
+                "function": function_name,
+                "thread": thread_name,
+                "message": message,
+            }) + "\n")
+            return
+        formattedLogType = FORMATTED_LOG_TYPES.get(logTypeUpper)
+        if formattedLogType is None:
+            formattedLogType = _formatted_log_type(logTypeUpper)
+        paddedFunctionName = function_name.ljust(FUNCTION_NAME_PADDING)
+        _print(f"{timestamp} {formattedLogType} {paddedFunctionName} {message}")
+
+
+_writer = _LogWriter()
+
+
+def configure_logging(log_format: str = 'text', level: str = 'debug') -> None:
+    """Select text or JSON-lines output and the minimum level that is rendered."""
+    if log_format not in LOG_FORMATS:
+        raise ValueError(f"Unknown log format '{log_format}'")
+    if level not in LOG_LEVELS:
+        raise ValueError(f"Unknown log level '{level}'")
+    _writer.log_format = log_format
+    _writer.min_level = LOG_LEVELS[level]
+
+
+def flush_logs() -> None:
+    _writer.flush()
+
+
+def Print(logType: str, message: str) -> None:
+    """
+    Prints a log message with timestamp, function name, symbols wrapping the logType, and the message.
+
+    Records are filtered by level before any formatting, then handed to a
+    background writer so callers never block on rendering.
+    """
+    try:
+        logTypeUpper = logType.upper()
+        if LOG_TYPE_LEVELS.get(logTypeUpper, LOG_LEVELS['info']) < _writer.min_level:
+            return
+
+        # Get the caller function name without building full frame records
+        caller_frame = sys._getframe(1)
+        function_name = caller_frame.f_code.co_name
+
+        # If the caller is Print, get the next frame
+        if function_name == 'Print' and caller_frame.f_back is not None:
+            function_name = caller_frame.f_back.f_code.co_name
+
+        _writer.submit((time.time(), logTypeUpper, function_name,
+                        threading.current_thread().name, message))
+
+    except Exception as e:
+        error_message = f"Something went wrong when attempting to print.\nError: {e}"
+        print(error_message)
+
+
+_current_process = psutil.Process(os.getpid())
+
+
+def CPU_and_Mem_usage() -> str:
+    """
+    Returns a string with the CPU usage and memory usage of the current process.
+
+    CPU usage is measured since the previous call rather than by sleeping, so
+    this never blocks; the first call reports 0.0%.
+    """
+    cpu_usage = _current_process.cpu_percent(interval=None)
+    memory_info = _current_process.memory_info()
+    memory_usage_mb = memory_info.rss / (1024 ** 2)
+    return f"CPU Usage: {cpu_usage}%, Process Memory Usage: {memory_usage_mb:.2f} MB"